@@ -0,0 +1,108 @@
+import math
+import time
+
+from flask import Blueprint, request, jsonify, Response, send_file
+
+from utils.role_required import role_required
+from model_registry import registry
+from shadow_eval import shadow
+import sql_profiler
+import sampling_profiler
+
+admin_bp = Blueprint("admin_bp", __name__, url_prefix="/api/admin")
+
+
+# ---------------------------------------------------------
+# MODEL VERSIONS
+# ---------------------------------------------------------
+@admin_bp.route("/models", methods=["GET"])
+@role_required("admin")
+def list_models():
+    return jsonify(registry.status()), 200
+
+
+@admin_bp.route("/models/activate", methods=["POST"])
+@role_required("admin")
+def activate_model():
+    data = request.get_json() or {}
+    version = data.get("version")
+    if not version:
+        return jsonify({"error": "version required"}), 400
+    if version not in registry.versions():
+        return jsonify({"error": "Unknown model version"}), 404
+
+    # point CURRENT at it so watchers in the other workers follow, then load here in the background
+    registry.set_current(version)
+    registry.activate(version, background=True)
+    return jsonify({"message": f"Loading model version {version}", "status": registry.status()}), 202
+
+
+# ---------------------------------------------------------
+# SHADOW EVALUATION
+# ---------------------------------------------------------
+@admin_bp.route("/shadow", methods=["GET"])
+@role_required("admin")
+def shadow_metrics():
+    return jsonify(shadow.snapshot()), 200
+
+
+@admin_bp.route("/shadow", methods=["POST"])
+@role_required("admin")
+def start_shadow():
+    data = request.get_json() or {}
+    version = data.get("version")
+    if not version:
+        return jsonify({"error": "version required"}), 400
+    if version not in registry.versions():
+        return jsonify({"error": "Unknown model version"}), 404
+    shadow.set_candidate(version)
+    return jsonify({"message": f"Loading shadow candidate {version}"}), 202
+
+
+@admin_bp.route("/shadow", methods=["DELETE"])
+@role_required("admin")
+def stop_shadow():
+    shadow.clear()
+    return jsonify({"message": "Shadow evaluation stopped"}), 200
+
+
+# ---------------------------------------------------------
+# SQL PROFILER
+# ---------------------------------------------------------
+@admin_bp.route("/sql", methods=["GET"])
+@role_required("admin")
+def sql_report():
+    return jsonify(sql_profiler.report()), 200
+
+
+# ---------------------------------------------------------
+# SAMPLING PROFILER
+# ---------------------------------------------------------
+@admin_bp.route("/profile", methods=["GET"])
+@role_required("admin")
+def profile_process():
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval = float(request.args.get("interval_ms", 5)) / 1000.0
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    # nan slips through min() and every comparison, inf through the clamp on interval
+    if not (math.isfinite(seconds) and math.isfinite(interval)) or seconds <= 0 or interval <= 0:
+        return jsonify({"error": "seconds and interval_ms must be positive"}), 400
+    seconds = min(seconds, sampling_profiler.MAX_SECONDS)
+
+    text = sampling_profiler.profile_for(seconds, interval)
+    if text is None:
+        return jsonify({"error": "A profile is already running"}), 409
+    name = f"profile-{time.strftime('%Y%m%d%H%M%S')}.folded"
+    return Response(text, mimetype="text/plain",
+                    headers={"Content-Disposition": f"attachment; filename={name}"})
+
+
+@admin_bp.route("/profiles/<path:name>", methods=["GET"])
+@role_required("admin")
+def stored_profile(name):
+    path = sampling_profiler.profile_path(name)
+    if not path:
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(path, mimetype="text/plain", as_attachment=True, download_name=name)
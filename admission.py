@@ -0,0 +1,223 @@
+"""Admission control: per-caller token buckets and a cap on concurrent inference.
+
+Every request is charged one token from a bucket keyed by (budget, caller). The
+caller is the JWT subject, or the client IP for anonymous requests. Budgets
+are configured as "<tokens>/<seconds>[:<burst>]":
+    RATE_INFERENCE       (default 20/60:5)   POST /predict for signed-in users
+    RATE_INFERENCE_ANON  (default 5/60:2)    POST /predict without a token
+    RATE_DEFAULT         (default 300/60:60) everything else
+An empty bucket answers 429 with Retry-After before the view runs. On top of that,
+INFERENCE_MAX_CONCURRENCY requests per process may be inside /predict at once; a
+request that cannot get a slot within INFERENCE_QUEUE_WAIT seconds gets 503, so
+overload stops piling up latency behind the model.
+
+Buckets live in this process by default. RATE_LIMIT_STORE=sqlite:<path> shares
+them between the workers on a host. RATE_LIMIT=0 turns the whole layer off.
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from flask import g, request, jsonify
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("RATE_LIMIT", "1") not in ("0", "false", "False")
+STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") in ("1", "true", "True")
+MAX_INFERENCE = int(os.getenv("INFERENCE_MAX_CONCURRENCY", "4"))
+QUEUE_WAIT = float(os.getenv("INFERENCE_QUEUE_WAIT", "0.5"))
+
+INFERENCE_ENDPOINTS = {"predict_bp.predict"}
+EXEMPT_ENDPOINTS = {"static", "health", "prometheus_metrics", "file", "serve_frontend"}
+
+
+def parse_rate(spec):
+    """"20/60:5" -> (refill per second, burst). Burst defaults to the full window."""
+    rate, _, burst = spec.partition(":")
+    tokens, _, seconds = rate.partition("/")
+    tokens, seconds = float(tokens), float(seconds or 1)
+    return tokens / seconds, float(burst) if burst else tokens
+
+
+BUDGETS = {
+    "inference": parse_rate(os.getenv("RATE_INFERENCE", "20/60:5")),
+    "inference_anon": parse_rate(os.getenv("RATE_INFERENCE_ANON", "5/60:2")),
+    "default": parse_rate(os.getenv("RATE_DEFAULT", "300/60:60")),
+}
+
+
+# -------------------------------------------------------------
+# BUCKET STORES
+# -------------------------------------------------------------
+def _refill(tokens, updated, now, rate, burst, cost):
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= cost:
+        return tokens - cost, True, 0.0
+    return tokens, False, (cost - tokens) / rate if rate > 0 else 3600.0
+
+
+class MemoryBuckets:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()   # key -> [tokens, updated], least recently used first
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1.0):
+        """(allowed, seconds until `cost` tokens are available, tokens left)."""
+        now = time.monotonic()
+        with self._lock:
+            b = self._buckets.get(key)
+            if b is None:
+                # the idlest callers go first: their buckets are the likeliest to have refilled anyway
+                while len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+                b = self._buckets[key] = [burst, now]
+            else:
+                self._buckets.move_to_end(key)
+            b[0], allowed, wait = _refill(b[0], b[1], now, rate, burst, cost)
+            b[1] = now
+            return allowed, wait, b[0]
+
+
+class SQLiteBuckets:
+    """Buckets in a small SQLite file so every worker process draws from the same budget."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        # rows untouched for longer than the slowest refill are full buckets and can go
+        self.horizon = max(burst / rate for rate, burst in BUDGETS.values() if rate > 0)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, cost=1.0):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens, allowed, wait = _refill(tokens, updated, now, rate, burst, cost)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - self.horizon,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, wait, tokens
+
+
+class InferenceSlots:
+    """At most `size` holders at once, with the number currently inside kept for the gauge."""
+
+    def __init__(self, size):
+        self._sem = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def acquire(self, timeout):
+        if not self._sem.acquire(timeout=timeout):
+            return False
+        with self._lock:
+            self.in_flight += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._sem.release()
+
+
+def _make_store(spec):
+    if spec.startswith("sqlite:"):
+        return SQLiteBuckets(spec[len("sqlite:"):])
+    return MemoryBuckets()
+
+
+# -------------------------------------------------------------
+# FLASK WIRING
+# -------------------------------------------------------------
+def _caller():
+    from flask_jwt_extended import verify_jwt_in_request, get_jwt
+    try:
+        verify_jwt_in_request(optional=True)
+        sub = (get_jwt() or {}).get("sub")
+    except Exception:
+        sub = None
+    if sub is not None:
+        return f"u:{sub}", True
+    addr = request.remote_addr
+    if TRUST_PROXY and request.headers.get("X-Forwarded-For"):
+        addr = request.headers["X-Forwarded-For"].split(",")[0].strip()
+    return f"ip:{addr}", False
+
+
+def init_admission(app):
+    if not ENABLED:
+        return
+    from metrics import metrics
+
+    buckets = _make_store(STORE)
+    slots = InferenceSlots(MAX_INFERENCE)
+    if not any(m.name == "inference_in_flight" for m in metrics._metrics):
+        metrics.gauge("inference_in_flight", "Requests holding an inference slot", lambda: slots.in_flight)
+
+    @app.before_request
+    def _admit():
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS or request.method == "OPTIONS":
+            return None
+        inference = endpoint in INFERENCE_ENDPOINTS
+        caller, signed_in = _caller()
+        budget = ("inference" if signed_in else "inference_anon") if inference else "default"
+        rate, burst = BUDGETS[budget]
+        try:
+            allowed, wait, left = buckets.take(f"{budget}:{caller}", rate, burst)
+        except sqlite3.Error:
+            # a broken shared store must not take the API down with it
+            logger.warning("Rate limit store unavailable; admitting", exc_info=True)
+            allowed, wait, left = True, 0.0, burst
+        if not allowed:
+            metrics.admission.inc(budget, "throttled")
+            resp = jsonify({"error": "Rate limit exceeded", "retry_after": round(wait, 1)})
+            resp.headers["Retry-After"] = str(max(1, int(wait + 0.999)))
+            return resp, 429
+        g._rate_remaining = int(left)
+
+        if inference:
+            if not slots.acquire(timeout=QUEUE_WAIT):
+                metrics.admission.inc(budget, "overloaded")
+                resp = jsonify({"error": "Server busy, try again shortly"})
+                resp.headers["Retry-After"] = "1"
+                return resp, 503
+            g._inference_slot = True
+        metrics.admission.inc(budget, "admitted")
+        return None
+
+    @app.after_request
+    def _rate_headers(resp):
+        remaining = g.get("_rate_remaining")
+        if remaining is not None:
+            resp.headers["X-RateLimit-Remaining"] = str(remaining)
+        return resp
+
+    @app.teardown_request
+    def _release_slot(exc):
+        if g.pop("_inference_slot", False):
+            slots.release()
@@ -1,6 +1,6 @@
 import os
 import logging
-from flask import Flask, jsonify, send_from_directory
+from flask import Flask, Response, jsonify, send_from_directory
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -73,6 +73,7 @@ def create_app():
     # ------------------ MODELS SAFE IMPORT ------------------
     try:
         import models
+        import rash_analytics  # keeps the per-baby summary tables current on SkinRecord insert
         logger.info("Models loaded successfully.")
     except Exception:
         logger.warning("Model import failed — continuing.", exc_info=True)
@@ -95,18 +96,60 @@ def create_app():
         ("consultation_routes", "consult_bp"),
         ("history_routes", "history_bp"),
         ("chat_routes", "chat_bp"),
+        ("doctor_routes", "doctor_bp"),
+        ("admin_routes", "admin_bp"),
+        ("events_routes", "events_bp"),
     ]
 
     for file, bp in blueprints:
         register(file, bp)
 
+    # ------------------ METRICS ------------------
+    from metrics import init_metrics
+    init_metrics(app)
+
+    # ------------------ ADMISSION CONTROL ------------------
+    # after metrics, so throttled requests are still counted and timed
+    from admission import init_admission
+    init_admission(app)
+
+    from sql_profiler import init_sql_profiler
+    init_sql_profiler(app)
+
+    from sampling_profiler import init_profiler
+    init_profiler(app)
+
+    # ------------------ OUTBOUND MAIL ------------------
+    # enqueue only; the workers start from the server entry point (or MAIL_QUEUE_AUTOSTART=1 under WSGI)
+    from mail_queue import init_mail_queue
+    init_mail_queue(app)
+
+    # ------------------ EVENTS ------------------
+    from events import init_events
+    init_events(app)
+
+    # ------------------ RETENTION ------------------
+    # RETENTION_INTERVAL_HOURS=<h> archives old originals in the background
+    from retention import init_retention
+    init_retention(app)
+
+    # ------------------ MODEL RELOAD WATCHER ------------------
+    # MODEL_WATCH_INTERVAL=<seconds> makes each worker follow model_store/CURRENT
+    watch_interval = float(os.getenv("MODEL_WATCH_INTERVAL", "0") or 0)
+    if watch_interval > 0:
+        from model_registry import registry
+        registry.start_watcher(watch_interval)
+
     # ------------------ ROUTES ------------------
     @app.route("/health")
     def health():
+        from model_registry import registry
+        active = registry.peek()
         return jsonify({
             "status": "ok",
-            "model_loaded": app.model is not None,
-            "labels": app.class_names
+            "model_loaded": active is not None,
+            "model_version": active.version if active else None,
+            "labels": active.class_names if active else app.class_names
         })
 
     # ------------------ SECURITY HEADERS ------------------
@@ -131,6 +174,14 @@ def create_app():
 
     @app.route("/instance/uploads/<path:filename>")
     def file(filename):
+        if not os.path.isfile(os.path.join(app.uploads_path, filename)):
+            # originals past retention live in instance/archive packs (retention.py)
+            from retention import archive
+            blob = archive.read(filename)
+            if blob is not None:
+                resp = Response(blob[0], mimetype=blob[1])
+                resp.headers["Cache-Control"] = "private, max-age=86400"
+                return resp
         return send_from_directory(app.uploads_path, filename)
 
     @app.route("/", defaults={"path": "login.html"})
@@ -157,4 +208,6 @@ def create_app():
 # -------------------------------------------------------------
 if __name__ == "__main__":
     application = create_app()
+    from mail_queue import dispatcher
+    dispatcher.start()
     application.run(debug=True, port=5000)
@@ -0,0 +1,92 @@
+"""Backfill skin_records.phash for uploads made before near-duplicate detection.
+Run: python backfill_phash.py [--workers 4] [--batch 200] [--force]
+
+Hashes every record's file in instance/uploads or the retention archive (JPEGs are decoded at reduced
+scale via draft mode; the hash only needs 32x32) and writes the hashes in batches.
+Files in uploads that no record points at are counted and listed, not hashed.
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from image_hash import phash, to_hex
+
+
+def hash_file(src):
+    """Hex phash of an image path or binary file object; None if it cannot be decoded."""
+    try:
+        with Image.open(src) as img:
+            img.draft("L", (64, 64))
+            return to_hex(phash(img))
+    except Exception:
+        return None
+
+
+def hash_upload(uploads, name):
+    """(phash or None, found) for an upload, read from the archive once retention has moved it."""
+    from retention import open_upload
+    try:
+        fh = open_upload(uploads, name)
+    except FileNotFoundError:
+        return None, False
+    with fh:
+        return hash_file(fh), True
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--batch", type=int, default=200)
+    ap.add_argument("--force", action="store_true", help="re-hash records that already have a phash")
+    args = ap.parse_args()
+
+    from app import create_app
+    from extensions import db
+    from models import SkinRecord
+
+    app = create_app()
+    with app.app_context():
+        uploads = app.uploads_path
+        query = SkinRecord.query.with_entities(SkinRecord.id, SkinRecord.image_path) \
+            .filter(SkinRecord.image_path.isnot(None))
+        if not args.force:
+            query = query.filter(SkinRecord.phash.is_(None))
+        rows = query.order_by(SkinRecord.id).all()
+        referenced = {p for (p,) in db.session.query(SkinRecord.image_path).filter(SkinRecord.image_path.isnot(None))}
+
+        started = time.perf_counter()
+        done = missing = failed = 0
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for i in range(0, len(rows), args.batch):
+                chunk = rows[i:i + args.batch]
+                names = [p for _, p in chunk]
+                updates = []
+                for (rid, _), (h, found) in zip(chunk, pool.map(hash_upload, [uploads] * len(names), names)):
+                    if h is not None:
+                        updates.append({"id": rid, "phash": h})
+                    elif not found:
+                        missing += 1
+                    else:
+                        failed += 1
+                if updates:
+                    db.session.bulk_update_mappings(SkinRecord, updates)
+                    db.session.commit()
+                done += len(updates)
+                print(f"  {i + len(chunk)}/{len(rows)} records, {done} hashed", flush=True)
+
+        orphans = sorted(f for f in os.listdir(uploads)
+                         if os.path.isfile(os.path.join(uploads, f)) and f not in referenced)
+        elapsed = time.perf_counter() - started
+        print(f"Hashed {done} records in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f}/s); "
+              f"{missing} files missing, {failed} unreadable")
+        if orphans:
+            print(f"{len(orphans)} files in uploads have no record (not indexed):")
+            for name in orphans[:20]:
+                print("   ", name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Benchmark inference_utils.predict_image_bytes.
+Run: python bench_inference.py --concurrency 1,2,4,8 --json bench_inference.json
+
+Replays every image in instance/uploads (plus optional synthetic images) through the
+real inference path and reports cold start, p50/p95/p99 latency, throughput per
+concurrency level and a per-stage breakdown. The JSON output carries the git commit
+so runs can be compared across commits.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+UPLOADS = os.path.join(BASE, "instance", "uploads")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def load_images(uploads, limit, synthetic, resolutions, seed):
+    images = []
+    if uploads and os.path.isdir(uploads):
+        for fname in sorted(os.listdir(uploads)):
+            if fname.lower().endswith(IMAGE_EXTS):
+                with open(os.path.join(uploads, fname), "rb") as f:
+                    images.append((fname, f.read()))
+            if limit and len(images) >= limit:
+                break
+    rng = np.random.default_rng(seed)
+    for w, h in resolutions:
+        for i in range(synthetic):
+            arr = rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+            buf = io.BytesIO()
+            Image.fromarray(arr).save(buf, format="JPEG", quality=90)
+            images.append((f"synthetic_{w}x{h}_{i}.jpg", buf.getvalue()))
+    return images
+
+
+def pct(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 2) if values else None
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "mean_ms": round(float(np.mean(latencies)) * 1000, 2) if latencies else None,
+        "p50_ms": pct(latencies, 50),
+        "p95_ms": pct(latencies, 95),
+        "p99_ms": pct(latencies, 99),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BASE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the inference path.")
+    p.add_argument("--uploads", default=UPLOADS, help="directory of real images to replay ('' to skip)")
+    p.add_argument("--limit", type=int, default=0, help="max real images (0 = all)")
+    p.add_argument("--synthetic", type=int, default=0, help="synthetic images per resolution")
+    p.add_argument("--resolution", default="224x224,1024x768,4032x3024",
+                   help="comma separated WxH list for synthetic images")
+    p.add_argument("--iterations", type=int, default=3, help="passes over the image set for latency")
+    p.add_argument("--warmup", type=int, default=3)
+    p.add_argument("--concurrency", default="1,2,4,8")
+    p.add_argument("--requests", type=int, default=0, help="requests per concurrency level (default: 2x images)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--json", default=None, help="write results here instead of stdout")
+    args = p.parse_args()
+
+    resolutions = [tuple(int(v) for v in r.split("x")) for r in args.resolution.split(",") if r]
+    images = load_images(args.uploads, args.limit, args.synthetic, resolutions, args.seed)
+    if not images:
+        raise SystemExit("No images to replay; use --synthetic N or point --uploads at a folder")
+
+    # ------------------ COLD START ------------------
+    t0 = time.perf_counter()
+    import inference_utils
+    t1 = time.perf_counter()
+    lm = inference_utils.registry.active()
+    t2 = time.perf_counter()
+    inference_utils.predict_image_bytes(images[0][1])
+    t3 = time.perf_counter()
+    cold = {"import_s": round(t1 - t0, 3), "load_and_warm_s": round(t2 - t1, 3),
+            "first_predict_ms": round((t3 - t2) * 1000, 2), "total_s": round(t3 - t0, 3)}
+    print(f"cold start: {cold}", file=sys.stderr)
+
+    for i in range(args.warmup):
+        inference_utils.predict_image_bytes(images[i % len(images)][1])
+
+    # ------------------ SEQUENTIAL LATENCY + STAGES ------------------
+    latencies = []
+    stages = {s: [] for s in inference_utils.STAGES}
+    for _ in range(args.iterations):
+        for _, data in images:
+            timings = {}
+            start = time.perf_counter()
+            inference_utils.predict_image_bytes(data, timings=timings)
+            latencies.append(time.perf_counter() - start)
+            for s in stages:
+                stages[s].append(timings.get(s, 0.0))
+    total_mean = float(np.mean(latencies))
+    breakdown = {}
+    for s, vals in stages.items():
+        breakdown[s] = dict(summarize(vals), share=round(float(np.mean(vals)) / total_mean, 3))
+    latency = summarize(latencies)
+    print(f"latency: {latency}", file=sys.stderr)
+
+    # ------------------ THROUGHPUT ------------------
+    throughput = []
+    n_req = args.requests or 2 * len(images)
+    for c in [int(v) for v in args.concurrency.split(",") if v]:
+        payloads = [images[i % len(images)][1] for i in range(n_req)]
+
+        def one(data):
+            s = time.perf_counter()
+            inference_utils.predict_image_bytes(data)
+            return time.perf_counter() - s
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=c) as pool:
+            lats = list(pool.map(one, payloads))
+        wall = time.perf_counter() - start
+        row = dict(summarize(lats), concurrency=c, wall_s=round(wall, 3), rps=round(n_req / wall, 2))
+        throughput.append(row)
+        print(f"concurrency {c}: {row['rps']} req/s, p95 {row['p95_ms']} ms", file=sys.stderr)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "model_version": lm.version,
+        "input_size": list(lm.input_size),
+        "images": {"real": sum(1 for n, _ in images if not n.startswith("synthetic_")),
+                   "synthetic": sum(1 for n, _ in images if n.startswith("synthetic_"))},
+        "cold_start": cold,
+        "latency": latency,
+        "stages": breakdown,
+        "throughput": throughput,
+    }
+    out = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(out)
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Compare the default training configuration against `train_model.py --fast`.
+Run: python bench_training.py --epochs 2
+Each configuration runs in its own process (the mixed precision policy is global),
+writes its model to a temp dir and reports wall-clock time, images/sec and final val accuracy.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+TRAIN_SCRIPT = os.path.join(BASE, "train_model.py")
+
+
+def run_config(name, extra_args, epochs, fine_tune_epochs, workdir):
+    out = os.path.join(workdir, f"{name}.keras")
+    report = os.path.join(workdir, f"{name}.json")
+    cmd = [sys.executable, TRAIN_SCRIPT, "--epochs", str(epochs),
+           "--fine-tune-epochs", str(fine_tune_epochs), "--out", out, "--report", report,
+           "--checkpoint-dir", os.path.join(workdir, f"{name}_ckpt")] + extra_args
+    print(f"\n=== {name}: {' '.join(cmd[1:])}")
+    subprocess.run(cmd, check=True)
+    with open(report, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark baseline vs --fast training.")
+    p.add_argument("--epochs", type=int, default=2)
+    p.add_argument("--fine-tune-epochs", type=int, default=0)
+    p.add_argument("--batch", type=int, default=None, help="batch size for the --fast run")
+    p.add_argument("--json", default=None, help="also write the comparison to this file")
+    args = p.parse_args()
+
+    fast_args = ["--fast"] + (["--batch", str(args.batch)] if args.batch else [])
+    with tempfile.TemporaryDirectory() as workdir:
+        results = {
+            "baseline": run_config("baseline", [], args.epochs, args.fine_tune_epochs, workdir),
+            "fast": run_config("fast", fast_args, args.epochs, args.fine_tune_epochs, workdir),
+        }
+
+    def mean_ips(r):
+        eps = r.get("epochs") or []
+        # first epoch includes tracing / XLA compilation, so report steady state when possible
+        steady = eps[1:] or eps
+        return sum(e["images_per_sec"] for e in steady) / len(steady) if steady else 0.0
+
+    print("\nconfig     policy           batch  wall_s    img/s   val_acc")
+    for name, r in results.items():
+        acc = r.get("final_val_accuracy")
+        print(f"{name:<10} {r['policy']:<16} {r['batch']:>5} {r['wall_seconds']:>7.1f} {mean_ips(r):>8.1f}   "
+              f"{acc if acc is None else round(acc, 4)}")
+    base_wall = results["baseline"]["wall_seconds"]
+    fast_wall = results["fast"]["wall_seconds"]
+    if fast_wall:
+        print(f"\nspeedup: {base_wall / fast_wall:.2f}x wall-clock")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+"""Bulk import of users, babies and skin records from CSV / JSONL.
+Run: python bulk_import.py users users.csv
+     python bulk_import.py babies babies.jsonl
+     python bulk_import.py records records.csv --images-dir ./photos [--batch 1000] [--workers 8]
+
+Input is streamed and handled `--batch` rows at a time: each chunk is validated
+with a few IN queries (duplicate emails, unknown parents / babies), its images are
+copied into instance/uploads on a thread pool (and perceptual-hashed on the way),
+and the valid rows go in with one executemany in their own transaction. Rows that
+fail validation are written to --rejects with their line number and reason;
+--strict stops at the first one instead. Should the database still refuse a chunk
+(a row written concurrently, say), that chunk is retried row by row so only the
+offending rows are rejected and their copied images removed.
+
+This talks to the database through a plain SQLAlchemy engine (DATABASE_URL, or
+instance/babyskincare.db like the app), so no create_app() and no TensorFlow. Core
+inserts skip the ORM hooks, so after a records import the per-baby analytics are
+rebuilt for the babies that received rows; embeddings for similar-case search are
+filled in by `python embedding_index.py backfill` as usual.
+
+Columns (header names for CSV, keys for JSONL; `id` is optional everywhere and
+must not exist yet):
+    users    full_name, email, password | password_hash, role, specialization, experience, bio
+    babies   name, parent_id | parent_email, date_of_birth
+    records  baby_id, image, predicted_rash_type, confidence_score, model_version, created_by_id, created_at
+"""
+import os
+import csv
+import sys
+import json
+import time
+import shutil
+import secrets
+import argparse
+from datetime import datetime
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+from werkzeug.utils import secure_filename
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+UPLOADS = os.path.join(ROOT, "instance", "uploads")
+ROLES = ("parent", "doctor", "admin")
+
+
+class RowError(ValueError):
+    pass
+
+
+# -------------------------------------------------------------
+# INPUT
+# -------------------------------------------------------------
+def read_rows(path, fmt=None):
+    """Yield (line number, dict) from a CSV or JSONL file ("-" reads stdin)."""
+    fmt = fmt or ("jsonl" if path.endswith((".jsonl", ".ndjson", ".json")) else "csv")
+    fh = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(fh)
+            for row in reader:
+                yield reader.line_num, {k.strip(): v.strip() if isinstance(v, str) else v
+                                        for k, v in row.items() if k}
+        else:
+            for n, line in enumerate(fh, 1):
+                if line.strip():
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        yield n, RowError(f"invalid JSON: {e.msg}")
+                        continue
+                    yield n, row if isinstance(row, dict) else RowError("expected a JSON object")
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+
+
+def chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _blank(v):
+    return v is None or (isinstance(v, str) and not v.strip())
+
+
+def _opt(row, key, conv=str):
+    v = row.get(key)
+    if _blank(v):
+        return None
+    try:
+        return conv(v)
+    except (TypeError, ValueError):
+        raise RowError(f"bad {key}: {v!r}")
+
+
+def _req(row, key, conv=str):
+    v = _opt(row, key, conv)
+    if v is None:
+        raise RowError(f"missing {key}")
+    return v
+
+
+def _row_id(row):
+    v = _opt(row, "id", int)
+    if v is not None and v < 1:
+        raise RowError(f"bad id: {v}")
+    return v
+
+
+def _datetime(v):
+    if isinstance(v, datetime):
+        return v
+    return datetime.fromisoformat(str(v).replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+# -------------------------------------------------------------
+# KINDS
+# -------------------------------------------------------------
+class Importer:
+    """Parses a chunk, checks it against the database, returns rows ready for executemany."""
+    table = None
+
+    def __init__(self, args, pool, reject):
+        self.args = args
+        self.pool = pool
+        self.reject = reject      # reject(row, error, line): report a row dropped in prepare()
+
+    def parse(self, row):
+        raise NotImplementedError
+
+    def check(self, conn, parsed):
+        """[(line, row, error or None)] -> same list with database-level errors filled in.
+
+        Subclasses extend this; the base checks explicit ids against the table and the chunk.
+        """
+        ids = [r["id"] for _, r, err in parsed if err is None and r["id"] is not None]
+        taken = set(conn.execute(sa.select(self.table.c.id).where(self.table.c.id.in_(ids))).scalars()) \
+            if ids else set()
+        seen = set()
+        out = []
+        for line, r, err in parsed:
+            if err is None and r["id"] is not None:
+                if r["id"] in taken:
+                    err = f"id {r['id']} already exists"
+                elif r["id"] in seen:
+                    err = f"duplicate id {r['id']} in input"
+                seen.add(r["id"])
+            out.append((line, r, err))
+        return out
+
+    def prepare(self, rows):
+        """Expensive per-row work (hashing, file copies) on the thread pool; may reject rows."""
+        return rows
+
+    def discard(self, rows):
+        """Undo prepare() side effects for rows that did not make it into the database."""
+
+    def inserted(self, rows):
+        """Rows now committed."""
+
+
+class UserImporter(Importer):
+    name = "users"
+
+    def __init__(self, *a):
+        super().__init__(*a)
+        from models import User
+        self.table = User.__table__
+
+    def parse(self, row):
+        role = (_opt(row, "role") or "parent").lower()
+        if role not in ROLES:
+            raise RowError(f"bad role: {role}")
+        email = _req(row, "email").lower()
+        if "@" not in email:
+            raise RowError(f"bad email: {email}")
+        if _blank(row.get("password")) and _blank(row.get("password_hash")):
+            raise RowError("missing password or password_hash")
+        return {"id": _row_id(row), "full_name": _req(row, "full_name"), "email": email,
+                "password_hash": _opt(row, "password_hash"), "_password": _opt(row, "password"),
+                "role": role, "specialization": _opt(row, "specialization"),
+                "experience": _opt(row, "experience", int), "bio": _opt(row, "bio"),
+                "created_at": _opt(row, "created_at", _datetime) or datetime.utcnow()}
+
+    def check(self, conn, parsed):
+        parsed = super().check(conn, parsed)
+        emails = [r["email"] for _, r, err in parsed if err is None]
+        taken = set(conn.execute(sa.select(self.table.c.email).where(self.table.c.email.in_(emails))).scalars()) \
+            if emails else set()
+        seen = set()
+        out = []
+        for line, r, err in parsed:
+            if err is None:
+                if r["email"] in taken:
+                    err = "email already registered"
+                elif r["email"] in seen:
+                    err = "duplicate email in input"
+                seen.add(r["email"])
+            out.append((line, r, err))
+        return out
+
+    def prepare(self, rows):
+        method = self.args.hash_method
+        todo = [r for r in rows if r["password_hash"] is None]
+        # scrypt / pbkdf2 run in C without the GIL, so the pool really runs them in parallel
+        hashes = self.pool.map(lambda r: generate_password_hash(r["_password"], method=method), todo)
+        for r, h in zip(todo, hashes):
+            r["password_hash"] = h
+        for r in rows:
+            del r["_password"]
+        return rows
+
+
+class BabyImporter(Importer):
+    name = "babies"
+
+    def __init__(self, *a):
+        super().__init__(*a)
+        from models import Baby, User
+        self.table = Baby.__table__
+        self.users = User.__table__
+
+    def parse(self, row):
+        parent_id, parent_email = _opt(row, "parent_id", int), _opt(row, "parent_email")
+        if parent_id is None and parent_email is None:
+            raise RowError("missing parent_id or parent_email")
+        return {"id": _row_id(row), "name": _req(row, "name"), "parent_id": parent_id,
+                "_parent_email": parent_email.lower() if parent_email else None,
+                "date_of_birth": _opt(row, "date_of_birth")}
+
+    def check(self, conn, parsed):
+        parsed = super().check(conn, parsed)
+        u = self.users.c
+        ids = {r["parent_id"] for _, r, err in parsed if err is None and r["parent_id"] is not None}
+        emails = {r["_parent_email"] for _, r, err in parsed if err is None and r["parent_id"] is None}
+        known_ids = set(conn.execute(sa.select(u.id).where(u.id.in_(ids))).scalars()) if ids else set()
+        by_email = dict(conn.execute(sa.select(u.email, u.id).where(u.email.in_(emails))).all()) if emails else {}
+        out = []
+        for line, r, err in parsed:
+            if err is None:
+                if r["parent_id"] is None:
+                    r["parent_id"] = by_email.get(r["_parent_email"])
+                    if r["parent_id"] is None:
+                        err = f"unknown parent_email {r['_parent_email']}"
+                elif r["parent_id"] not in known_ids:
+                    err = f"unknown parent_id {r['parent_id']}"
+                r.pop("_parent_email", None)
+            out.append((line, r, err))
+        return out
+
+
+class RecordImporter(Importer):
+    name = "records"
+
+    def __init__(self, *a):
+        super().__init__(*a)
+        from models import SkinRecord, Baby
+        self.table = SkinRecord.__table__
+        self.babies = Baby.__table__
+        self.affected = set()
+
+    def parse(self, row):
+        conf = _opt(row, "confidence_score", float)
+        if conf is not None and not 0 <= conf <= 100:
+            raise RowError(f"confidence_score out of range: {conf}")
+        return {"id": _row_id(row), "baby_id": _req(row, "baby_id", int),
+                "created_by_id": _opt(row, "created_by_id", int),
+                "predicted_rash_type": _opt(row, "predicted_rash_type"), "confidence_score": conf,
+                "model_version": _opt(row, "model_version"), "phash": _opt(row, "phash"),
+                "_image": _opt(row, "image"), "image_path": None,
+                "created_at": _opt(row, "created_at", _datetime) or datetime.utcnow()}
+
+    def check(self, conn, parsed):
+        parsed = super().check(conn, parsed)
+        ids = {r["baby_id"] for _, r, err in parsed if err is None}
+        known = set(conn.execute(sa.select(self.babies.c.id).where(self.babies.c.id.in_(ids))).scalars()) \
+            if ids else set()
+        return [(line, r, err if err or r["baby_id"] in known else f"unknown baby_id {r['baby_id']}")
+                for line, r, err in parsed]
+
+    def _copy(self, r):
+        src = r.pop("_image")
+        if src is None:
+            return r, None
+        path = src if os.path.isabs(src) else os.path.join(self.args.images_dir or ".", src)
+        if not os.path.isfile(path):
+            return r, f"image not found: {src}"
+        stem, ext = os.path.splitext(secure_filename(os.path.basename(src)) or "upload.jpg")
+        name = f"{stem}_import_{secrets.token_hex(4)}{ext or '.jpg'}"
+        try:
+            shutil.copyfile(path, os.path.join(self.args.uploads, name))
+        except OSError as e:
+            return r, f"copy failed: {e}"
+        r["image_path"] = name
+        if r["phash"] is None and not self.args.no_phash:
+            from backfill_phash import hash_file
+            r["phash"] = hash_file(path)
+        return r, None
+
+    def prepare(self, rows):
+        ok = []
+        for r, err in self.pool.map(self._copy, rows):
+            if err is None:
+                ok.append(r)
+            else:
+                self.reject(r, err, r.get("_line"))
+        return ok
+
+    def discard(self, rows):
+        for r in rows:
+            if r.get("image_path"):
+                try:
+                    os.remove(os.path.join(self.args.uploads, r["image_path"]))
+                except OSError:
+                    pass
+
+    def inserted(self, rows):
+        self.affected.update(r["baby_id"] for r in rows)
+
+
+KINDS = {k.name: k for k in (UserImporter, BabyImporter, RecordImporter)}
+
+
+# -------------------------------------------------------------
+# DRIVER
+# -------------------------------------------------------------
+def make_engine(url=None):
+    url = url or os.getenv("DATABASE_URL") or f"sqlite:///{os.path.join(ROOT, 'instance', 'babyskincare.db')}"
+    engine = sa.create_engine(url)
+    if engine.dialect.name == "sqlite":
+        @sa.event.listens_for(engine, "connect")
+        def _pragmas(dbapi_conn, _):
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.close()
+    return engine
+
+
+def insert_rows(engine, table, rows):
+    """Insert rows in one transaction; executemany wants one shape per statement,
+    so rows with an explicit id and rows without go in as two batches."""
+    with_id = [r for r in rows if r["id"] is not None]
+    without_id = [{k: v for k, v in r.items() if k != "id"} for r in rows if r["id"] is None]
+    with engine.begin() as conn:
+        for batch in (with_id, without_id):
+            if batch:
+                conn.execute(table.insert(), batch)
+
+
+def _insert_chunk(engine, importer, rows, lines, reject):
+    """Insert a prepared chunk -> the rows that were stored."""
+    try:
+        insert_rows(engine, importer.table, rows)
+        return rows
+    except sa.exc.IntegrityError:
+        pass
+    except Exception:
+        importer.discard(rows)
+        raise
+    # something check() could not see (a concurrent writer, a constraint it does not know):
+    # find the offending rows one at a time and keep the rest
+    stored = []
+    for line, r in zip(lines, rows):
+        try:
+            insert_rows(engine, importer.table, [r])
+            stored.append(r)
+        except sa.exc.IntegrityError as e:
+            importer.discard([r])
+            reject(r, f"rejected by database: {e.orig}", line)
+    return stored
+
+
+def run(kind, path, args, engine=None):
+    engine = engine or make_engine(args.database_url)
+    os.makedirs(args.uploads, exist_ok=True)
+    rejects = open(args.rejects, "w", encoding="utf-8") if args.rejects else None
+    stats = {"read": 0, "inserted": 0, "rejected": 0}
+
+    def reject(row, error, line):
+        stats["rejected"] += 1
+        if args.strict:
+            raise SystemExit(f"line {line}: {error}")
+        if rejects:
+            rejects.write(json.dumps({"line": line, "error": error}) + "\n")
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            importer = KINDS[kind](args, pool, reject)
+            for chunk in chunks(read_rows(path, args.format), args.batch):
+                t0 = time.perf_counter()
+                parsed = []
+                for line, row in chunk:
+                    stats["read"] += 1
+                    if isinstance(row, Exception):
+                        parsed.append((line, None, str(row)))
+                        continue
+                    try:
+                        parsed.append((line, importer.parse(row), None))
+                    except RowError as e:
+                        parsed.append((line, None, str(e)))
+
+                with engine.connect() as conn:
+                    parsed = importer.check(conn, parsed)
+                good = []
+                for line, r, err in parsed:
+                    if err is None:
+                        r["_line"] = line
+                        good.append(r)
+                    else:
+                        reject(r, err, line)
+                good = importer.prepare(good)
+                if good:
+                    lines = [r.pop("_line") for r in good]
+                    stored = _insert_chunk(engine, importer, good, lines, reject)
+                    importer.inserted(stored)
+                    stats["inserted"] += len(stored)
+                elapsed = time.perf_counter() - started
+                print(f"{kind}: {stats['inserted']} inserted, {stats['rejected']} rejected "
+                      f"({len(chunk) / (time.perf_counter() - t0):.0f} rows/s this batch, "
+                      f"{stats['read'] / elapsed:.0f} rows/s overall)", flush=True)
+
+        if kind == "records" and importer.affected:
+            import rash_analytics
+            t0 = time.perf_counter()
+            with engine.begin() as conn:
+                n = rash_analytics.rebuild(conn, sorted(importer.affected))
+            print(f"analytics: rebuilt {len(importer.affected)} babies from {n} records "
+                  f"in {time.perf_counter() - t0:.2f}s")
+    finally:
+        if rejects:
+            rejects.close()
+
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = round(elapsed, 3)
+    stats["rows_per_sec"] = round(stats["read"] / elapsed, 1) if elapsed else None
+    print(f"done: {stats['read']} read, {stats['inserted']} inserted, {stats['rejected']} rejected "
+          f"in {elapsed:.2f}s ({stats['rows_per_sec']} rows/s)")
+    return stats
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("kind", choices=sorted(KINDS))
+    ap.add_argument("path", help="CSV or JSONL file, '-' for stdin")
+    ap.add_argument("--format", choices=("csv", "jsonl"), help="default: from the file extension")
+    ap.add_argument("--batch", type=int, default=1000, help="rows per validation chunk and transaction")
+    ap.add_argument("--workers", type=int, default=8, help="threads for image copies / password hashing")
+    ap.add_argument("--images-dir", help="base directory for relative `image` paths")
+    ap.add_argument("--uploads", default=UPLOADS)
+    ap.add_argument("--no-phash", action="store_true", help="do not hash images while copying")
+    ap.add_argument("--hash-method", default="scrypt", help="werkzeug method for plain-text passwords")
+    ap.add_argument("--rejects", default="import_rejects.jsonl", help="where rejected rows are reported")
+    ap.add_argument("--strict", action="store_true", help="stop at the first invalid row")
+    ap.add_argument("--database-url", help="default: DATABASE_URL or instance/babyskincare.db")
+    args = ap.parse_args()
+    run(args.kind, args.path, args)
+
+
+if __name__ == "__main__":
+    main()
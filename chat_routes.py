@@ -1,25 +1,26 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
 from extensions import db
-from models import User, Conversation, Message
+from models import Conversation, Message
+from utils.role_required import claims_required, current_user, current_user_id, user_profiles
+from events import publish
 
 chat_bp = Blueprint("chat_bp", __name__, url_prefix="/api/chat")
 
 # 1) Create or get conversation (parent creates with doctor)
 @chat_bp.route("/conversations", methods=["POST"])
-@jwt_required()
+@claims_required()
 def create_conversation():
     data = request.get_json() or {}
-    user_id = get_jwt_identity()
+    user_id, role = current_user()
     doctor_id = data.get("doctor_id")
     # ensure doctor exists
-    doctor = User.query.filter_by(id=doctor_id, role="doctor").first()
-    if not doctor:
+    doctor = user_profiles.get(doctor_id) if str(doctor_id or "").isdigit() else None
+    if not doctor or doctor["role"] != "doctor":
         return jsonify({"error": "Doctor not found"}), 404
+    doctor_id = doctor["id"]
 
     # If current user is doctor, treat other id as parent
-    current = User.query.get(user_id)
-    if current.role == "doctor":
+    if role == "doctor":
         parent_id = data.get("parent_id")
         if not parent_id:
             return jsonify({"error": "parent_id required for doctors"}), 400
@@ -39,26 +40,26 @@ def create_conversation():
 
 # 2) List conversations for current user
 @chat_bp.route("/conversations", methods=["GET"])
-@jwt_required()
+@claims_required()
 def list_conversations():
-    user_id = get_jwt_identity()
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({"error": "Unauthorized"}), 401
+    user_id, role = current_user()
 
-    if user.role == "doctor":
+    if role == "doctor":
         convs = Conversation.query.filter_by(doctor_id=user_id).order_by(Conversation.created_at.desc()).all()
     else:
         convs = Conversation.query.filter_by(parent_id=user_id).order_by(Conversation.created_at.desc()).all()
 
+    other_ids = [c.parent_id if role == "doctor" else c.doctor_id for c in convs]
+    others = user_profiles.get_many(other_ids)
+
     out = []
-    for c in convs:
-        other = User.query.get(c.doctor_id) if user.role == "parent" else User.query.get(c.parent_id)
+    for c, other_id in zip(convs, other_ids):
+        other = others.get(other_id) or {"id": other_id, "full_name": None}
         last_msg = Message.query.filter_by(conversation_id=c.id).order_by(Message.created_at.desc()).first()
         out.append({
             "conversation_id": c.id,
-            "other_id": other.id,
-            "other_name": other.full_name,
+            "other_id": other["id"],
+            "other_name": other["full_name"],
             "last_message": last_msg.text if last_msg else None,
             "last_at": last_msg.created_at.strftime("%Y-%m-%d %H:%M") if last_msg else None
         })
@@ -67,9 +68,9 @@ def list_conversations():
 
 # 3) Get messages for a conversation (paged simple)
 @chat_bp.route("/conversations/<int:conv_id>/messages", methods=["GET"])
-@jwt_required()
+@claims_required()
 def get_messages(conv_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     conv = Conversation.query.get(conv_id)
     if not conv:
         return jsonify({"error": "Conversation not found"}), 404
@@ -95,14 +96,14 @@ def get_messages(conv_id):
 
 # 4) Send message to a conversation
 @chat_bp.route("/conversations/<int:conv_id>/messages", methods=["POST"])
-@jwt_required()
+@claims_required()
 def send_message(conv_id):
     data = request.get_json() or {}
     text = (data.get("text") or "").strip()
     if not text:
         return jsonify({"error": "text required"}), 400
 
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     conv = Conversation.query.get(conv_id)
     if not conv:
         return jsonify({"error": "Conversation not found"}), 404
@@ -114,6 +115,13 @@ def send_message(conv_id):
     db.session.add(msg)
     db.session.commit()
 
+    sender = user_profiles.get(user_id)
+    recipient = conv.doctor_id if user_id == conv.parent_id else conv.parent_id
+    publish("message.sent", [recipient],
+            conversation_id=conv_id, message_id=msg.id, sender_id=user_id,
+            sender_name=sender["full_name"] if sender else None, text=msg.text,
+            created_at=msg.created_at.strftime("%Y-%m-%d %H:%M:%S"))
+
     return jsonify({
         "message_id": msg.id,
         "conversation_id": conv_id,
@@ -124,9 +132,9 @@ def send_message(conv_id):
 
 # 5) Mark messages as read (mark all in conv as read by recipient)
 @chat_bp.route("/conversations/<int:conv_id>/read", methods=["PUT"])
-@jwt_required()
+@claims_required()
 def mark_read(conv_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     conv = Conversation.query.get(conv_id)
     if not conv:
         return jsonify({"error": "Conversation not found"}), 404
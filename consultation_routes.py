@@ -1,7 +1,12 @@
 from flask import Blueprint, request, jsonify
 from extensions import db
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import User, Consultation, SkinRecord, Baby
+from sqlalchemy import func, or_, and_
+from models import Consultation, SkinRecord, Baby
+from utils.role_required import claims_required, current_user_id, user_profiles
+from embedding_index import similar
+from model_registry import registry
+from events import publish
+from retention import thumb_url, thumb_urls
 
 consult_bp = Blueprint("consult_bp", __name__, url_prefix="/api/consultations")
 
@@ -10,13 +15,13 @@ consult_bp = Blueprint("consult_bp", __name__, url_prefix="/api/consultations")
 # 1️⃣ Parent Sends Consultation Request
 # ---------------------------------------------------------
 @consult_bp.route("/request", methods=["POST"])
-@jwt_required()
+@claims_required()
 def request_consultation():
     data = request.get_json() or {}
 
     record_id = data.get("record_id")
     doctor_id = data.get("doctor_id")
-    parent_id = get_jwt_identity()
+    parent_id = current_user_id()
 
     if not record_id or not doctor_id:
         return jsonify({"error": "record_id and doctor_id required"}), 400
@@ -27,21 +32,28 @@ def request_consultation():
         return jsonify({"error": "Skin record not found"}), 404
 
     # Validate doctor
-    doctor = User.query.filter_by(id=doctor_id, role="doctor").first()
-    if not doctor:
+    doctor = user_profiles.get(doctor_id) if str(doctor_id).isdigit() else None
+    if not doctor or doctor["role"] != "doctor":
         return jsonify({"error": "Doctor not found"}), 404
 
     # Create consultation request
     consultation = Consultation(
-        record_id=record_id,
-        doctor_id=doctor_id,
+        baby_id=record.baby_id,
+        record_id=record.id,
+        doctor_id=doctor["id"],
         parent_id=parent_id,
+        reason=f"Skin record #{record.id}",
         status="pending"
     )
 
     db.session.add(consultation)
     db.session.commit()
 
+    parent = user_profiles.get(parent_id)
+    publish("consultation.requested", [consultation.doctor_id],
+            consultation_id=consultation.id, baby_id=consultation.baby_id, record_id=record.id,
+            parent_id=parent_id, parent_name=parent["full_name"] if parent else None)
+
     return jsonify({"message": "Consultation request sent successfully!"}), 201
 
 
@@ -49,33 +61,43 @@ def request_consultation():
 # 2️⃣ Doctor Views Consultation Requests
 # ---------------------------------------------------------
 @consult_bp.route("/doctor", methods=["GET"])
-@jwt_required()
+@claims_required("doctor")
 def doctor_requests():
-    doctor_id = get_jwt_identity()
-
-    # Check if user is doctor
-    doctor = User.query.get(doctor_id)
-    if not doctor or doctor.role != "doctor":
-        return jsonify({"error": "Access restricted to doctors only"}), 403
-
+    doctor_id = current_user_id()
+
+    # the record asked about, or for a baby-level booking the baby's latest one at the time
+    latest_then = (db.session.query(SkinRecord.id)
+                   .filter(SkinRecord.baby_id == Consultation.baby_id,
+                           SkinRecord.created_at <= Consultation.created_at)
+                   .order_by(SkinRecord.created_at.desc(), SkinRecord.id.desc())
+                   .limit(1)
+                   .correlate(Consultation)
+                   .scalar_subquery())
     requests = (
-        Consultation.query.filter_by(doctor_id=doctor_id)
-        .order_by(Consultation.requested_at.desc())
+        db.session.query(Consultation, func.coalesce(Consultation.record_id, latest_then))
+        .filter(Consultation.doctor_id == doctor_id)
+        .order_by(Consultation.created_at.desc())
         .all()
     )
 
+    # babies and records in two queries instead of two per consultation
+    baby_ids = {req.baby_id for req, _ in requests if req.baby_id is not None}
+    babies = {b.id: b for b in Baby.query.filter(Baby.id.in_(baby_ids)).all()} if baby_ids else {}
+    record_ids = {rid for _, rid in requests if rid is not None}
+    records = {r.id: r for r in SkinRecord.query.filter(SkinRecord.id.in_(record_ids)).all()} if record_ids else {}
+
     response = []
-    for req in requests:
-        record = SkinRecord.query.get(req.record_id)
-        baby = Baby.query.get(record.baby_id)
+    for req, record_id in requests:
+        baby = babies.get(req.baby_id)
+        record = records.get(record_id)
 
         response.append({
             "consultation_id": req.id,
             "status": req.status,
-            "baby_name": baby.name,
-            "rash_type": record.predicted_rash_type,
-            "requested_at": req.requested_at.strftime("%Y-%m-%d %H:%M"),
-            "record_id": record.id
+            "baby_name": baby.name if baby else None,
+            "rash_type": record.predicted_rash_type if record else None,
+            "requested_at": req.created_at.strftime("%Y-%m-%d %H:%M") if req.created_at else None,
+            "record_id": record.id if record else None
         })
 
     return jsonify(response), 200
@@ -85,10 +107,10 @@ def doctor_requests():
 # 3️⃣ Doctor Accepts or Rejects Consultation Request
 # ---------------------------------------------------------
 @consult_bp.route("/<int:consult_id>/update", methods=["PUT"])
-@jwt_required()
+@claims_required("doctor")
 def update_consultation(consult_id):
     data = request.get_json() or {}
-    doctor_id = get_jwt_identity()
+    doctor_id = current_user_id()
 
     status = data.get("status")
     if status not in ["accepted", "rejected"]:
@@ -102,9 +124,16 @@ def update_consultation(consult_id):
     if consultation.doctor_id != doctor_id:
         return jsonify({"error": "Not authorized"}), 403
 
+    changed = consultation.status != status
     consultation.status = status
     db.session.commit()
 
+    if changed:
+        doctor = user_profiles.get(doctor_id)
+        publish("consultation.updated", [consultation.parent_id],
+                consultation_id=consultation.id, baby_id=consultation.baby_id, status=status,
+                doctor_id=doctor_id, doctor_name=doctor["full_name"] if doctor else None)
+
     return jsonify({"message": f"Consultation {status} successfully!"}), 200
 
 
@@ -112,48 +141,57 @@ def update_consultation(consult_id):
 # 4️⃣ Parent Views All Their Consultation Requests
 # ---------------------------------------------------------
 @consult_bp.route("/parent", methods=["GET"])
-@jwt_required()
+@claims_required()
 def parent_consultations():
-    parent_id = get_jwt_identity()
+    parent_id = current_user_id()
 
     requests = Consultation.query.filter_by(parent_id=parent_id).order_by(
-        Consultation.requested_at.desc()
+        Consultation.created_at.desc()
     ).all()
+    doctors = user_profiles.get_many(req.doctor_id for req in requests)
 
     output = []
     for req in requests:
-        doctor = User.query.get(req.doctor_id)
+        doctor = doctors.get(req.doctor_id)
 
         output.append({
             "consultation_id": req.id,
-            "doctor_name": doctor.full_name,
+            "doctor_name": doctor["full_name"] if doctor else None,
             "status": req.status,
-            "requested_at": req.requested_at.strftime("%Y-%m-%d %H:%M"),
-            "record_id": req.record_id
+            "requested_at": req.created_at.strftime("%Y-%m-%d %H:%M") if req.created_at else None,
+            "baby_id": req.baby_id
         })
 
     return jsonify(output), 200
 
 
+def _accepted_consultation(doctor_id, record):
+    """The doctor's accepted consultation covering `record`: one about this very record, or a
+    baby-level booking made after it. Records made after a consultation are not part of it."""
+    return Consultation.query.filter(
+        Consultation.doctor_id == doctor_id,
+        Consultation.baby_id == record.baby_id,
+        Consultation.status == "accepted",
+        or_(Consultation.record_id == record.id,
+            and_(Consultation.record_id.is_(None), Consultation.created_at >= record.created_at)),
+    ).first()
+
+
 # ---------------------------------------------------------
 # 5️⃣ Doctor Gets Full Baby Record After Accepting
 # ---------------------------------------------------------
 @consult_bp.route("/details/<int:record_id>", methods=["GET"])
-@jwt_required()
+@claims_required("doctor")
 def consultation_details(record_id):
-    doctor_id = get_jwt_identity()
+    doctor_id = current_user_id()
 
-    # Verify doctor has access
-    consultation = Consultation.query.filter_by(
-        record_id=record_id,
-        doctor_id=doctor_id,
-        status="accepted"
-    ).first()
+    record = SkinRecord.query.get(record_id)
+    if not record:
+        return jsonify({"error": "Access denied"}), 403
 
-    if not consultation:
+    if not _accepted_consultation(doctor_id, record):
         return jsonify({"error": "Access denied"}), 403
 
-    record = SkinRecord.query.get(record_id)
     baby = Baby.query.get(record.baby_id)
 
     return jsonify({
@@ -161,5 +199,49 @@ def consultation_details(record_id):
         "rash_type": record.predicted_rash_type,
         "confidence": record.confidence_score,
         "image_url": record.image_path,
+        "thumb_url": thumb_url(record.image_path),
         "created_at": record.created_at.strftime("%Y-%m-%d %H:%M")
     }), 200
+
+
+# ---------------------------------------------------------
+# 6️⃣ Doctor Sees Visually Similar Past Cases
+# ---------------------------------------------------------
+@consult_bp.route("/similar/<int:record_id>", methods=["GET"])
+@claims_required("doctor")
+def similar_records(record_id):
+    doctor_id = current_user_id()
+
+    record = SkinRecord.query.get(record_id)
+    if not record:
+        return jsonify({"error": "Skin record not found"}), 404
+
+    # same access rule as the case itself
+    if not _accepted_consultation(doctor_id, record):
+        return jsonify({"error": "Access denied"}), 403
+
+    k = min(max(request.args.get("k", 10, type=int), 1), 50)
+    # embeddings only compare within a model version; fall back to the serving one (backfilled)
+    version = record.model_version
+    if not version or not similar.has(version, record_id):
+        active = registry.peek()
+        version = active.version if active else registry.current_version()
+    hits = similar.search(version, record_id, k)
+    if hits is None:
+        return jsonify({"error": "No embedding for this record yet"}), 404
+
+    records = {r.id: r for r in SkinRecord.query.filter(SkinRecord.id.in_([rid for rid, _ in hits])).all()}
+    thumbs = thumb_urls(r.image_path for r in records.values())
+    return jsonify({
+        "record_id": record_id,
+        "model_version": version,
+        "similar": [{
+            "record_id": rid,
+            "similarity": score,
+            "rash_type": records[rid].predicted_rash_type,
+            "confidence": records[rid].confidence_score,
+            "image_url": records[rid].image_path,
+            "thumb_url": thumbs.get(records[rid].image_path),
+            "created_at": records[rid].created_at.strftime("%Y-%m-%d %H:%M") if records[rid].created_at else None
+        } for rid, score in hits if rid in records]
+    }), 200
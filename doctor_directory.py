@@ -0,0 +1,198 @@
+"""In-memory doctor directory: precomputed listing, ETag, prefix search.
+
+The listing is serialised once per snapshot version; GET /api/parent/doctors
+serves those bytes (or a 304 when the client's ETag still matches) instead of
+querying every doctor on each page load. Search goes through an inverted index
+from every prefix of every name / specialization token to doctor ids, so
+"?q=der ped" is a couple of set intersections.
+
+Changes are applied per doctor: User inserts/updates/deletes mark the id dirty
+once their transaction commits (doctor_routes.update_profile refreshes it
+straight away) and the next read re-fetches only those rows.
+DOCTOR_DIRECTORY_TTL bounds how long another worker's edits can go unseen
+before a full reload.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+
+from sqlalchemy.orm import object_session
+
+from metrics import metrics
+
+DOCTOR_DIRECTORY_TTL = float(os.getenv("DOCTOR_DIRECTORY_TTL", "300"))
+LISTING_FIELDS = ("id", "full_name", "specialization")
+PROFILE_FIELDS = ("id", "full_name", "specialization", "bio", "experience")
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokens(text):
+    return _TOKEN.findall((text or "").lower())
+
+
+class DoctorDirectory:
+    def __init__(self, ttl=DOCTOR_DIRECTORY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._doctors = None         # id -> profile dict
+        self._prefixes = {}          # prefix -> set(ids)
+        self._order = []             # ids in listing order
+        self._dirty = set()
+        self._loaded_at = 0.0
+        self.version = 0
+        self.etag = None
+        self.payload = None          # serialised {"doctors": [...]} for the current version
+
+    # ------------------ LOADING ------------------
+    @staticmethod
+    def _fetch(ids=None):
+        from models import User
+        q = User.query.with_entities(*[getattr(User, f) for f in PROFILE_FIELDS]).filter(User.role == "doctor")
+        if ids is not None:
+            q = q.filter(User.id.in_(ids))
+        return {r.id: dict(zip(PROFILE_FIELDS, r)) for r in q.all()}
+
+    def _index(self, doc, add=True):
+        for tok in set(tokens(doc["full_name"]) + tokens(doc["specialization"])):
+            for i in range(1, len(tok) + 1):
+                ids = self._prefixes.get(tok[:i])
+                if add:
+                    if ids is None:
+                        ids = self._prefixes[tok[:i]] = set()
+                    ids.add(doc["id"])
+                elif ids is not None:
+                    ids.discard(doc["id"])
+                    if not ids:
+                        del self._prefixes[tok[:i]]
+
+    def _publish(self):
+        ordered = sorted(self._doctors.values(), key=lambda d: ((d["full_name"] or "").lower(), d["id"]))
+        self._order = [d["id"] for d in ordered]
+        body = json.dumps({"doctors": [{f: d[f] for f in LISTING_FIELDS} for d in ordered]},
+                          separators=(",", ":")).encode("utf-8")
+        self.payload = body
+        # content hash, so every worker hands out the same ETag for the same listing
+        self.etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.version += 1
+
+    def _ensure(self):
+        """Bring the snapshot up to date; returns True when it was already current."""
+        stale = self._doctors is None or time.monotonic() - self._loaded_at > self.ttl
+        if not stale and not self._dirty:
+            return True
+        with self._lock:
+            if self._doctors is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._doctors = self._fetch()
+                self._prefixes = {}
+                for doc in self._doctors.values():
+                    self._index(doc)
+                self._dirty.clear()
+                self._loaded_at = time.monotonic()
+                self._publish()
+            elif self._dirty:
+                ids, self._dirty = self._dirty, set()
+                self._apply(ids, self._fetch(ids))
+        return False
+
+    def _apply(self, ids, rows):
+        changed = False
+        for uid in ids:
+            old, new = self._doctors.get(uid), rows.get(uid)
+            if old == new:
+                continue
+            if old is not None:
+                self._index(old, add=False)
+                del self._doctors[uid]
+            if new is not None:
+                self._doctors[uid] = new
+                self._index(new)
+            changed = True
+        if changed:
+            self._publish()
+
+    # ------------------ WRITES ------------------
+    def mark_dirty(self, user_id):
+        with self._lock:
+            self._dirty.add(int(user_id))
+
+    def refresh(self, user_id):
+        """Re-read one doctor now (after a profile update) instead of waiting for the next read."""
+        user_id = int(user_id)
+        rows = self._fetch([user_id])
+        with self._lock:
+            self._dirty.discard(user_id)
+            if self._doctors is not None:
+                self._apply([user_id], rows)
+
+    # ------------------ READS ------------------
+    def listing(self):
+        """(serialised listing, etag)."""
+        metrics.cache("doctor_directory", self._ensure())
+        with self._lock:
+            return self.payload, self.etag
+
+    def get(self, doctor_id):
+        metrics.cache("doctor_directory", self._ensure())
+        with self._lock:
+            return self._doctors.get(int(doctor_id))
+
+    def search(self, query, limit=50):
+        """Doctors whose name/specialization has a token starting with every query token, in listing order."""
+        metrics.cache("doctor_directory", self._ensure())
+        terms = tokens(query)
+        with self._lock:
+            if not terms:
+                ids = None
+            else:
+                sets = sorted((self._prefixes.get(t, set()) for t in terms), key=len)
+                ids = set(sets[0]).intersection(*sets[1:])
+            out = []
+            for uid in self._order:
+                if ids is None or uid in ids:
+                    d = self._doctors[uid]
+                    out.append({f: d[f] for f in LISTING_FIELDS})
+                    if len(out) >= limit:
+                        break
+            return out
+
+
+directory = DoctorDirectory()
+
+
+_PENDING = "doctor_directory_dirty"
+
+
+def _mark_doctor_dirty(mapper, connection, target):
+    # flush time: the change may still roll back, so park the id on the session until it commits
+    session = object_session(target)
+    if target.id is None:
+        return
+    if session is None:
+        directory.mark_dirty(target.id)
+    else:
+        session.info.setdefault(_PENDING, set()).add(target.id)
+
+def _publish_dirty(session):
+    for user_id in session.info.pop(_PENDING, ()):
+        directory.mark_dirty(user_id)
+
+def _drop_dirty(session):
+    session.info.pop(_PENDING, None)
+
+def _install_hooks():
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+    from models import User
+
+    for name in ("after_insert", "after_update", "after_delete"):
+        if not event.contains(User, name, _mark_doctor_dirty):
+            event.listen(User, name, _mark_doctor_dirty)
+    for name, fn in (("after_commit", _publish_dirty), ("after_rollback", _drop_dirty)):
+        if not event.contains(Session, name, fn):
+            event.listen(Session, name, fn)
+
+_install_hooks()
@@ -1,7 +1,8 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
 from extensions import db
 from models import User
+from utils.role_required import claims_required, current_user_id, user_profiles
+from doctor_directory import directory
 
 doctor_bp = Blueprint("doctor_bp", __name__, url_prefix="/api/doctor")
 
@@ -10,22 +11,20 @@ doctor_bp = Blueprint("doctor_bp", __name__, url_prefix="/api/doctor")
 # GET Doctor Profile
 # ---------------------------------------------------------
 @doctor_bp.route("/profile", methods=["GET"])
-@jwt_required()
+@claims_required("doctor")
 def get_profile():
-    user_id = get_jwt_identity()
-    doctor = User.query.filter_by(id=user_id, role="doctor").first()
+    doctor = user_profiles.get(current_user_id())
 
     if not doctor:
         return jsonify({"error": "Doctor not found"}), 404
 
     return jsonify({
-        "id": doctor.id,
-        "full_name": doctor.full_name,
-        "email": doctor.email,
-        "phone": doctor.phone,
-        "profile_pic": doctor.profile_pic,
-        "specialization": doctor.role,  
-        "created_at": doctor.created_at.strftime("%Y-%m-%d"),
+        "id": doctor["id"],
+        "full_name": doctor["full_name"],
+        "email": doctor["email"],
+        "specialization": doctor["specialization"],
+        "experience": doctor["experience"],
+        "bio": doctor["bio"],
     }), 200
 
 
@@ -33,20 +32,25 @@ def get_profile():
 # UPDATE Doctor Profile
 # ---------------------------------------------------------
 @doctor_bp.route("/profile", methods=["PUT"])
-@jwt_required()
+@claims_required("doctor")
 def update_profile():
-    user_id = get_jwt_identity()
-    doctor = User.query.filter_by(id=user_id, role="doctor").first()
+    user_id = current_user_id()
+    doctor = User.query.get(user_id)
 
     if not doctor:
         return jsonify({"error": "Doctor not found"}), 404
 
-    data = request.get_json()
+    data = request.get_json() or {}
 
     doctor.full_name = data.get("full_name", doctor.full_name)
-    doctor.phone = data.get("phone", doctor.phone)
     doctor.email = data.get("email", doctor.email)
+    doctor.specialization = data.get("specialization", doctor.specialization)
+    doctor.experience = data.get("experience", doctor.experience)
+    doctor.bio = data.get("bio", doctor.bio)
 
     db.session.commit()
+    # the after_update hook already dropped it; be explicit for updates that changed nothing
+    user_profiles.invalidate(user_id)
+    directory.refresh(user_id)
 
     return jsonify({"message": "Profile updated successfully!"}), 200
@@ -0,0 +1,401 @@
+"""Similar-case retrieval over pooled backbone embeddings.
+Run: python embedding_index.py backfill [--batch 64]   # embed existing records with the active model
+     python embedding_index.py build                   # (re)train the IVF index and save it
+
+Embeddings only compare within one model version, so each version has its own
+directory under instance/embeddings/<version>/:
+    vectors.f16    memory-mapped float16 matrix, row = SkinRecord.id, L2-normalised
+    present.u8     1 where a row holds a vector
+    meta.json      {"dim": D}
+    ivf.npz        trained index (centroids, ids grouped by list)
+
+The index is an inverted file (IVF): spherical k-means splits the vectors into
+~sqrt(N) lists and a query only scores the ids in the SIMILAR_NPROBE lists whose
+centroids are closest. Rows written by any worker are picked up on the next
+query (present.u8 is compared with an in-memory bitmap of the ids already indexed,
+so ids embedded out of order are not missed); the index retrains in the
+background once the collection has doubled. Below IVF_MIN_VECTORS it is a plain
+exact scan.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+EMBED_DIR = os.getenv("EMBEDDING_DIR", os.path.join(ROOT, "instance", "embeddings"))
+SIMILAR_NPROBE = int(os.getenv("SIMILAR_NPROBE", "8"))
+IVF_MIN_VECTORS = int(os.getenv("IVF_MIN_VECTORS", "5000"))
+_GROW_ROWS = 4096
+
+
+def _normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    n = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(n, 1e-12)
+
+
+# -------------------------------------------------------------
+# STORAGE
+# -------------------------------------------------------------
+class EmbeddingStore:
+    """float16 vectors in a memmap addressed directly by record id."""
+
+    def __init__(self, path, dim=None):
+        self.path = path
+        self.dim = dim
+        meta = os.path.join(path, "meta.json")
+        if os.path.exists(meta):
+            with open(meta, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        self._vectors = None
+        self._present = None
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    def _files(self):
+        return os.path.join(self.path, "vectors.f16"), os.path.join(self.path, "present.u8")
+
+    def _map(self, min_rows=0):
+        """(Re)map the files when they are missing, too small, or were grown by another process."""
+        vec_path, present_path = self._files()
+        on_disk = os.path.getsize(present_path) if os.path.exists(present_path) else 0
+        if self._present is not None and on_disk == self._rows and min_rows <= self._rows:
+            return
+        rows = max(on_disk, self._rows)
+        if min_rows > rows:
+            rows = max(min_rows, rows * 2, _GROW_ROWS)
+            os.makedirs(self.path, exist_ok=True)
+            for p, width in ((vec_path, self.dim * 2), (present_path, 1)):
+                with open(p, "ab") as f:
+                    # only ever grow: a concurrent grower may already have gone further
+                    if os.fstat(f.fileno()).st_size < rows * width:
+                        f.truncate(rows * width)
+            rows = os.path.getsize(present_path)
+        if rows == 0:
+            return
+        self._vectors = np.memmap(vec_path, dtype=np.float16, mode="r+", shape=(rows, self.dim))
+        self._present = np.memmap(present_path, dtype=np.uint8, mode="r+", shape=(rows,))
+        self._rows = rows
+
+    def put(self, record_id, vec):
+        vec = _normalize(np.ravel(vec))
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vec.shape[0])
+                os.makedirs(self.path, exist_ok=True)
+                with open(os.path.join(self.path, "meta.json"), "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+            self._map(record_id + 1)
+            self._vectors[record_id] = vec
+            self._present[record_id] = 1
+
+    def flush(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._present.flush()
+
+    def has(self, record_id):
+        with self._lock:
+            if self.dim is None:
+                return False
+            self._map()
+            return record_id < self._rows and bool(self._present[record_id])
+
+    def rows(self, ids):
+        """float32 (len(ids), D) for ids known to be present."""
+        with self._lock:
+            self._map()
+            return np.asarray(self._vectors[np.asarray(ids, dtype=np.int64)], dtype=np.float32)
+
+    def unindexed(self, indexed):
+        """Record ids with a vector whose flag in `indexed` (a bool array, possibly shorter) is not set."""
+        with self._lock:
+            if self.dim is None:
+                return np.empty(0, dtype=np.int64)
+            self._map()
+            if self._present is None:
+                return np.empty(0, dtype=np.int64)
+            todo = np.asarray(self._present, dtype=bool)
+        n = min(len(indexed), len(todo))
+        todo[:n] &= ~indexed[:n]
+        return np.flatnonzero(todo).astype(np.int64)
+
+    def ids(self, start=0):
+        """Record ids with a vector, >= start."""
+        with self._lock:
+            if self.dim is None:
+                return np.empty(0, dtype=np.int64)
+            self._map()
+            if self._present is None or start >= self._rows:
+                return np.empty(0, dtype=np.int64)
+            return np.flatnonzero(self._present[start:]).astype(np.int64) + start
+
+
+# -------------------------------------------------------------
+# IVF INDEX
+# -------------------------------------------------------------
+def spherical_kmeans(x, k, iters=10, seed=0):
+    """Centroids (k, D), unit length, for unit-length rows of x."""
+    rng = np.random.default_rng(seed)
+    c = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ c.T, axis=1)
+        sums = np.zeros_like(c)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        if empty.any():
+            # re-seed empty lists with random points so every list stays in use
+            sums[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+        c = _normalize(sums)
+    return c
+
+
+class IVFIndex:
+    def __init__(self, centroids, lists, trained_on):
+        self.centroids = centroids      # (nlist, D) float32
+        self.lists = lists              # list of int64 arrays of record ids
+        self.trained_on = trained_on
+        self.size = sum(len(l) for l in lists)
+
+    @classmethod
+    def train(cls, store, ids, iters=10, sample_per_list=64, chunk=65536):
+        nlist = max(1, int(np.sqrt(len(ids))))
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(ids, size=min(len(ids), nlist * sample_per_list), replace=False))
+        centroids = spherical_kmeans(store.rows(sample), nlist, iters)
+        assign = np.empty(len(ids), dtype=np.int64)
+        for i in range(0, len(ids), chunk):
+            assign[i:i + chunk] = np.argmax(store.rows(ids[i:i + chunk]) @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+        lists = [ids[order[bounds[j]:bounds[j + 1]]] for j in range(nlist)]
+        return cls(centroids, lists, len(ids))
+
+    def add(self, ids, vecs):
+        assign = np.argmax(vecs @ self.centroids.T, axis=1)
+        for j in np.unique(assign):
+            self.lists[j] = np.concatenate([self.lists[j], ids[assign == j]])
+        self.size += len(ids)
+
+    def candidates(self, q, nprobe):
+        scores = self.centroids @ q
+        nprobe = min(nprobe, len(scores))
+        probe = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self.lists[j] for j in probe])
+
+    def save(self, path):
+        lengths = np.array([len(l) for l in self.lists], dtype=np.int64)
+        flat = np.concatenate(self.lists) if self.lists else np.empty(0, dtype=np.int64)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, centroids=self.centroids, ids=flat, lengths=lengths, trained_on=self.trained_on)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            bounds = np.concatenate([[0], np.cumsum(z["lengths"])])
+            ids = z["ids"]
+            lists = [ids[bounds[j]:bounds[j + 1]] for j in range(len(z["lengths"]))]
+            return cls(z["centroids"], lists, int(z["trained_on"]))
+
+
+# -------------------------------------------------------------
+# SERVICE
+# -------------------------------------------------------------
+class _Collection:
+    def __init__(self, path):
+        self.store = EmbeddingStore(path)
+        self.index = None
+        self.exact_ids = np.empty(0, dtype=np.int64)
+        self.indexed = np.zeros(0, dtype=bool)   # True where an id is already in index / exact_ids
+        self.rebuilding = False
+        index_path = os.path.join(path, "ivf.npz")
+        if os.path.exists(index_path):
+            try:
+                self.index = IVFIndex.load(index_path)
+                for l in self.index.lists:
+                    self.mark(l)
+            except Exception:
+                logger.warning("Ignoring unreadable index %s", index_path, exc_info=True)
+
+    def mark(self, ids):
+        if not len(ids):
+            return
+        need = int(ids.max()) + 1
+        if need > len(self.indexed):
+            grown = np.zeros(max(need, 2 * len(self.indexed), _GROW_ROWS), dtype=bool)
+            grown[:len(self.indexed)] = self.indexed
+            self.indexed = grown
+        self.indexed[ids] = True
+
+    def is_indexed(self, ids):
+        inside = ids < len(self.indexed)
+        out = np.zeros(len(ids), dtype=bool)
+        out[inside] = self.indexed[ids[inside]]
+        return out
+
+
+class SimilarityIndex:
+    def __init__(self, root=EMBED_DIR, nprobe=SIMILAR_NPROBE, min_ivf=IVF_MIN_VECTORS):
+        self.root = root
+        self.nprobe = nprobe
+        self.min_ivf = min_ivf
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def collection(self, version):
+        with self._lock:
+            col = self._collections.get(version)
+            if col is None:
+                col = self._collections[version] = _Collection(os.path.join(self.root, version))
+            return col
+
+    def put(self, version, record_id, vec):
+        self.collection(version).store.put(int(record_id), vec)
+
+    def has(self, version, record_id):
+        return self.collection(version).store.has(int(record_id))
+
+    def build(self, version):
+        """Train the IVF index over everything stored for `version` and save it."""
+        col = self.collection(version)
+        ids = col.store.ids()
+        if len(ids) == 0:
+            return None
+        started = time.perf_counter()
+        index = IVFIndex.train(col.store, ids)
+        index.save(os.path.join(col.store.path, "ivf.npz"))
+        with self._lock:
+            col.index = index
+            col.exact_ids = np.empty(0, dtype=np.int64)
+            # ids added to the old index while this one trained are picked up by the next catch-up
+            col.indexed = np.zeros(0, dtype=bool)
+            col.mark(ids)
+        logger.info("Built IVF index for %s: %d vectors, %d lists in %.1fs",
+                    version, len(ids), len(index.lists), time.perf_counter() - started)
+        return index
+
+    def _rebuild_async(self, version, col):
+        def _run():
+            try:
+                self.build(version)
+            except Exception:
+                logger.exception("Rebuilding similarity index for %s failed", version)
+            finally:
+                col.rebuilding = False
+        col.rebuilding = True
+        threading.Thread(target=_run, name=f"ivf-build-{version}", daemon=True).start()
+
+    def _catch_up(self, version, col):
+        new = col.store.unindexed(col.indexed)
+        with self._lock:
+            # a concurrent catch-up may have added some of them meanwhile
+            new = new[~col.is_indexed(new)]
+            if len(new):
+                if col.index is not None:
+                    col.index.add(new, col.store.rows(new))
+                else:
+                    col.exact_ids = np.concatenate([col.exact_ids, new])
+                col.mark(new)
+            total = col.index.size if col.index is not None else len(col.exact_ids)
+            if col.index is None:
+                stale = total >= self.min_ivf
+            else:
+                stale = total >= 2 * col.index.trained_on
+        if stale and not col.rebuilding:
+            self._rebuild_async(version, col)
+
+    def search(self, version, record_id, k=10):
+        """[(record_id, cosine similarity)] of the k nearest other records, best first; None if not embedded."""
+        col = self.collection(version)
+        if not col.store.has(record_id):
+            return None
+        self._catch_up(version, col)
+        q = col.store.rows([record_id])[0]
+        with self._lock:
+            cand = col.index.candidates(q, self.nprobe) if col.index is not None else col.exact_ids
+        cand = cand[cand != record_id]
+        if len(cand) == 0:
+            return []
+        scores = col.store.rows(cand) @ q
+        k = min(k, len(cand))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(cand[i]), round(float(scores[i]), 4)) for i in top]
+
+
+similar = SimilarityIndex()
+
+
+# -------------------------------------------------------------
+# CLI
+# -------------------------------------------------------------
+def backfill(batch):
+    """Embed every record the active model has not embedded yet, `batch` images per forward pass."""
+    from app import create_app
+    from models import SkinRecord
+    from model_registry import registry
+    from inference_utils import _open_image, to_input, forward_embed
+    from retention import open_upload
+
+    app = create_app()
+    with app.app_context():
+        lm = registry.active()
+        if lm.embedder is None:
+            raise SystemExit(f"Model {lm.version} has no pooling layer to embed with")
+        col = similar.collection(lm.version)
+        rows = SkinRecord.query.with_entities(SkinRecord.id, SkinRecord.image_path) \
+            .filter(SkinRecord.image_path.isnot(None)).order_by(SkinRecord.id).all()
+        rows = [(rid, p) for rid, p in rows if not col.store.has(rid)]
+        started = time.perf_counter()
+        done = 0
+        for i in range(0, len(rows), batch):
+            ids, inputs = [], []
+            for rid, p in rows[i:i + batch]:
+                try:
+                    with open_upload(app.uploads_path, p) as fh:
+                        inputs.append(to_input(_open_image(fh), lm.input_size))
+                    ids.append(rid)
+                except Exception:
+                    logger.warning("Skipping record %s (%s): unreadable", rid, p)
+            if not ids:
+                continue
+            _, emb = forward_embed(lm, np.concatenate(inputs, axis=0))
+            for rid, vec in zip(ids, emb):
+                col.store.put(rid, vec)
+            done += len(ids)
+            print(f"  {i + batch if i + batch < len(rows) else len(rows)}/{len(rows)} records", flush=True)
+        col.store.flush()
+        print(f"Embedded {done} records for {lm.version} in {time.perf_counter() - started:.1f}s")
+        return lm.version
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Similar-case embedding index")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("backfill", help="embed existing records with the active model, then build")
+    b.add_argument("--batch", type=int, default=64)
+    p = sub.add_parser("build", help="train and save the IVF index")
+    p.add_argument("--version", help="model version (default: current)")
+    args = ap.parse_args()
+
+    if args.cmd == "backfill":
+        version = backfill(args.batch)
+    else:
+        from model_registry import registry
+        version = args.version or registry.current_version()
+    index = similar.build(version)
+    print(f"Index for {version}: " + (f"{index.size} vectors in {len(index.lists)} lists" if index else "empty"))
+
+
+if __name__ == "__main__":
+    main()
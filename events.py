@@ -0,0 +1,250 @@
+"""In-process event bus for consultation and chat notifications.
+
+Routes publish typed events after their commit; subscribers run on a dispatcher
+thread so a slow webhook or mail enqueue never delays the response:
+    consultation.requested   -> doctor     (request_consultation, book_consultation)
+    consultation.updated     -> parent     (update_consultation: accepted / rejected)
+    message.sent             -> other side of the conversation (send_message)
+
+Built-in subscribers:
+    stream   per-user fan-out to open SSE connections (/api/events/stream) plus a
+             short replay buffer so reconnects with Last-Event-ID miss nothing
+    email    a digest line through mail_queue for each recipient (EVENT_EMAIL=0 disables)
+    webhook  JSON POST to every URL in EVENT_WEBHOOK_URLS, HMAC-signed when
+             EVENT_WEBHOOK_SECRET is set
+
+Events only reach streams held by the same process; with several workers a
+client may need to fall back to the list endpoints after reconnecting to another one.
+"""
+import os
+import hmac
+import json
+import time
+import queue
+import hashlib
+import logging
+import threading
+import itertools
+import urllib.request
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = ("consultation.requested", "consultation.updated", "message.sent")
+REPLAY_PER_USER = int(os.getenv("EVENT_REPLAY_PER_USER", "50"))
+SEND_EMAIL = os.getenv("EVENT_EMAIL", "1") not in ("0", "false", "False")
+WEBHOOK_URLS = [u.strip() for u in os.getenv("EVENT_WEBHOOK_URLS", "").split(",") if u.strip()]
+WEBHOOK_SECRET = os.getenv("EVENT_WEBHOOK_SECRET", "")
+WEBHOOK_TIMEOUT = float(os.getenv("EVENT_WEBHOOK_TIMEOUT", "5"))
+WEBHOOK_RETRIES = 3
+
+
+class Event:
+    __slots__ = ("id", "type", "recipients", "data", "ts")
+
+    def __init__(self, id, type, recipients, data):
+        self.id = id
+        self.type = type
+        self.recipients = recipients
+        self.data = data
+        self.ts = time.time()
+
+    def to_dict(self):
+        return {"id": self.id, "type": self.type, "ts": round(self.ts, 3), "data": self.data}
+
+
+# -------------------------------------------------------------
+# BUS
+# -------------------------------------------------------------
+class EventBus:
+    def __init__(self):
+        self._subscribers = {}        # event type or "*" -> [handler]
+        self._queue = queue.Queue(maxsize=10000)
+        # time-seeded so ids keep increasing across restarts and a reconnecting client's
+        # Last-Event-ID stays meaningful; microseconds keep them exact as JavaScript numbers
+        self._ids = itertools.count(time.time_ns() // 1000)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.app = None               # handlers run inside its app context (set by init_events)
+
+    def subscribe(self, event_type, handler):
+        """Call handler(event) for every event of `event_type` ("*" for all)."""
+        if event_type != "*" and event_type not in EVENT_TYPES:
+            raise ValueError(f"Unknown event type: {event_type}")
+        with self._lock:
+            handlers = self._subscribers.setdefault(event_type, [])
+            if handler not in handlers:
+                handlers.append(handler)
+
+    def publish(self, event_type, recipients, **data):
+        """Queue an event for delivery to `recipients` (user ids); returns it.
+
+        Delivery happens on the bus thread, so subscriber failures never reach the caller.
+        """
+        if event_type not in EVENT_TYPES:
+            raise ValueError(f"Unknown event type: {event_type}")
+        from metrics import metrics
+
+        event = Event(next(self._ids), event_type, [int(r) for r in recipients if str(r).isdigit()], data)
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(event)
+            metrics.events.inc(event_type, "queued")
+        except queue.Full:
+            metrics.events.inc(event_type, "dropped")
+            logger.warning("Event queue full; dropping %s", event_type)
+        return event
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="event-bus", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        from metrics import metrics
+        while True:
+            event = self._queue.get()
+            with self._lock:
+                handlers = self._subscribers.get(event.type, []) + self._subscribers.get("*", [])
+            try:
+                with self.app.app_context():
+                    for handler in handlers:
+                        try:
+                            handler(event)
+                        except Exception:
+                            metrics.events.inc(event.type, "handler_error")
+                            logger.exception("Event handler %s failed for %s",
+                                             getattr(handler, "__name__", handler), event.type)
+            finally:
+                self._queue.task_done()
+
+    def drain(self, timeout=5.0):
+        """Wait until queued events are handled (scripts and tests)."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+# -------------------------------------------------------------
+# SSE FAN-OUT
+# -------------------------------------------------------------
+class StreamHub:
+    """Open SSE connections per user, plus the last few events each user was sent."""
+
+    def __init__(self, replay=REPLAY_PER_USER):
+        self.replay = replay
+        self._lock = threading.Lock()
+        self._listeners = {}   # user_id -> set(queue.Queue)
+        self._recent = {}      # user_id -> deque(Event)
+
+    def __call__(self, event):
+        with self._lock:
+            for uid in event.recipients:
+                recent = self._recent.get(uid)
+                if recent is None:
+                    recent = self._recent[uid] = deque(maxlen=self.replay)
+                recent.append(event)
+                for q in self._listeners.get(uid, ()):
+                    try:
+                        q.put_nowait(event)
+                    except queue.Full:
+                        pass   # a stuck client; it catches up from the replay buffer on reconnect
+
+    def connect(self, user_id, last_event_id=None):
+        """Register a listener; returns (queue, events after last_event_id still in the buffer)."""
+        q = queue.Queue(maxsize=200)
+        with self._lock:
+            self._listeners.setdefault(user_id, set()).add(q)
+            backlog = self._after(user_id, last_event_id) if last_event_id is not None else []
+        return q, backlog
+
+    def disconnect(self, user_id, q):
+        with self._lock:
+            listeners = self._listeners.get(user_id)
+            if listeners is not None:
+                listeners.discard(q)
+                if not listeners:
+                    del self._listeners[user_id]
+
+    def since(self, user_id, last_event_id=0):
+        with self._lock:
+            return self._after(user_id, last_event_id)
+
+    def _after(self, user_id, last_event_id):
+        recent = self._recent.get(user_id, ())
+        if recent and last_event_id > recent[-1].id:
+            # an id from another process's sequence (other worker, clock step back): it says
+            # nothing about what this buffer holds, so replay all of it rather than none
+            return list(recent)
+        return [e for e in recent if e.id > last_event_id]
+
+    def connections(self):
+        with self._lock:
+            return sum(len(v) for v in self._listeners.values())
+
+
+# -------------------------------------------------------------
+# EMAIL / WEBHOOK SUBSCRIBERS
+# -------------------------------------------------------------
+def _describe(event):
+    d = event.data
+    if event.type == "consultation.updated":
+        who = f"Dr. {d['doctor_name']}" if d.get("doctor_name") else "Your doctor"
+        return f"Consultation {d.get('status')}", f"{who} has {d.get('status')} your consultation request."
+    if event.type == "consultation.requested":
+        return ("New consultation request",
+                f"{d.get('parent_name') or 'A parent'} requested a consultation"
+                + (f" for {d['date']} {d.get('time') or ''}".rstrip() if d.get("date") else "") + ".")
+    return ("New message", f"{d.get('sender_name') or 'Someone'}: {(d.get('text') or '')[:200]}")
+
+
+def email_subscriber(event):
+    from mail_queue import enqueue_digest
+    from utils.role_required import user_profiles
+
+    subject, body = _describe(event)
+    for uid, profile in user_profiles.get_many(event.recipients).items():
+        if profile.get("email"):
+            enqueue_digest(profile["email"], subject, body)
+
+
+def webhook_subscriber(event):
+    body = json.dumps({**event.to_dict(), "recipients": event.recipients}, separators=(",", ":")).encode("utf-8")
+    headers = {"Content-Type": "application/json", "X-Event-Type": event.type, "X-Event-Id": str(event.id)}
+    if WEBHOOK_SECRET:
+        headers["X-Signature"] = "sha256=" + hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    for url in WEBHOOK_URLS:
+        for attempt in range(WEBHOOK_RETRIES):
+            try:
+                req = urllib.request.Request(url, data=body, headers=headers, method="POST")
+                with urllib.request.urlopen(req, timeout=WEBHOOK_TIMEOUT) as resp:
+                    if resp.status < 300:
+                        break
+            except Exception as e:
+                if attempt == WEBHOOK_RETRIES - 1:
+                    logger.warning("Webhook %s failed for event %s: %s", url, event.id, e)
+                else:
+                    time.sleep(0.5 * 2 ** attempt)
+
+
+bus = EventBus()
+streams = StreamHub()
+
+
+def publish(event_type, recipients, **data):
+    return bus.publish(event_type, recipients, **data)
+
+
+def init_events(app):
+    from metrics import metrics
+
+    bus.app = app
+    bus.subscribe("*", streams)
+    if SEND_EMAIL:
+        bus.subscribe("*", email_subscriber)
+    if WEBHOOK_URLS:
+        bus.subscribe("*", webhook_subscriber)
+    if not any(m.name == "event_stream_connections" for m in metrics._metrics):
+        metrics.gauge("event_stream_connections", "Open SSE event streams", streams.connections)
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import queue
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from flask_jwt_extended import decode_token
+from utils.role_required import claims_required, current_user_id
+from events import streams
+
+events_bp = Blueprint("events_bp", __name__, url_prefix="/api/events")
+
+HEARTBEAT_SECONDS = 15
+# a stream holds a worker; end it periodically and let EventSource reconnect with Last-Event-ID
+STREAM_MAX_SECONDS = float(os.getenv("EVENT_STREAM_MAX_SECONDS", "300"))
+
+
+def _sse(event):
+    return f"id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.to_dict(), separators=(',', ':'))}\n\n"
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# ---------------------------------------------------------
+# SSE stream of the caller's events
+# ---------------------------------------------------------
+@events_bp.route("/stream", methods=["GET"])
+def stream():
+    # EventSource cannot set headers, so the token may also come as ?token=
+    token = request.args.get("token")
+    auth = request.headers.get("Authorization", "")
+    if not token and auth.startswith("Bearer "):
+        token = auth[7:]
+    try:
+        user_id = int(decode_token(token)["sub"])
+    except Exception:
+        return jsonify({"error": "Invalid or missing token"}), 401
+
+    last_id = _int_or_none(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+    q, backlog = streams.connect(user_id, last_id)
+
+    def generate():
+        try:
+            yield "retry: 3000\n: connected\n\n"
+            for event in backlog:
+                yield _sse(event)
+            deadline = time.monotonic() + STREAM_MAX_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    yield _sse(q.get(timeout=HEARTBEAT_SECONDS))
+                except queue.Empty:
+                    yield ": ping\n\n"
+        finally:
+            streams.disconnect(user_id, q)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ---------------------------------------------------------
+# Recent events (polling fallback)
+# ---------------------------------------------------------
+@events_bp.route("", methods=["GET"])
+@claims_required()
+def recent():
+    since = _int_or_none(request.args.get("since")) or 0
+    events = streams.since(current_user_id(), since)
+    return jsonify({"events": [e.to_dict() for e in events],
+                    "last_event_id": events[-1].id if events else since}), 200
@@ -0,0 +1,203 @@
+"""Streaming export of one baby's full history (scans, consultations, messages).
+
+Both formats are generators that the route hands straight to the response, so
+the first bytes go out as soon as the first rows are read and memory does not
+grow with the history: rows come from server-side cursors (yield_per) and image
+files are copied in CHUNK_SIZE pieces.
+
+    zip     records.csv, consultations.csv, messages.csv, images/<record>_<file>,
+            then manifest.json (baby, counts, images that were missing on disk).
+            Written by zipfile onto a non-seekable sink (data descriptors), so
+            no temp file; JPEGs are stored, the CSVs deflated.
+    ndjson  one JSON object per line with a "type" of baby / record /
+            consultation / message, closed by an "end" line with the counts.
+
+Messages are the conversations between the baby's parent and the doctors who
+had a consultation for this baby (only the caller's own when a doctor exports).
+"""
+import io
+import os
+import csv
+import json
+import zipfile
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from extensions import db
+from models import SkinRecord, Consultation, Conversation, Message, User
+
+CHUNK_SIZE = 64 * 1024
+ROWS_PER_FETCH = 500
+
+RECORD_FIELDS = ("record_id", "created_at", "rash_type", "confidence", "model_version", "image")
+CONSULTATION_FIELDS = ("consultation_id", "created_at", "status", "doctor_id", "doctor_name", "date", "time", "reason")
+MESSAGE_FIELDS = ("message_id", "conversation_id", "created_at", "sender_id", "sender_name", "text", "read")
+
+
+def _ts(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S") if dt else None
+
+
+# -------------------------------------------------------------
+# ROW STREAMS
+# -------------------------------------------------------------
+def _stream(stmt):
+    return db.session.execute(stmt.execution_options(yield_per=ROWS_PER_FETCH))
+
+
+def _records(baby_id):
+    r = SkinRecord.__table__.c
+    stmt = (sa.select(r.id, r.created_at, r.predicted_rash_type, r.confidence_score, r.model_version, r.image_path)
+            .where(r.baby_id == baby_id).order_by(r.created_at, r.id))
+    for row in _stream(stmt):
+        yield {"record_id": row.id, "created_at": _ts(row.created_at), "rash_type": row.predicted_rash_type,
+               "confidence": row.confidence_score, "model_version": row.model_version, "image": row.image_path}
+
+
+def _consultations(baby_id, doctor_id=None):
+    c, u = Consultation.__table__.c, User.__table__.c
+    stmt = (sa.select(c.id, c.created_at, c.status, c.doctor_id, u.full_name, c.date, c.time, c.reason)
+            .select_from(Consultation.__table__.outerjoin(User.__table__, u.id == c.doctor_id))
+            .where(c.baby_id == baby_id).order_by(c.created_at, c.id))
+    if doctor_id is not None:
+        stmt = stmt.where(c.doctor_id == doctor_id)
+    for row in _stream(stmt):
+        yield {"consultation_id": row.id, "created_at": _ts(row.created_at), "status": row.status,
+               "doctor_id": row.doctor_id, "doctor_name": row.full_name, "date": row.date, "time": row.time,
+               "reason": row.reason}
+
+
+def _messages(baby, doctor_id=None):
+    m, cv, u, c = Message.__table__.c, Conversation.__table__.c, User.__table__.c, Consultation.__table__.c
+    doctors = sa.select(c.doctor_id).where(c.baby_id == baby.id)
+    if doctor_id is not None:
+        doctors = doctors.where(c.doctor_id == doctor_id)
+    stmt = (sa.select(m.id, m.conversation_id, m.created_at, m.sender_id, u.full_name, m.text, m.read)
+            .select_from(Message.__table__
+                         .join(Conversation.__table__, cv.id == m.conversation_id)
+                         .outerjoin(User.__table__, u.id == m.sender_id))
+            .where(cv.parent_id == baby.parent_id, cv.doctor_id.in_(doctors))
+            .order_by(m.conversation_id, m.created_at, m.id))
+    for row in _stream(stmt):
+        yield {"message_id": row.id, "conversation_id": row.conversation_id, "created_at": _ts(row.created_at),
+               "sender_id": row.sender_id, "sender_name": row.full_name, "text": row.text, "read": bool(row.read)}
+
+
+def _baby_header(baby):
+    return {"baby_id": baby.id, "name": baby.name, "date_of_birth": baby.date_of_birth,
+            "exported_at": _ts(datetime.utcnow())}
+
+
+# -------------------------------------------------------------
+# NDJSON
+# -------------------------------------------------------------
+def ndjson_stream(baby, doctor_id=None):
+    counts = {"records": 0, "consultations": 0, "messages": 0}
+
+    def line(kind, obj):
+        return json.dumps({"type": kind, **obj}, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+    yield line("baby", _baby_header(baby))
+    for kind, key, rows in (("record", "records", _records(baby.id)),
+                            ("consultation", "consultations", _consultations(baby.id, doctor_id)),
+                            ("message", "messages", _messages(baby, doctor_id))):
+        buf = []
+        for row in rows:
+            if kind == "record":
+                row["image_url"] = f"/instance/uploads/{row['image']}" if row["image"] else None
+            buf.append(line(kind, row))
+            counts[key] += 1
+            if len(buf) >= ROWS_PER_FETCH:
+                yield "".join(buf)
+                buf = []
+        if buf:
+            yield "".join(buf)
+    yield line("end", {"counts": counts})
+
+
+# -------------------------------------------------------------
+# ZIP
+# -------------------------------------------------------------
+class _Sink:
+    """Write-only file object for zipfile; the generator drains what was written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+
+def zip_stream(baby, uploads_dir, open_image=None, doctor_id=None):
+    """ZIP archive bytes in pieces. open_image(name) -> binary file object (default: uploads_dir/name)."""
+    open_image = open_image or (lambda name: open(os.path.join(uploads_dir, name), "rb"))
+    sink = _Sink()
+    counts = {"records": 0, "consultations": 0, "messages": 0, "images": 0}
+    missing = []
+
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for name, fields, rows, key in (
+                ("records.csv", RECORD_FIELDS, _records(baby.id), "records"),
+                ("consultations.csv", CONSULTATION_FIELDS, _consultations(baby.id, doctor_id), "consultations"),
+                ("messages.csv", MESSAGE_FIELDS, _messages(baby, doctor_id), "messages")):
+            with zf.open(name, "w", force_zip64=True) as entry:
+                text = io.TextIOWrapper(entry, encoding="utf-8", newline="", write_through=True)
+                writer = csv.DictWriter(text, fieldnames=fields)
+                writer.writeheader()
+                for row in rows:
+                    if key == "records" and row["image"]:
+                        row["image"] = f"images/{row['record_id']}_{row['image']}"
+                    writer.writerow(row)
+                    counts[key] += 1
+                    if counts[key] % ROWS_PER_FETCH == 0:
+                        yield sink.drain()
+                text.detach()
+            yield sink.drain()
+
+        # second pass over the records for their files, so each CSV above is one contiguous entry
+        for row in _records(baby.id):
+            if not row["image"]:
+                continue
+            try:
+                src = open_image(row["image"])
+            except (OSError, LookupError):
+                missing.append(row["image"])
+                continue
+            info = zipfile.ZipInfo(f"images/{row['record_id']}_{row['image']}",
+                                   date_time=_zip_time(row["created_at"]))
+            info.compress_type = zipfile.ZIP_STORED   # already-compressed images
+            with src, zf.open(info, "w", force_zip64=True) as entry:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    yield sink.drain()
+            counts["images"] += 1
+            yield sink.drain()
+
+        zf.writestr("manifest.json", json.dumps({
+            **_baby_header(baby),
+            "counts": counts,
+            "missing_images": missing,
+            "files": {"records": "records.csv", "consultations": "consultations.csv",
+                      "messages": "messages.csv", "images": "images/"},
+        }, indent=2, ensure_ascii=False))
+    yield sink.drain()
+
+
+def _zip_time(ts):
+    if not ts:
+        return (1980, 1, 1, 0, 0, 0)
+    dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+    return (max(dt.year, 1980), dt.month, dt.day, dt.hour, dt.minute, dt.second)
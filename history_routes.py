@@ -1,7 +1,10 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, jsonify, request, current_app, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from extensions import db
-from models import SkinRecord, Baby
+from models import SkinRecord, Baby, Consultation
+from utils.role_required import claims_required, current_user
+from history_export import ndjson_stream, zip_stream
+from retention import open_upload, thumb_urls
 
 history_bp = Blueprint("history_bp", __name__, url_prefix="/api/history")
 
@@ -25,6 +28,7 @@ def get_history(baby_id):
         .order_by(SkinRecord.created_at.desc())
         .all()
     )
+    thumbs = thumb_urls(rec.image_path for rec in records)
 
     history_list = [
         {
@@ -32,6 +36,7 @@ def get_history(baby_id):
             "rash_type": rec.predicted_rash_type,
             "confidence": rec.confidence_score,
             "image_url": rec.image_path,
+            "thumb_url": thumbs.get(rec.image_path),
             "created_at": rec.created_at.strftime("%Y-%m-%d %H:%M"),
         }
         for rec in records
@@ -64,6 +69,7 @@ def get_all_history():
             .order_by(SkinRecord.created_at.desc())
             .all()
         )
+        thumbs = thumb_urls(rec.image_path for rec in records)
 
         record_list = [
             {
@@ -71,6 +77,7 @@ def get_all_history():
                 "rash_type": rec.predicted_rash_type,
                 "confidence": rec.confidence_score,
                 "image_url": rec.image_path,
+                "thumb_url": thumbs.get(rec.image_path),
                 "created_at": rec.created_at.strftime("%Y-%m-%d %H:%M"),
             }
             for rec in records
@@ -84,3 +91,40 @@ def get_all_history():
         })
 
     return jsonify({"history": history_output}), 200
+
+
+# ---------------------------------------------------------
+# 3️⃣ GET: Download ONE baby's full history (streamed)
+# ---------------------------------------------------------
+@history_bp.route("/<int:baby_id>/export", methods=["GET"])
+@claims_required("parent", "doctor")
+def export_history(baby_id):
+    user_id, role = current_user()
+    fmt = request.args.get("format", "zip").lower()
+    if fmt not in ("zip", "ndjson"):
+        return jsonify({"error": "format must be 'zip' or 'ndjson'"}), 400
+
+    baby = Baby.query.get(baby_id)
+    doctor_id = None
+    if baby is None:
+        return jsonify({"error": "Baby not found or unauthorized"}), 404
+    if role == "doctor":
+        # doctors export what they were consulted on: an accepted consultation for this baby
+        accepted = Consultation.query.filter_by(baby_id=baby_id, doctor_id=user_id, status="accepted").first()
+        if not accepted:
+            return jsonify({"error": "Baby not found or unauthorized"}), 404
+        doctor_id = user_id
+    elif baby.parent_id != user_id:
+        return jsonify({"error": "Baby not found or unauthorized"}), 404
+
+    if fmt == "ndjson":
+        body, mimetype, ext = ndjson_stream(baby, doctor_id), "application/x-ndjson", "ndjson"
+    else:
+        uploads = current_app.uploads_path
+        body = zip_stream(baby, uploads, open_image=lambda name: open_upload(uploads, name), doctor_id=doctor_id)
+        mimetype, ext = "application/zip", "zip"
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="baby_{baby.id}_history.{ext}"',
+        "Cache-Control": "no-store",
+        "X-Accel-Buffering": "no",
+    })
@@ -0,0 +1,159 @@
+"""Perceptual hashes and a per-baby near-duplicate index.
+
+Parents re-send the same photo recompressed, resized or slightly cropped. A 64-bit
+pHash (low-frequency DCT signs) barely moves under those edits, so two uploads
+within a few bits of Hamming distance are treated as the same picture.
+
+Each baby gets a BK-tree of (hash -> record) built lazily from skin_records.phash
+and topped up incrementally (only ids above the last one seen are queried), so
+records written by other workers are picked up without a rebuild.
+
+Config (env):
+    DEDUP_MAX_DISTANCE=6      Hamming radius (of 64 bits) counted as a duplicate
+    DEDUP_WINDOW_HOURS=72     only reuse records this recent; 0 disables reuse
+"""
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from PIL import Image
+
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "6"))
+DEDUP_WINDOW_HOURS = float(os.getenv("DEDUP_WINDOW_HOURS", "72"))
+
+_PHASH_SIZE = 32
+_PHASH_LOW = 8
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m.astype(np.float32)
+
+
+_DCT = _dct_matrix(_PHASH_SIZE)
+
+
+# -------------------------------------------------------------
+# HASHES
+# -------------------------------------------------------------
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+def phash(img):
+    """64-bit DCT hash of a PIL image: sign of the 8x8 lowest frequencies vs their median."""
+    g = np.asarray(img.convert("L").resize((_PHASH_SIZE, _PHASH_SIZE), Image.LANCZOS), dtype=np.float32)
+    low = (_DCT @ g @ _DCT.T)[:_PHASH_LOW, :_PHASH_LOW]
+    # the DC term only tracks overall brightness; leave it out of the median
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+def dhash(img):
+    """64-bit gradient hash: is each pixel brighter than its right neighbour (9x8 grayscale)."""
+    g = np.asarray(img.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(g[:, 1:] > g[:, :-1])
+
+def to_hex(h):
+    return f"{h:016x}"
+
+def from_hex(s):
+    return int(s, 16)
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+# -------------------------------------------------------------
+# BK-TREE
+# -------------------------------------------------------------
+class BKTree:
+    """Metric tree over Hamming distance: a radius-r search only visits children
+    whose edge distance lies within [d - r, d + r] of the query's distance."""
+
+    def __init__(self):
+        self.root = None  # [hash, items, {distance: child}]
+        self.size = 0
+
+    def add(self, h, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [h, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [item], {}]
+                return
+            node = child
+
+    def search(self, h, radius):
+        """[(distance, item)] for every stored hash within `radius`, closest first."""
+        out = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                out.extend((d, item) for item in node[1])
+            for edge, child in node[2].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        out.sort(key=lambda x: x[0])
+        return out
+
+
+# -------------------------------------------------------------
+# PER-BABY INDEX
+# -------------------------------------------------------------
+class DuplicateIndex:
+    def __init__(self, max_distance=DEDUP_MAX_DISTANCE, window_hours=DEDUP_WINDOW_HOURS):
+        self.max_distance = max_distance
+        self.window_hours = window_hours
+        self._trees = {}      # baby_id -> (BKTree, last record id seen)
+        self._lock = threading.Lock()
+
+    def _refresh(self, baby_id):
+        from models import SkinRecord
+
+        with self._lock:
+            last_id = self._trees.get(baby_id, (None, 0))[1]
+        rows = (SkinRecord.query
+                .with_entities(SkinRecord.id, SkinRecord.phash, SkinRecord.created_at)
+                .filter(SkinRecord.baby_id == baby_id, SkinRecord.id > last_id,
+                        SkinRecord.phash.isnot(None))
+                .order_by(SkinRecord.id)
+                .all())
+        with self._lock:
+            tree, last_id = self._trees.get(baby_id, (BKTree(), 0))
+            for rid, ph, created_at in rows:
+                if rid > last_id:
+                    tree.add(from_hex(ph), (rid, created_at))
+                    last_id = rid
+            self._trees[baby_id] = (tree, last_id)
+            return tree
+
+    def find(self, baby_id, h, now=None):
+        """Closest earlier record of this baby within the radius and time window: (record_id, distance) or None."""
+        if not self.window_hours:
+            return None
+        tree = self._refresh(baby_id)
+        since = (now or datetime.utcnow()) - timedelta(hours=self.window_hours)
+        with self._lock:
+            matches = tree.search(h, self.max_distance)
+        for d, (rid, created_at) in matches:
+            if created_at is None or created_at >= since:
+                return rid, d
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+
+duplicates = DuplicateIndex()
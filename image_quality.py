@@ -0,0 +1,131 @@
+"""Cheap pre-inference quality gate for uploaded photos.
+
+Runs on a grayscale copy box-reduced to about QUALITY_WORK_SIDE px, so the cost is a few
+milliseconds regardless of the upload size:
+    resolution   shortest side of the original
+    blur         variance of the 4-neighbour Laplacian (low = soft / out of focus)
+    exposure     mean luminance and the share of crushed / blown-out pixels
+
+Problems are "reject" (the model would be guessing) or "warn" (scored, but the
+parent is told how to retake the photo).
+
+Config (env):
+    QUALITY_GATE=reject        reject | flag (never reject, only warn) | off
+"""
+import os
+
+import numpy as np
+
+QUALITY_GATE = os.getenv("QUALITY_GATE", "reject").lower()
+WORK_SIDE = int(os.getenv("QUALITY_WORK_SIDE", "512"))
+
+MIN_SIDE = int(os.getenv("QUALITY_MIN_SIDE", "160"))
+WARN_SIDE = int(os.getenv("QUALITY_WARN_SIDE", "224"))
+BLUR_REJECT = float(os.getenv("QUALITY_BLUR_REJECT", "15"))
+BLUR_WARN = float(os.getenv("QUALITY_BLUR_WARN", "50"))
+DARK_MEAN = float(os.getenv("QUALITY_DARK_MEAN", "35"))
+BRIGHT_MEAN = float(os.getenv("QUALITY_BRIGHT_MEAN", "230"))
+CLIP_WARN = float(os.getenv("QUALITY_CLIP_WARN", "0.25"))
+
+MESSAGES = {
+    "too_small": "The photo resolution is too low. Move closer or use the camera's full resolution.",
+    "low_resolution": "The photo is quite small; a closer, full-resolution shot gives a more reliable result.",
+    "blurry": "The photo is blurry. Hold the phone steady and tap the skin area to focus.",
+    "slightly_blurry": "The photo is a little soft. Hold the phone steady and tap to focus if you can.",
+    "too_dark": "The photo is too dark. Use daylight or turn on a room light (avoid the flash glare).",
+    "too_bright": "The photo is overexposed. Avoid direct sunlight or flash on the skin.",
+    "underexposed": "Parts of the photo are very dark; more even light would help.",
+    "overexposed": "Parts of the photo are washed out; avoid glare from flash or windows.",
+}
+
+
+class ImageRejected(Exception):
+    """Raised by the predict pipeline when the quality gate rejects an image."""
+
+    def __init__(self, report):
+        super().__init__(", ".join(i["code"] for i in report["issues"]))
+        self.report = report
+
+
+def _work_copy(img):
+    # integer box reduction first (cheap), so the grayscale conversion touches few pixels
+    factor = max(img.size) // WORK_SIDE
+    small = img.reduce(factor) if factor > 1 else img
+    return np.asarray(small.convert("L"), dtype=np.float32)
+
+
+def laplacian_variance(g):
+    """Variance of the 4-neighbour Laplacian over a 2-D float array."""
+    if g.shape[0] < 3 or g.shape[1] < 3:
+        return 0.0
+    lap = g[:-2, 1:-1] + g[2:, 1:-1] + g[1:-1, :-2] + g[1:-1, 2:] - 4.0 * g[1:-1, 1:-1]
+    return float(lap.var())
+
+
+def measure(img):
+    g = _work_copy(img)
+    return {
+        "width": img.width,
+        "height": img.height,
+        "blur": round(laplacian_variance(g), 2),
+        "brightness": round(float(g.mean()), 2),
+        "dark_fraction": round(float((g < 16).mean()), 4),
+        "bright_fraction": round(float((g > 240).mean()), 4),
+    }
+
+
+def assess(img, mode=None):
+    """Decoded PIL image -> {"ok", "action", "metrics", "issues": [{code, severity, message}]}.
+
+    `action` is "accept", "warn" or "reject"; with mode "flag" it never rejects.
+    """
+    mode = (mode or QUALITY_GATE).lower()
+    m = measure(img)
+    issues = []
+
+    def add(code, severity):
+        issues.append({"code": code, "severity": severity, "message": MESSAGES[code]})
+
+    short = min(m["width"], m["height"])
+    if short < MIN_SIDE:
+        add("too_small", "reject")
+    elif short < WARN_SIDE:
+        add("low_resolution", "warn")
+
+    if m["brightness"] < DARK_MEAN:
+        add("too_dark", "reject")
+    elif m["brightness"] > BRIGHT_MEAN:
+        add("too_bright", "reject")
+    elif m["dark_fraction"] > CLIP_WARN:
+        add("underexposed", "warn")
+    elif m["bright_fraction"] > CLIP_WARN:
+        add("overexposed", "warn")
+
+    # a near-black/white frame has no texture either; report the exposure, not blur
+    if not any(i["code"] in ("too_dark", "too_bright") for i in issues):
+        if m["blur"] < BLUR_REJECT:
+            add("blurry", "reject")
+        elif m["blur"] < BLUR_WARN:
+            add("slightly_blurry", "warn")
+
+    if mode == "flag":
+        for i in issues:
+            i["severity"] = "warn"
+    if any(i["severity"] == "reject" for i in issues):
+        action = "reject"
+    elif issues:
+        action = "warn"
+    else:
+        action = "accept"
+    return {"ok": action != "reject", "action": action, "metrics": m, "issues": issues}
+
+
+def check(img, mode=None):
+    """assess() for the request path: None when the gate is off, raises ImageRejected on reject."""
+    mode = (mode or QUALITY_GATE).lower()
+    if mode == "off":
+        return None
+    report = assess(img, mode)
+    if not report["ok"]:
+        raise ImageRejected(report)
+    return report
@@ -0,0 +1,268 @@
+"""Incremental retraining from SkinRecord uploads.
+Run: python incremental_train.py [--confirmed-only] [--epochs 2]
+     python incremental_train.py --bootstrap      # one-off: cache dataset/ into shards first
+
+New SkinRecords since the last run are resized once and appended to the shard
+cache as a new TFRecord file; older shards are never re-decoded. The current
+unified_model.keras is then fine-tuned on the cached shards at a low learning rate.
+"""
+import os
+import io
+import json
+import zlib
+import functools
+import argparse
+from datetime import datetime, timedelta
+
+from PIL import Image
+import tensorflow as tf
+
+import train_model
+from train_model import IMG_SIZE, BATCH, MODEL_OUT, CLASS_JSON
+
+SHARD_DIR = os.path.join(train_model.BASE, "instance", "train_shards")
+MANIFEST = "manifest.json"
+VAL_PERCENT = 10
+# --confirmed-only: how long a record may wait for an accepted consultation before it is skipped for good
+PENDING_DAYS = int(os.getenv("INCREMENTAL_PENDING_DAYS", "30"))
+
+
+# -------------------------------------------------------------
+# SHARD CACHE
+# -------------------------------------------------------------
+def load_manifest(shard_dir, classes):
+    path = os.path.join(shard_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["classes"] != classes:
+            raise SystemExit(f"Shard cache classes {manifest['classes']} do not match model classes {classes}; "
+                             "rebuild the cache (delete it and run --bootstrap)")
+        return manifest
+    return {"classes": classes, "shards": [], "last_record_id": 0, "pending_ids": []}
+
+def save_manifest(shard_dir, manifest):
+    path = os.path.join(shard_dir, MANIFEST)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+def _is_val(key):
+    # dataset/train and dataset/val keep the split they were given
+    if key.startswith("dataset/train/"):
+        return 0
+    if key.startswith("dataset/val/"):
+        return 1
+    # stable split: the same image always lands on the same side, run after run
+    return int(zlib.crc32(key.encode("utf-8")) % 100 < VAL_PERCENT)
+
+def _encode(src):
+    # src: a path or a binary file object
+    img = Image.open(src).convert("RGB").resize(IMG_SIZE, Image.BICUBIC)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=95)
+    return buf.getvalue()
+
+def _example(jpeg, label, key):
+    feature = {
+        "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[jpeg])),
+        "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+        "val": tf.train.Feature(int64_list=tf.train.Int64List(value=[_is_val(key)])),
+        "key": tf.train.Feature(bytes_list=tf.train.BytesList(value=[key.encode("utf-8")])),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+def write_shard(shard_dir, manifest, items, source, opener=None):
+    """items: iterable of (image_path, label_index, key). Returns the number of examples written.
+    opener(image_path) -> binary file object, for images that are not plain files (archived uploads)."""
+    os.makedirs(shard_dir, exist_ok=True)
+    name = f"shard-{len(manifest['shards']):05d}.tfrecord"
+    path = os.path.join(shard_dir, name)
+    count = 0
+    with tf.io.TFRecordWriter(path + ".tmp") as w:
+        for img_path, label, key in items:
+            try:
+                if opener is None:
+                    jpeg = _encode(img_path)
+                else:
+                    with opener(img_path) as fh:
+                        jpeg = _encode(fh)
+                w.write(_example(jpeg, label, key))
+                count += 1
+            except Exception as e:
+                print(f"  skip {img_path}: {e}")
+    if count == 0:
+        os.remove(path + ".tmp")
+        return 0
+    os.replace(path + ".tmp", path)
+    manifest["shards"].append({"file": name, "count": count, "source": source,
+                               "created_at": datetime.utcnow().isoformat()})
+    return count
+
+def bootstrap(shard_dir, manifest, data_root):
+    if any(s["source"] == "dataset" for s in manifest["shards"]):
+        print("dataset/ already cached; skipping bootstrap")
+        return 0
+    index = {c: i for i, c in enumerate(manifest["classes"])}
+    # explicit train/ + val/ layout when either exists, otherwise class folders directly under data_root
+    roots = [os.path.join(data_root, split) for split in ("train", "val")
+             if os.path.isdir(os.path.join(data_root, split))] or [data_root]
+    items = []
+    for root in roots:
+        for cls in train_model.list_subdirs(root):
+            if cls not in index:
+                continue
+            cdir = os.path.join(root, cls)
+            prefix = os.path.relpath(cdir, data_root).replace(os.sep, "/")
+            for fname in sorted(os.listdir(cdir)):
+                items.append((os.path.join(cdir, fname), index[cls], f"dataset/{prefix}/{fname}"))
+    n = write_shard(shard_dir, manifest, items, "dataset")
+    print(f"Cached {n} dataset images")
+    return n
+
+
+# -------------------------------------------------------------
+# NEW RECORD SELECTION
+# -------------------------------------------------------------
+def ingest_new_records(shard_dir, manifest, uploads_path, confirmed_only=False, pending_days=PENDING_DAYS):
+    import sqlalchemy as sa
+    from extensions import db
+    from models import SkinRecord, Consultation
+    from retention import open_upload
+
+    last_id = manifest.get("last_record_id", 0)
+    pending = set(manifest.get("pending_ids", [])) if confirmed_only else set()
+    cutoff = datetime.utcnow() - timedelta(days=pending_days)
+
+    if confirmed_only:
+        accepted = sa.select(Consultation.baby_id).where(Consultation.status == "accepted")
+        confirmed_col = SkinRecord.baby_id.in_(accepted).label("confirmed")
+    else:
+        confirmed_col = sa.true().label("confirmed")
+    window = SkinRecord.id > last_id
+    if pending:
+        # records still awaiting a consultation are looked at again until they age out;
+        # an id range keeps the statement small however many there are
+        window = sa.or_(window, sa.and_(SkinRecord.id >= min(pending), SkinRecord.created_at >= cutoff))
+    rows = (db.session.query(SkinRecord.id, SkinRecord.image_path, SkinRecord.predicted_rash_type,
+                             SkinRecord.created_at, confirmed_col)
+            .filter(SkinRecord.image_path.isnot(None), window)
+            .order_by(SkinRecord.id).all())
+    rows = [r for r in rows if r.id > last_id or r.id in pending]
+    if not rows:
+        print("No new records since last run (last_record_id=%s)" % last_id)
+        manifest["pending_ids"] = []
+        return 0
+
+    index = {c: i for i, c in enumerate(manifest["classes"])}
+    items, still_pending, expired = [], [], 0
+    for r in rows:
+        if not r.confirmed:
+            # a doctor may still accept a consultation for this baby; look at it again next run
+            if r.created_at is not None and r.created_at >= cutoff:
+                still_pending.append(r.id)
+            else:
+                expired += 1
+            continue
+        label = index.get(r.predicted_rash_type)
+        if label is None:
+            continue
+        items.append((r.image_path, label, f"record/{r.id}"))
+
+    # originals older than the retention window live in the archive; open_upload reads either
+    opener = functools.partial(open_upload, uploads_path)
+    n = write_shard(shard_dir, manifest, items, "records", opener=opener) if items else 0
+    manifest["last_record_id"] = max(last_id, rows[-1].id)
+    manifest["pending_ids"] = still_pending
+    print(f"Added {n} new records ({len(still_pending)} awaiting consultation, "
+          f"{expired} older than {pending_days} days dropped)")
+    return n
+
+
+# -------------------------------------------------------------
+# FINE-TUNE
+# -------------------------------------------------------------
+def shard_dataset(shard_dir, manifest, batch, val):
+    files = [os.path.join(shard_dir, s["file"]) for s in manifest["shards"]]
+    num_classes = len(manifest["classes"])
+    spec = {
+        "image": tf.io.FixedLenFeature([], tf.string),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+        "val": tf.io.FixedLenFeature([], tf.int64),
+    }
+    AUTOTUNE = tf.data.AUTOTUNE
+
+    def _to_xy(ex):
+        x = tf.cast(tf.io.decode_jpeg(ex["image"], channels=3), tf.float32)
+        x = tf.keras.applications.efficientnet.preprocess_input(x)
+        return x, tf.one_hot(ex["label"], num_classes)
+
+    ds = tf.data.TFRecordDataset(files, num_parallel_reads=AUTOTUNE).with_options(train_model.data_options())
+    ds = ds.map(lambda raw: tf.io.parse_single_example(raw, spec), num_parallel_calls=AUTOTUNE)
+    ds = ds.filter(lambda ex: tf.equal(ex["val"], int(val)))
+    if not val:
+        ds = ds.shuffle(2048, seed=train_model.SEED)
+    return ds.map(_to_xy, num_parallel_calls=AUTOTUNE).batch(batch).prefetch(AUTOTUNE)
+
+def fine_tune(shard_dir, manifest, model_path, out, epochs, batch, lr):
+    model = tf.keras.models.load_model(model_path)
+    backbone = train_model.find_backbone(model)
+    if backbone is not None:
+        backbone.trainable = True
+    train_model.compile_model(model, lr)
+    train_ds = shard_dataset(shard_dir, manifest, batch, val=False)
+    val_ds = shard_dataset(shard_dir, manifest, batch, val=True)
+    callbacks = [tf.keras.callbacks.EarlyStopping(patience=2, restore_best_weights=True, monitor="val_loss")]
+    hist = model.fit(train_ds, validation_data=val_ds, epochs=epochs, callbacks=callbacks)
+    model.save(out)
+    print("Fine-tuned model saved to:", out)
+    return hist
+
+
+def main():
+    p = argparse.ArgumentParser(description="Fine-tune the current model on newly collected uploads.")
+    p.add_argument("--confirmed-only", action="store_true",
+                   help="only use records whose baby has an accepted consultation")
+    p.add_argument("--pending-days", type=int, default=PENDING_DAYS,
+                   help="with --confirmed-only, stop waiting for a consultation after this many days")
+    p.add_argument("--bootstrap", action="store_true", help="also cache dataset/ as the base shard")
+    p.add_argument("--data-root", default=train_model.DATA_ROOT)
+    p.add_argument("--shard-dir", default=SHARD_DIR)
+    p.add_argument("--model", default=MODEL_OUT, help="model to start from")
+    p.add_argument("--out", default=MODEL_OUT)
+    p.add_argument("--epochs", type=int, default=2)
+    p.add_argument("--batch", type=int, default=BATCH)
+    p.add_argument("--lr", type=float, default=1e-5)
+    p.add_argument("--ingest-only", action="store_true", help="update the shard cache without training")
+    args = p.parse_args()
+
+    from model_registry import load_labels
+    classes = load_labels(CLASS_JSON)
+    if not classes:
+        raise SystemExit(f"No class map at {CLASS_JSON}; run train_model.py first")
+    manifest = load_manifest(args.shard_dir, classes)
+
+    if args.bootstrap:
+        bootstrap(args.shard_dir, manifest, args.data_root)
+        save_manifest(args.shard_dir, manifest)
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        added = ingest_new_records(args.shard_dir, manifest, app.uploads_path,
+                                   args.confirmed_only, args.pending_days)
+    save_manifest(args.shard_dir, manifest)
+
+    if args.ingest_only:
+        return
+    if not manifest["shards"]:
+        raise SystemExit("Shard cache is empty; run with --bootstrap or collect some records first")
+    if added == 0 and not args.bootstrap:
+        print("Nothing new to learn from; model left unchanged")
+        return
+    fine_tune(args.shard_dir, manifest, args.model, args.out, args.epochs, args.batch, args.lr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,29 @@
 import os
 import io
-import json
+import time
 import numpy as np
 from PIL import Image
 import tensorflow as tf
 
+from model_registry import registry, load_labels
+import image_quality
+
 ROOT = os.path.dirname(__file__)
 MODEL_PATH = os.path.join(ROOT, "unified_model.keras")
 LABELS_PATH = os.path.join(ROOT, "class_index_to_label.json")
 
 # load labels (index -> label)
 def _load_labels(path=LABELS_PATH):
-    if not os.path.exists(path):
-        return []
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            d = json.load(f)
-        if all(str(k).isdigit() for k in d.keys()):
-            mapping = {int(k): v for k, v in d.items()}
-            return [mapping[i] for i in sorted(mapping.keys())]
-        # if it's label->index, invert
-        inv = {int(v): k for k, v in d.items()}
-        return [inv[i] for i in sorted(inv.keys())]
-    except Exception:
-        return []
+    return load_labels(path)
 
+# labels of the legacy model file; live predictions use the labels of the active registry version
 CLASS_NAMES = _load_labels()
 
-_model = None
-_input_size = (224, 224)
-
 def load_model(path=None):
-    global _model, _input_size
-    if _model is not None:
-        return _model
-    p = path or MODEL_PATH
-    if not os.path.exists(p):
-        raise FileNotFoundError(f"Model not found at {p}")
-    _model = tf.keras.models.load_model(p)
-    try:
-        ishape = _model.input_shape
-        if ishape and len(ishape) == 4:
-            _, h, w, _ = ishape
-            _input_size = (int(h) or 224, int(w) or 224)
-    except Exception:
-        _input_size = (224, 224)
-    return _model
+    """Return the active model, loading the current registry version on first use."""
+    if path is not None:
+        return tf.keras.models.load_model(path)
+    return registry.active().model
 
 def _open_image(obj, size=None):
     # accept bytes, file-like (Flask FileStorage), or path
@@ -63,49 +41,212 @@ def _open_image(obj, size=None):
         img = img.resize(size, Image.BICUBIC)
     return img
 
-def predict_image_bytes(fileobj):
-    """
-    Accepts a Flask FileStorage or bytes or path.
-    Returns a JSON-serializable dict:
-      { rash_type, confidence, confidence_raw, care_tips, probs }
-    """
-    model = load_model()
-    img = _open_image(fileobj, size=_input_size)
+def to_input(img, size):
+    """Decoded RGB image -> preprocessed (1,H,W,3) batch, exactly as in training."""
+    if img.size != size:
+        img = img.resize(size, Image.BICUBIC)
+    return _preprocess(img)
+
+def _preprocess(img):
     arr = np.asarray(img).astype(np.float32)
     arr = tf.keras.applications.efficientnet.preprocess_input(arr)  # same as training
-    inp = np.expand_dims(arr, 0)  # (1,H,W,3)
-    preds = model.predict(inp)
+    return np.expand_dims(arr, 0)  # (1,H,W,3)
+
+def forward(model, inp):
+    """Run the model on a (N,H,W,3) batch and return the raw (N,C) outputs."""
+    return _as_2d(model.predict(inp, verbose=0))
+
+def forward_embed(lm, inp):
+    """One pass through lm.embedder -> (raw (N,C) outputs, pooled (N,D) float32 embeddings)."""
+    emb, preds = lm.embedder.predict(inp, verbose=0)
+    return _as_2d(preds), np.asarray(emb, dtype=np.float32)
+
+def _as_2d(preds):
     # handle dict or array outputs
     if isinstance(preds, dict):
         # take first item
         preds = list(preds.values())[0]
-    preds = np.asarray(preds)
-    if preds.ndim == 2 and preds.shape[0] == 1:
-        probs = preds[0]
-    elif preds.ndim == 1:
-        probs = preds
+    preds = np.asarray(preds, dtype=np.float32)
+    if preds.ndim == 1:
+        preds = preds[None, :]
+    elif preds.ndim > 2:
+        # fallback: flatten per sample
+        preds = preds.reshape(preds.shape[0], -1)
+    return preds
+
+# -------------------------------------------------------------
+# POST-PROCESSING (vectorized over the batch)
+# -------------------------------------------------------------
+TOP_K = 3
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+def postprocess_batch(preds, top_k=TOP_K, temperature=1.0):
+    """(N,C) outputs -> (probs (N,C), top_idx (N,k), top_scores (N,k)), sorted best first.
+
+    Rows that are not already distributions are softmaxed; temperature != 1 rescales
+    the log-probabilities (temperature scaling calibration).
+    """
+    probs = np.array(preds, dtype=np.float32, ndmin=2)
+    normalized = (probs.min(axis=1) >= 0) & np.isclose(probs.sum(axis=1), 1.0, atol=1e-2)
+    if not normalized.all():
+        probs[~normalized] = _softmax(probs[~normalized])
+    if temperature != 1.0:
+        probs = _softmax(np.log(np.clip(probs, 1e-12, 1.0)) / temperature)
+
+    k = max(1, min(top_k, probs.shape[1]))
+    top_idx = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(probs, top_idx, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top_idx = np.take_along_axis(top_idx, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    return probs, top_idx, top_scores
+
+def build_results(lm, probs, top_idx, top_scores, full=False):
+    """Compact per-image results: top-k only, full distribution when `full`."""
+    labels = lm.class_names
+    idx_rows = top_idx.tolist()
+    # float64 before rounding so tolist() gives clean JSON numbers
+    score_rows = np.round(top_scores.astype(np.float64), 4).tolist()
+    prob_rows = np.round(probs.astype(np.float64), 4).tolist() if full else None
+    results = []
+    for n, (idxs, scores) in enumerate(zip(idx_rows, score_rows)):
+        res = {
+            "rash_type": lm.label(idxs[0]),
+            "confidence_raw": scores[0],
+            "top_k": [{"label": lm.label(i), "score": s} for i, s in zip(idxs, scores)],
+            "model_version": lm.version,
+        }
+        if full:
+            row = prob_rows[n]
+            res["probs"] = {(labels[i] if i < len(labels) else f"label_{i}"): p for i, p in enumerate(row)}
+        results.append(res)
+    return results
+
+# -------------------------------------------------------------
+# TEST-TIME AUGMENTATION (low-confidence cases only)
+# -------------------------------------------------------------
+# off by default; set e.g. 0.6 to score flips/crops in one extra batched call and average them
+# when the top-1 probability is below it
+TTA_THRESHOLD = float(os.getenv("TTA_THRESHOLD", "0"))
+TTA_CROP = 0.85
+
+def tta_views(img, size):
+    """Flip + centre/corner crops of the already-decoded image, each resized to `size`."""
+    w, h = img.size
+    cw, ch = int(w * TTA_CROP), int(h * TTA_CROP)
+    boxes = [
+        ((w - cw) // 2, (h - ch) // 2),     # centre
+        (0, 0), (w - cw, 0), (0, h - ch), (w - cw, h - ch),
+    ]
+    views = [img.transpose(Image.FLIP_LEFT_RIGHT).resize(size, Image.BICUBIC)]
+    for x, y in boxes:
+        views.append(img.crop((x, y, x + cw, y + ch)).resize(size, Image.BICUBIC))
+    return views
+
+def tta_probs(lm, img):
+    """Probabilities for every augmented view, from a single forward pass: (V,C)."""
+    batch = np.concatenate([_preprocess(v) for v in tta_views(img, lm.input_size)], axis=0)
+    probs, _, _ = postprocess_batch(forward(lm.model, batch), 1, lm.temperature)
+    return probs
+
+STAGES = ("decode", "quality", "resize", "preprocess", "forward", "postprocess", "tta")
+
+def decode(fileobj, timings=None, quality_gate=False):
+    """Decode an upload to RGB -> (img, quality report or None).
+
+    With `quality_gate` the image is checked right away (image_quality.check): unusable
+    photos raise ImageRejected before the model is touched.
+    """
+    t0 = time.perf_counter()
+    img = _open_image(fileobj)
+    t1 = time.perf_counter()
+    quality = None
+    try:
+        if quality_gate:
+            quality = image_quality.check(img)
+    finally:
+        if timings is not None:
+            timings["decode"] = t1 - t0
+            if quality_gate:
+                timings["quality"] = time.perf_counter() - t1
+    return img, quality
+
+def predict_decoded(img, timings=None, top_k=TOP_K, full=False, tta_threshold=None, quality=None,
+                    embed=False):
+    """Score an already-decoded image -> (result, model input).
+
+    When the top-1 probability is below `tta_threshold` (default TTA_THRESHOLD) the
+    augmented views are averaged in; confident images never pay for it. Warnings from
+    a `quality` report are passed through in result["quality"].
+    With `embed`, result["embedding"] holds the pooled backbone features (a float32
+    array, not JSON - pop it before responding), taken from the same forward pass.
+    """
+    # pin one version for the whole call so a concurrent swap cannot mix models and labels
+    lm = registry.active()
+    t1 = time.perf_counter()
+    resized = img.resize(lm.input_size, Image.BICUBIC) if img.size != lm.input_size else img
+    t2 = time.perf_counter()
+    inp = _preprocess(resized)
+    t3 = time.perf_counter()
+    emb = None
+    if embed and lm.embedder is not None:
+        preds, emb = forward_embed(lm, inp)
     else:
-        # fallback: flatten
-        probs = preds.flatten()
-
-    # If outputs not normalized, apply softmax
-    if not (probs.min() >= 0 and np.isclose(probs.sum(), 1.0, atol=1e-2)):
-        e = np.exp(probs - np.max(probs))
-        probs = e / e.sum()
-
-    top_idx = int(np.argmax(probs))
-    top_score = float(probs[top_idx])
-    top_label = CLASS_NAMES[top_idx] if CLASS_NAMES and top_idx < len(CLASS_NAMES) else f"label_{top_idx}"
-
-    probs_map = {}
-    for i, p in enumerate(probs.tolist()):
-        lbl = CLASS_NAMES[i] if CLASS_NAMES and i < len(CLASS_NAMES) else f"label_{i}"
-        probs_map[lbl] = f"{p*100:.2f}%"
-
-    return {
-        "rash_type": top_label,
-        "confidence": f"{top_score*100:.1f}%",
-        "confidence_raw": float(top_score),
-        "care_tips": [],   # app.py / frontend will map label -> tips
-        "probs": probs_map
-    }
\ No newline at end of file
+        preds = forward(lm.model, inp)
+    t4 = time.perf_counter()
+    probs, top_idx, top_scores = postprocess_batch(preds, top_k, lm.temperature)
+    t5 = time.perf_counter()
+
+    threshold = TTA_THRESHOLD if tta_threshold is None else tta_threshold
+    views = 0
+    if threshold and float(top_scores[0, 0]) < threshold:
+        extra = tta_probs(lm, img)
+        views = extra.shape[0]
+        probs = (probs + extra.sum(axis=0, keepdims=True)) / (views + 1)
+        # already calibrated and normalized: only re-rank
+        probs, top_idx, top_scores = postprocess_batch(probs, top_k)
+    t6 = time.perf_counter()
+
+    result = build_results(lm, probs, top_idx, top_scores, full=full)[0]
+    if views:
+        result["tta_views"] = views + 1
+    if quality is not None and quality["issues"]:
+        result["quality"] = {"action": quality["action"], "issues": quality["issues"]}
+    if emb is not None:
+        result["embedding"] = emb[0]
+    if timings is not None:
+        t7 = time.perf_counter()
+        timings.update(resize=t2 - t1, preprocess=t3 - t2, forward=t4 - t3,
+                       postprocess=(t5 - t4) + (t7 - t6))
+        if views:
+            timings["tta"] = t6 - t5
+    return result, inp
+
+def predict_with_inputs(fileobj, timings=None, top_k=TOP_K, full=False, tta_threshold=None, quality_gate=False):
+    """Like predict_image_bytes, but also returns the decoded image and model input for reuse (shadow scoring).
+
+    If `timings` is a dict it is filled with seconds spent per stage (see STAGES).
+    See decode() for `quality_gate` and predict_decoded() for `tta_threshold`.
+    """
+    img, quality = decode(fileobj, timings, quality_gate)
+    result, inp = predict_decoded(img, timings, top_k, full, tta_threshold, quality)
+    return result, img, inp
+
+def predict_image_bytes(fileobj, timings=None, top_k=TOP_K, full=False):
+    """
+    Accepts a Flask FileStorage or bytes or path.
+    Returns a JSON-serializable dict:
+      { rash_type, confidence_raw, top_k: [{label, score}], model_version[, probs] }
+    """
+    result, _, _ = predict_with_inputs(fileobj, timings=timings, top_k=top_k, full=full)
+    return result
+
+def predict_batch(fileobjs, top_k=TOP_K, full=False):
+    """Score several images with one forward pass; returns one result dict per input."""
+    lm = registry.active()
+    inp = np.concatenate([to_input(_open_image(f), lm.input_size) for f in fileobjs], axis=0)
+    preds = forward(lm.model, inp)
+    return build_results(lm, *postprocess_batch(preds, top_k, lm.temperature), full=full)
@@ -0,0 +1,341 @@
+"""Local load test for the Flask API.
+Run: python loadtest.py --parents 200 --concurrency 8 --duration 30 --json loadtest.json
+
+Seeds a throw-away SQLite database (parents, doctors, babies, skin records,
+conversations, messages, consultations), logs users in through /api/auth/login
+to mint real JWTs, then drives a weighted mix of requests against create_app()
+in-process and reports per-endpoint latency histograms and error rates.
+Nothing touches the network or instance/babyskincare.db.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+PASSWORD = "loadtest-pass"
+# upper bounds (ms) of the latency histogram buckets
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+RASH_TYPES = ["Candidiases", "Chickenpox", "HdMs", "Impetigo", "Ringworm",
+              "diaper_rash", "eczema_rash", "healthy", "heat_rash"]
+
+
+# -------------------------------------------------------------
+# SEEDING
+# -------------------------------------------------------------
+def seed(db, scale, rng):
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from models import User, Baby, SkinRecord, Consultation, Conversation, Message
+
+    # hashing is deliberately slow; every synthetic user shares one hash
+    pw_hash = generate_password_hash(PASSWORD)
+    now = datetime.utcnow()
+
+    users = []
+    for i in range(scale["doctors"]):
+        users.append({"full_name": f"Doctor {i}", "email": f"doctor{i}@load.test", "password_hash": pw_hash,
+                      "role": "doctor", "specialization": rng.choice(["Dermatology", "Pediatrics"]),
+                      "experience": rng.randint(1, 30), "created_at": now})
+    for i in range(scale["parents"]):
+        users.append({"full_name": f"Parent {i}", "email": f"parent{i}@load.test", "password_hash": pw_hash,
+                      "role": "parent", "created_at": now})
+    db.session.execute(insert(User), users)
+    doctor_ids = [u.id for u in User.query.filter_by(role="doctor").all()]
+    parent_ids = [u.id for u in User.query.filter_by(role="parent").all()]
+
+    babies = [{"parent_id": pid, "name": f"Baby {pid}-{j}", "date_of_birth": "2025-01-01"}
+              for pid in parent_ids for j in range(scale["babies_per_parent"])]
+    db.session.execute(insert(Baby), babies)
+    baby_rows = Baby.query.with_entities(Baby.id, Baby.parent_id).all()
+
+    records, consultations = [], []
+    for baby_id, parent_id in baby_rows:
+        for k in range(scale["records_per_baby"]):
+            records.append({"baby_id": baby_id, "created_by_id": parent_id,
+                            "predicted_rash_type": rng.choice(RASH_TYPES),
+                            "confidence_score": round(rng.uniform(40, 99), 2),
+                            "image_path": f"seed_{baby_id}_{k}.jpg",
+                            "created_at": now - timedelta(days=rng.randint(0, 365))})
+        if doctor_ids:
+            consultations.append({"parent_id": parent_id, "doctor_id": rng.choice(doctor_ids), "baby_id": baby_id,
+                                  "date": "2026-01-01", "time": "10:00", "reason": "load test",
+                                  "status": rng.choice(["pending", "accepted", "rejected"]), "created_at": now})
+    if records:
+        db.session.execute(insert(SkinRecord), records)
+    if consultations:
+        db.session.execute(insert(Consultation), consultations)
+
+    convs = []
+    for pid in parent_ids:
+        for did in rng.sample(doctor_ids, min(len(doctor_ids), scale["conversations_per_parent"])):
+            convs.append({"parent_id": pid, "doctor_id": did, "created_at": now})
+    if convs:
+        db.session.execute(insert(Conversation), convs)
+    conv_rows = Conversation.query.with_entities(Conversation.id, Conversation.parent_id,
+                                                 Conversation.doctor_id).all()
+    messages = []
+    for cid, pid, did in conv_rows:
+        for m in range(scale["messages_per_conversation"]):
+            messages.append({"conversation_id": cid, "sender_id": pid if m % 2 else did,
+                             "text": f"message {m}", "read": False, "created_at": now})
+    if messages:
+        db.session.execute(insert(Message), messages)
+    db.session.commit()
+
+    return {
+        "parents": parent_ids, "doctors": doctor_ids,
+        "babies_by_parent": _group(baby_rows),
+        "convs_by_user": _convs_by_user(conv_rows),
+        "counts": {"users": len(users), "babies": len(babies), "records": len(records),
+                   "consultations": len(consultations), "conversations": len(convs), "messages": len(messages)},
+    }
+
+
+def _group(rows):
+    out = defaultdict(list)
+    for child, parent in rows:
+        out[parent].append(child)
+    return out
+
+
+def _convs_by_user(rows):
+    out = defaultdict(list)
+    for cid, pid, did in rows:
+        out[pid].append(cid)
+        out[did].append(cid)
+    return out
+
+
+def mint_tokens(client, user_ids, role, limit):
+    from models import User
+    tokens = {}
+    for uid in user_ids[:limit]:
+        user = User.query.get(uid)
+        resp = client.post("/api/auth/login", json={"email": user.email, "password": PASSWORD})
+        if resp.status_code != 200:
+            raise SystemExit(f"login failed for {user.email}: {resp.status_code} {resp.get_data(as_text=True)}")
+        tokens[uid] = resp.get_json()["access_token"]
+    print(f"minted {len(tokens)} {role} tokens", file=sys.stderr)
+    return tokens
+
+
+# -------------------------------------------------------------
+# TRAFFIC
+# -------------------------------------------------------------
+def _jpeg():
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 150, 140)).save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def build_scenarios(data, parent_tokens, doctor_tokens, with_predict):
+    jpeg = _jpeg() if with_predict else None
+
+    def parent(rng):
+        uid = rng.choice(list(parent_tokens))
+        return uid, {"Authorization": f"Bearer {parent_tokens[uid]}"}
+
+    def doctor(rng):
+        uid = rng.choice(list(doctor_tokens))
+        return uid, {"Authorization": f"Bearer {doctor_tokens[uid]}"}
+
+    def history_all(c, rng):
+        _, h = parent(rng)
+        return c.get("/api/history/", headers=h)
+
+    def history_baby(c, rng):
+        uid, h = parent(rng)
+        babies = data["babies_by_parent"].get(uid) or [0]
+        return c.get(f"/api/history/{rng.choice(babies)}", headers=h)
+
+    def chat_list(c, rng):
+        _, h = parent(rng) if rng.random() < 0.7 else doctor(rng)
+        return c.get("/api/chat/conversations", headers=h)
+
+    def chat_messages(c, rng):
+        uid, h = parent(rng)
+        convs = data["convs_by_user"].get(uid) or [0]
+        return c.get(f"/api/chat/conversations/{rng.choice(convs)}/messages", headers=h)
+
+    def chat_send(c, rng):
+        uid, h = parent(rng)
+        convs = data["convs_by_user"].get(uid) or [0]
+        return c.post(f"/api/chat/conversations/{rng.choice(convs)}/messages", headers=h, json={"text": "hello"})
+
+    def consult_parent(c, rng):
+        _, h = parent(rng)
+        return c.get("/api/consultations/parent", headers=h)
+
+    def consult_doctor(c, rng):
+        _, h = doctor(rng)
+        return c.get("/api/consultations/doctor", headers=h)
+
+    def predict(c, rng):
+        uid, h = parent(rng)
+        babies = data["babies_by_parent"].get(uid) or [0]
+        form = {"file": (io.BytesIO(jpeg), "load.jpg"), "baby_id": str(rng.choice(babies))}
+        return c.post("/predict", headers=h, data=form, content_type="multipart/form-data")
+
+    # (name, weight, fn) - weights roughly follow what the front-end pages fetch
+    scenarios = [
+        ("GET /api/history/", 15, history_all),
+        ("GET /api/history/<baby_id>", 20, history_baby),
+        ("GET /api/chat/conversations", 15, chat_list),
+        ("GET /api/chat/conversations/<id>/messages", 20, chat_messages),
+        ("POST /api/chat/conversations/<id>/messages", 5, chat_send),
+        ("GET /api/consultations/parent", 10, consult_parent),
+        ("GET /api/consultations/doctor", 5, consult_doctor),
+    ]
+    if with_predict:
+        scenarios.append(("POST /predict", 10, predict))
+    return scenarios
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def add(self, name, seconds, status):
+        with self._lock:
+            self.latencies[name].append(seconds)
+            self.statuses[name][status] += 1
+
+    def report(self, wall):
+        import numpy as np
+        out = {}
+        for name, lats in sorted(self.latencies.items()):
+            arr = np.asarray(lats) * 1000
+            statuses = self.statuses[name]
+            total = len(lats)
+            client_err = sum(v for k, v in statuses.items() if 400 <= k < 500)
+            server_err = sum(v for k, v in statuses.items() if k >= 500 or k == 0)
+            hist = {}
+            lower = 0
+            for upper in BUCKETS_MS:
+                hist[f"<={upper}ms"] = int(((arr > lower) & (arr <= upper)).sum()) if lower else int((arr <= upper).sum())
+                lower = upper
+            hist[f">{BUCKETS_MS[-1]}ms"] = int((arr > BUCKETS_MS[-1]).sum())
+            out[name] = {
+                "requests": total,
+                "rps": round(total / wall, 2),
+                "p50_ms": round(float(np.percentile(arr, 50)), 2),
+                "p95_ms": round(float(np.percentile(arr, 95)), 2),
+                "p99_ms": round(float(np.percentile(arr, 99)), 2),
+                "max_ms": round(float(arr.max()), 2),
+                "error_rate": round((client_err + server_err) / total, 4),
+                "client_errors": client_err,
+                "server_errors": server_err,
+                "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+                "histogram": hist,
+            }
+        return out
+
+
+def drive(app, scenarios, concurrency, duration, max_requests, seed_value):
+    stats = Stats()
+    names, weights, fns = zip(*scenarios)
+    deadline = time.perf_counter() + duration
+    counter = {"n": 0}
+    counter_lock = threading.Lock()
+
+    def worker(idx):
+        rng = random.Random(seed_value + idx)
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            with counter_lock:
+                if max_requests and counter["n"] >= max_requests:
+                    return
+                counter["n"] += 1
+            i = rng.choices(range(len(fns)), weights=weights)[0]
+            start = time.perf_counter()
+            try:
+                status = fns[i](client, rng).status_code
+            except Exception:
+                status = 0
+            stats.add(names[i], time.perf_counter() - start, status)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return stats, time.perf_counter() - start
+
+
+def main():
+    p = argparse.ArgumentParser(description="Local load test for the Flask API.")
+    p.add_argument("--parents", type=int, default=100)
+    p.add_argument("--doctors", type=int, default=10)
+    p.add_argument("--babies-per-parent", type=int, default=2)
+    p.add_argument("--records-per-baby", type=int, default=20)
+    p.add_argument("--conversations-per-parent", type=int, default=2)
+    p.add_argument("--messages-per-conversation", type=int, default=20)
+    p.add_argument("--tokens", type=int, default=50, help="users per role to log in")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--duration", type=float, default=20.0, help="seconds")
+    p.add_argument("--max-requests", type=int, default=0)
+    p.add_argument("--no-predict", action="store_true", help="leave /predict out of the mix")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--json", default=None)
+    args = p.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="babyskincare-load-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    # measure the app, not the per-user rate limits
+    os.environ.setdefault("RATE_LIMIT", "0")
+
+    from app import create_app
+    from extensions import db
+
+    app = create_app()
+    rng = random.Random(args.seed)
+    scale = {"parents": args.parents, "doctors": args.doctors, "babies_per_parent": args.babies_per_parent,
+             "records_per_baby": args.records_per_baby, "conversations_per_parent": args.conversations_per_parent,
+             "messages_per_conversation": args.messages_per_conversation}
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        data = seed(db, scale, rng)
+        print(f"seeded {data['counts']} in {time.perf_counter() - started:.1f}s ({workdir})", file=sys.stderr)
+        client = app.test_client()
+        parent_tokens = mint_tokens(client, data["parents"], "parent", args.tokens)
+        doctor_tokens = mint_tokens(client, data["doctors"], "doctor", args.tokens)
+
+    with_predict = not args.no_predict and "predict_bp" in app.blueprints
+    if not args.no_predict and not with_predict:
+        print("predict blueprint not registered (TensorFlow missing?); skipping /predict", file=sys.stderr)
+    scenarios = build_scenarios(data, parent_tokens, doctor_tokens, with_predict)
+
+    stats, wall = drive(app, scenarios, args.concurrency, args.duration, args.max_requests, args.seed)
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "concurrency": args.concurrency,
+        "wall_s": round(wall, 2),
+        "seeded": data["counts"],
+        "total_requests": sum(len(v) for v in stats.latencies.values()),
+        "endpoints": stats.report(wall),
+    }
+    report["total_rps"] = round(report["total_requests"] / wall, 2)
+
+    for name, r in report["endpoints"].items():
+        print(f"{name:<45} n={r['requests']:<6} p50={r['p50_ms']:>8}ms p95={r['p95_ms']:>8}ms "
+              f"p99={r['p99_ms']:>8}ms err={r['error_rate']:.1%}", file=sys.stderr)
+    out = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(out)
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""Asynchronous outbound mail: SQLite outbox + background SMTP workers.
+Run: python mail_queue.py sink [--port 1025]            # local SMTP stand-in that prints what it receives
+     python mail_queue.py send --to a@b.c [--subject s]  # enqueue a test message
+     python mail_queue.py status
+
+Request handlers only insert a row (enqueue / enqueue_digest) and return. Worker
+threads claim due rows, send them over one SMTP connection each (kept open and
+reused between messages, dropped after MAIL_SMTP_IDLE seconds), and reschedule
+failures with exponential backoff until MAIL_MAX_ATTEMPTS. 5xx replies are
+permanent and fail at once. Digest items for a recipient are rolled up into a
+single message once the oldest one is MAIL_DIGEST_WINDOW seconds old.
+
+The outbox is its own SQLite file (instance/mail_outbox.db by default), so it
+survives restarts and is shared by all workers on the host; claims are leased,
+so rows held by a crashed process are picked up again. SMTP settings are the
+MAIL_* keys Flask-Mail is configured with.
+
+create_app() only wires up the producers. The workers are started by the
+server entry points (app.py, manage.py); under a WSGI server set
+MAIL_QUEUE_AUTOSTART=1. CLIs that build an app never send mail themselves.
+"""
+import os
+import time
+import random
+import socket
+import sqlite3
+import logging
+import smtplib
+import argparse
+import threading
+from email.message import EmailMessage
+from email.utils import make_msgid, formatdate
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+OUTBOX_PATH = os.getenv("MAIL_QUEUE_PATH", os.path.join(ROOT, "instance", "mail_outbox.db"))
+WORKERS = int(os.getenv("MAIL_QUEUE_WORKERS", "2"))
+AUTOSTART = os.getenv("MAIL_QUEUE_AUTOSTART", "0") in ("1", "true", "True")
+MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "6"))
+RETRY_BASE = float(os.getenv("MAIL_RETRY_BASE", "30"))
+RETRY_MAX = float(os.getenv("MAIL_RETRY_MAX", "3600"))
+DIGEST_WINDOW = float(os.getenv("MAIL_DIGEST_WINDOW", "600"))
+SMTP_IDLE = float(os.getenv("MAIL_SMTP_IDLE", "60"))
+KEEP_SENT = float(os.getenv("MAIL_KEEP_SENT", str(7 * 86400)))
+LEASE_SECONDS = 120
+CLAIM_BATCH = 10
+POLL_SECONDS = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,                 -- 'message' | 'digest_item'
+    recipient TEXT NOT NULL,
+    subject TEXT,
+    body TEXT NOT NULL,
+    html TEXT,
+    status TEXT NOT NULL,               -- pending | sending | sent | failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox (status, kind, next_attempt_at);
+"""
+
+
+class PermanentError(Exception):
+    pass
+
+
+# -------------------------------------------------------------
+# OUTBOX
+# -------------------------------------------------------------
+class Outbox:
+    def __init__(self, path=OUTBOX_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, kind, recipient, subject, body, html=None, delay=0.0):
+        now = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO outbox (kind, recipient, subject, body, html, status, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)",
+            (kind, recipient, subject, body, html, now + delay, now))
+        return cur.lastrowid
+
+    def claim(self, limit=CLAIM_BATCH):
+        """Roll up due digests, then lease up to `limit` due messages to the caller."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._roll_up_digests(conn, now)
+            rows = conn.execute(
+                "SELECT id, recipient, subject, body, html, attempts FROM outbox "
+                "WHERE kind = 'message' AND ((status = 'pending' AND next_attempt_at <= ?) "
+                "   OR (status = 'sending' AND lease_until < ?)) "
+                "ORDER BY next_attempt_at LIMIT ?", (now, now, limit)).fetchall()
+            if rows:
+                conn.executemany("UPDATE outbox SET status = 'sending', lease_until = ? WHERE id = ?",
+                                 [(now + LEASE_SECONDS, r[0]) for r in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _roll_up_digests(self, conn, now):
+        due = conn.execute(
+            "SELECT recipient FROM outbox WHERE kind = 'digest_item' AND status = 'pending' "
+            "GROUP BY recipient HAVING MIN(created_at) <= ?", (now - DIGEST_WINDOW,)).fetchall()
+        for (recipient,) in due:
+            items = conn.execute(
+                "SELECT id, subject, body FROM outbox WHERE kind = 'digest_item' AND status = 'pending' "
+                "AND recipient = ? ORDER BY created_at", (recipient,)).fetchall()
+            if len(items) == 1:
+                subject = items[0][1] or "Notification"
+                body = items[0][2]
+            else:
+                subject = f"{len(items)} new notifications"
+                body = "\n\n".join(f"- {s}\n  {b}" if s else f"- {b}" for _, s, b in items)
+            conn.execute(
+                "INSERT INTO outbox (kind, recipient, subject, body, status, next_attempt_at, created_at) "
+                "VALUES ('message', ?, ?, ?, 'pending', ?, ?)", (recipient, subject, body, now, now))
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i, _, _ in items])
+
+    def mark_sent(self, msg_id):
+        self._conn().execute("UPDATE outbox SET status = 'sent', sent_at = ?, lease_until = NULL, last_error = NULL "
+                             "WHERE id = ?", (time.time(), msg_id))
+
+    def mark_failed(self, msg_id, attempts, error, permanent=False):
+        attempts += 1
+        if permanent or attempts >= MAX_ATTEMPTS:
+            self._conn().execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ?, "
+                                 "lease_until = NULL WHERE id = ?", (attempts, error[:500], msg_id))
+            return False
+        delay = min(RETRY_MAX, RETRY_BASE * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+        self._conn().execute("UPDATE outbox SET status = 'pending', attempts = ?, last_error = ?, "
+                             "next_attempt_at = ?, lease_until = NULL WHERE id = ?",
+                             (attempts, error[:500], time.time() + delay, msg_id))
+        return True
+
+    def depth(self):
+        """{(status,): count} plus pending digest items, for the queue-depth gauge."""
+        rows = self._conn().execute(
+            "SELECT CASE WHEN kind = 'digest_item' THEN 'digest_item' ELSE status END, COUNT(*) "
+            "FROM outbox GROUP BY 1").fetchall()
+        return {(status,): n for status, n in rows}
+
+    def purge_sent(self, older_than=KEEP_SENT):
+        self._conn().execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?",
+                             (time.time() - older_than,))
+
+
+# -------------------------------------------------------------
+# SMTP WORKERS
+# -------------------------------------------------------------
+class _SMTPSession:
+    """One reusable SMTP connection owned by a single worker thread."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.smtp = None
+        self.last_used = 0.0
+
+    def _open(self):
+        cfg = self.cfg
+        cls = smtplib.SMTP_SSL if cfg["use_ssl"] else smtplib.SMTP
+        smtp = cls(cfg["server"], cfg["port"], timeout=cfg["timeout"])
+        if cfg["use_tls"] and not cfg["use_ssl"]:
+            smtp.starttls()
+        if cfg["username"]:
+            smtp.login(cfg["username"], cfg["password"] or "")
+        return smtp
+
+    def send(self, msg):
+        if self.smtp is not None and time.monotonic() - self.last_used > SMTP_IDLE:
+            self.close()
+        for attempt in (0, 1):
+            if self.smtp is None:
+                self.smtp = self._open()
+            try:
+                self.smtp.send_message(msg)
+                self.last_used = time.monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout):
+                # the server dropped an idle connection: reconnect once and retry
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+            self.smtp = None
+
+
+class MailDispatcher:
+    def __init__(self, outbox=None, workers=WORKERS):
+        self.outbox = outbox
+        self.workers = workers
+        self.cfg = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def configure(self, config):
+        self.cfg = {
+            "server": config.get("MAIL_SERVER") or "localhost",
+            "port": int(config.get("MAIL_PORT") or 25),
+            "use_tls": bool(config.get("MAIL_USE_TLS")),
+            "use_ssl": bool(config.get("MAIL_USE_SSL")),
+            "username": config.get("MAIL_USERNAME"),
+            "password": config.get("MAIL_PASSWORD"),
+            "sender": config.get("MAIL_DEFAULT_SENDER") or config.get("MAIL_USERNAME") or "no-reply@localhost",
+            "timeout": float(config.get("MAIL_TIMEOUT", 30)),
+        }
+        if self.outbox is None:
+            self.outbox = Outbox(config.get("MAIL_QUEUE_PATH", OUTBOX_PATH))
+
+    # ------------------ PRODUCERS ------------------
+    def enqueue(self, to, subject, body, html=None):
+        """Queue one email; returns its outbox id. Never touches the network."""
+        msg_id = self.outbox.add("message", to, subject, body, html)
+        self._wake.set()
+        return msg_id
+
+    def enqueue_digest(self, to, subject, body):
+        """Queue a notification line; lines per recipient go out together as one digest email."""
+        return self.outbox.add("digest_item", to, subject, body)
+
+    # ------------------ WORKERS ------------------
+    def start(self):
+        with self._lock:
+            if self._threads or self.workers <= 0:
+                return
+            self._stop.clear()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"mail-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            logger.info("Mail dispatcher started: %d workers, outbox %s", self.workers, self.outbox.path)
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _build(self, recipient, subject, body, html):
+        msg = EmailMessage()
+        msg["From"] = self.cfg["sender"]
+        msg["To"] = recipient
+        msg["Subject"] = subject or ""
+        msg["Date"] = formatdate(localtime=True)
+        msg["Message-ID"] = make_msgid()
+        msg.set_content(body)
+        if html:
+            msg.add_alternative(html, subtype="html")
+        return msg
+
+    def _run(self):
+        from metrics import metrics
+        session = _SMTPSession(self.cfg)
+        try:
+            while not self._stop.is_set():
+                try:
+                    rows = self.outbox.claim()
+                except sqlite3.OperationalError:
+                    logger.warning("Outbox busy; retrying", exc_info=True)
+                    rows = []
+                if not rows:
+                    if session.smtp is not None and time.monotonic() - session.last_used > SMTP_IDLE:
+                        session.close()
+                    if time.monotonic() - self._purged_at > 3600:
+                        self._purged_at = time.monotonic()
+                        self.outbox.purge_sent()
+                    self._wake.wait(POLL_SECONDS)
+                    self._wake.clear()
+                    continue
+                for msg_id, recipient, subject, body, html, attempts in rows:
+                    started = time.perf_counter()
+                    try:
+                        session.send(self._build(recipient, subject, body, html))
+                        self.outbox.mark_sent(msg_id)
+                        metrics.mail_sent.inc("sent")
+                        metrics.mail_send_seconds.observe(time.perf_counter() - started)
+                    except Exception as e:
+                        permanent = isinstance(e, (smtplib.SMTPRecipientsRefused, PermanentError)) or (
+                            isinstance(e, smtplib.SMTPResponseException) and 500 <= e.smtp_code < 600)
+                        if not isinstance(e, smtplib.SMTPResponseException):
+                            session.close()
+                        retried = self.outbox.mark_failed(msg_id, attempts, repr(e), permanent)
+                        metrics.mail_sent.inc("retry" if retried else "failed")
+                        logger.warning("Mail %s to %s failed (attempt %d, %s): %s", msg_id, recipient,
+                                       attempts + 1, "will retry" if retried else "giving up", e)
+        finally:
+            session.close()
+
+
+dispatcher = MailDispatcher()
+
+
+def enqueue(to, subject, body, html=None):
+    return dispatcher.enqueue(to, subject, body, html)
+
+
+def enqueue_digest(to, subject, body):
+    return dispatcher.enqueue_digest(to, subject, body)
+
+
+def init_mail_queue(app, start=AUTOSTART):
+    from metrics import metrics
+    dispatcher.configure(app.config)
+    if not any(m.name == "mail_queue_depth" for m in metrics._metrics):
+        metrics.gauge("mail_queue_depth", "Outbox rows by status", dispatcher.outbox.depth, ("status",))
+    if start:
+        dispatcher.start()
+
+
+# -------------------------------------------------------------
+# CLI / LOCAL SMTP STAND-IN
+# -------------------------------------------------------------
+def run_sink(host, port):
+    """Minimal SMTP server that accepts everything and prints it (for local testing)."""
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def reply(line):
+                self.wfile.write((line + "\r\n").encode())
+            reply("220 sink ready")
+            data, in_data = [], False
+            for raw in self.rfile:
+                line = raw.decode("utf-8", "replace").rstrip("\r\n")
+                if in_data:
+                    if line == ".":
+                        in_data = False
+                        print("----- message -----\n" + "\n".join(data) + "\n-------------------", flush=True)
+                        data = []
+                        reply("250 OK queued")
+                    else:
+                        data.append(line[1:] if line.startswith("..") else line)
+                    continue
+                cmd = line[:4].upper()
+                if cmd in ("HELO", "EHLO"):
+                    reply("250 sink")
+                elif cmd == "DATA":
+                    in_data = True
+                    reply("354 end with <CRLF>.<CRLF>")
+                elif cmd == "QUIT":
+                    reply("221 bye")
+                    return
+                else:
+                    reply("250 OK")
+
+    class Server(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    with Server((host, port), Handler) as srv:
+        print(f"SMTP sink listening on {host}:{port}", flush=True)
+        srv.serve_forever()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Outbound mail queue")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("sink", help="run a local SMTP stand-in")
+    s.add_argument("--host", default="127.0.0.1")
+    s.add_argument("--port", type=int, default=1025)
+    e = sub.add_parser("send", help="enqueue a test message")
+    e.add_argument("--to", required=True)
+    e.add_argument("--subject", default="Test message")
+    e.add_argument("--body", default="Sent through the mail queue.")
+    sub.add_parser("status", help="outbox depth by status")
+    args = ap.parse_args()
+
+    if args.cmd == "sink":
+        run_sink(args.host, args.port)
+        return
+    outbox = Outbox()
+    if args.cmd == "send":
+        print("queued", outbox.add("message", args.to, args.subject, args.body))
+    for (status,), n in sorted(outbox.depth().items()):
+        print(f"{status:12s} {n}")
+
+
+if __name__ == "__main__":
+    main()
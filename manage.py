@@ -5,4 +5,6 @@ app = create_app()
 migrate.init_app(app, db)
 
 if __name__ == "__main__":
+    from mail_queue import dispatcher
+    dispatcher.start()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,316 @@
+"""In-process metrics with a Prometheus text endpoint (/metrics).
+
+Hot-path updates never take a lock: every thread writes to its own shard
+(a plain dict reached through threading.local) and only the scrape walks and
+sums the shards. A lock is taken once per thread, when its shard is created,
+and once more when the thread exits and its shard is folded into a running total.
+
+    from metrics import metrics
+    metrics.cache("doctor_directory", hit=True)
+    metrics.inference_stages({"decode": 0.004, "forward": 0.081})
+"""
+import time
+import bisect
+import logging
+import weakref
+import threading
+
+from flask import g, request, has_request_context, Response
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    esc = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in esc) + "}"
+
+
+def _fmt_num(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _ShardRef:
+    """Per-thread handle on a shard; when its thread ends it is collected and the shard folded away."""
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class _Sharded:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}     # totals of shards whose threads have exited
+        # reentrant: a shard can be retired by garbage collection on a thread already holding the lock
+        self._lock = threading.RLock()
+
+    def _shard(self):
+        ref = getattr(self._local, "ref", None)
+        if ref is None:
+            shard = {}
+            ref = self._local.ref = _ShardRef(shard)
+            with self._lock:
+                self._shards.append(shard)
+            weakref.finalize(ref, self._retire, shard)
+        return ref.shard
+
+    def _retire(self, shard):
+        # keeps the shard list as long as the set of live threads, however many come and go
+        with self._lock:
+            self._fold(self._retired, shard)
+            self._shards = [s for s in self._shards if s is not shard]
+
+    def _fold(self, into, snap):
+        raise NotImplementedError
+
+    def _merged(self):
+        with self._lock:
+            shards = list(self._shards)
+            total = {}
+            self._fold(total, self._retired)
+        # dict.copy() is a single C call, so it is consistent even while the owner thread writes
+        for snap in [s.copy() for s in shards]:
+            self._fold(total, snap)
+        return total
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _fold(self, into, snap):
+        for k, v in snap.items():
+            into[k] = into.get(k, 0) + v
+
+    def values(self):
+        return self._merged()
+
+    def render(self):
+        for labels, v in sorted(self.values().items()):
+            yield f"{self.name}{_fmt_labels(self.labelnames, labels)} {_fmt_num(v)}"
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        row = shard.get(labels)
+        if row is None:
+            # [per-bucket counts..., +Inf count, sum]
+            row = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[labels] = row
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def _fold(self, into, snap):
+        for k, row in snap.items():
+            row = list(row)
+            acc = into.setdefault(k, [0] * len(row))
+            for i, v in enumerate(row):
+                acc[i] += v
+
+    def render(self):
+        for labels, row in sorted(self._merged().items()):
+            cumulative = 0
+            for i, upper in enumerate(self.buckets + (float("inf"),)):
+                cumulative += row[i]
+                le = [("le", _fmt_num(float(upper)) if upper != float("inf") else "+Inf")]
+                yield f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {_fmt_num(row[-1])}"
+            yield f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Gauge:
+    """Value computed at scrape time: fn() -> {label_tuple: value} or a plain number."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            logger.warning("Gauge %s failed", self.name, exc_info=True)
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, v in sorted(value.items()):
+            yield f"{self.name}{_fmt_labels(self.labelnames, labels)} {_fmt_num(v)}"
+
+
+class Metrics:
+    def __init__(self):
+        self._metrics = []
+        self.requests = self.counter("http_requests_total", "HTTP requests",
+                                     ("blueprint", "endpoint", "method", "status"))
+        self.latency = self.histogram("http_request_duration_seconds", "HTTP request latency",
+                                      ("blueprint", "endpoint"))
+        self.stages = self.histogram("inference_stage_seconds", "Time per inference stage", ("stage",))
+        self.quality_gate = self.counter("image_quality_gate_total", "Image quality gate outcomes", ("action",))
+        self.db_queries = self.counter("db_queries_total", "SQL statements executed", ("endpoint",))
+        self.db_seconds = self.counter("db_query_seconds_total", "Time spent in SQL", ("endpoint",))
+        self.db_per_request = self.histogram("db_queries_per_request", "SQL statements per request",
+                                             ("endpoint",), buckets=COUNT_BUCKETS)
+        self.cache_lookups = self.counter("cache_lookups_total", "Cache lookups", ("cache", "result"))
+        self.mail_sent = self.counter("mail_deliveries_total", "Outbound mail delivery attempts", ("result",))
+        self.admission = self.counter("admission_total", "Admission control decisions", ("budget", "outcome"))
+        self.events = self.counter("events_total", "Bus events by outcome", ("type", "outcome"))
+        self.mail_send_seconds = self.histogram("mail_send_seconds", "SMTP time per delivered message")
+        self.gauge("cache_hit_ratio", "Hit ratio per cache since start", self._hit_ratios, ("cache",))
+
+    # ------------------ REGISTRATION ------------------
+    def counter(self, name, help_text, labelnames=()):
+        m = Counter(name, help_text, labelnames)
+        self._metrics.append(m)
+        return m
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        m = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(m)
+        return m
+
+    def gauge(self, name, help_text, fn, labelnames=()):
+        m = Gauge(name, help_text, fn, labelnames)
+        self._metrics.append(m)
+        return m
+
+    # ------------------ HELPERS ------------------
+    def cache(self, name, hit):
+        self.cache_lookups.inc(name, "hit" if hit else "miss")
+
+    def inference_stages(self, timings):
+        for stage, seconds in timings.items():
+            self.stages.observe(seconds, stage)
+
+    def _hit_ratios(self):
+        totals = {}
+        for (cache, result), v in self.cache_lookups.values().items():
+            hits, all_ = totals.get(cache, (0, 0))
+            totals[cache] = (hits + (v if result == "hit" else 0), all_ + v)
+        return {(c,): round(h / n, 4) for c, (h, n) in totals.items() if n}
+
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# -------------------------------------------------------------
+# FLASK / SQLALCHEMY WIRING
+# -------------------------------------------------------------
+def _endpoint_labels():
+    rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    return request.blueprint or "app", rule
+
+
+def _model_state():
+    from model_registry import registry
+    active = registry.peek()
+    loading = registry.loading
+    return {
+        ("active", active.version if active else ""): 1 if active else 0,
+        ("loading", loading or ""): 1 if loading else 0,
+    }
+
+
+_query_hooks = []
+
+
+def add_query_hook(fn):
+    """Call fn(statement, parameters, executemany, seconds) after every SQL statement.
+
+    Shares the one pair of Engine cursor listeners installed here, so statements
+    are timed once however many consumers there are (e.g. sql_profiler).
+    """
+    _install_db_listeners()
+    if fn not in _query_hooks:
+        _query_hooks.append(fn)
+
+
+def _install_db_listeners():
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    if event.contains(Engine, "after_cursor_execute", _after_execute):
+        return
+    event.listen(Engine, "before_cursor_execute", _before_execute)
+    event.listen(Engine, "after_cursor_execute", _after_execute)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_metrics_t0", []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get("_metrics_t0")
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    if has_request_context() and hasattr(g, "_db_queries"):
+        g._db_queries += 1
+        g._db_seconds += elapsed
+    for hook in _query_hooks:
+        try:
+            hook(statement, parameters, executemany, elapsed)
+        except Exception:
+            logger.warning("Query hook %s failed", getattr(hook, "__name__", hook), exc_info=True)
+
+
+def init_metrics(app):
+    _install_db_listeners()
+    if not any(m.name == "model_state" for m in metrics._metrics):
+        metrics.gauge("model_state", "Model registry state (1 = true)", _model_state, ("state", "version"))
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+        g._db_queries = 0
+        g._db_seconds = 0.0
+
+    @app.after_request
+    def _record_request(resp):
+        start = getattr(g, "_metrics_start", None)
+        if start is None:
+            return resp
+        blueprint, endpoint = _endpoint_labels()
+        metrics.requests.inc(blueprint, endpoint, request.method, resp.status_code)
+        metrics.latency.observe(time.perf_counter() - start, blueprint, endpoint)
+        metrics.db_per_request.observe(g._db_queries, endpoint)
+        if g._db_queries:
+            metrics.db_queries.inc(endpoint, amount=g._db_queries)
+            metrics.db_seconds.inc(endpoint, amount=g._db_seconds)
+        return resp
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,26 @@
+"""skin_records.model_version
+
+Revision ID: a3c91f2d7b10
+Revises: <REVISION_ID>
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c91f2d7b10'
+down_revision = '<REVISION_ID>'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('skin_records') as batch_op:
+        batch_op.add_column(sa.Column('model_version', sa.String(64)))
+
+
+def downgrade():
+    with op.batch_alter_table('skin_records') as batch_op:
+        batch_op.drop_column('model_version')
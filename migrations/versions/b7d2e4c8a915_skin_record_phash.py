@@ -0,0 +1,28 @@
+"""skin_records.phash
+
+Revision ID: b7d2e4c8a915
+Revises: a3c91f2d7b10
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e4c8a915'
+down_revision = 'a3c91f2d7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('skin_records') as batch_op:
+        batch_op.add_column(sa.Column('phash', sa.String(16)))
+        batch_op.create_index('ix_skin_records_baby_id_id', ['baby_id', 'id'])
+
+
+def downgrade():
+    with op.batch_alter_table('skin_records') as batch_op:
+        batch_op.drop_index('ix_skin_records_baby_id_id')
+        batch_op.drop_column('phash')
@@ -0,0 +1,43 @@
+"""baby rash analytics tables
+
+Revision ID: c4f81a2b6d37
+Revises: b7d2e4c8a915
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f81a2b6d37'
+down_revision = 'b7d2e4c8a915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'baby_rash_summary',
+        sa.Column('baby_id', sa.Integer(), sa.ForeignKey('babies.id'), primary_key=True),
+        sa.Column('rash_type', sa.String(120), primary_key=True),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('confidence_sum', sa.Float(), nullable=False),
+        sa.Column('confidence_ewma', sa.Float()),
+        sa.Column('first_seen', sa.DateTime()),
+        sa.Column('last_seen', sa.DateTime())
+    )
+
+    op.create_table(
+        'baby_rash_weekly',
+        sa.Column('baby_id', sa.Integer(), sa.ForeignKey('babies.id'), primary_key=True),
+        sa.Column('week_start', sa.String(10), primary_key=True),
+        sa.Column('rash_type', sa.String(120), primary_key=True),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('confidence_sum', sa.Float(), nullable=False)
+    )
+
+
+def downgrade():
+    op.drop_table('baby_rash_weekly')
+    op.drop_table('baby_rash_summary')
@@ -0,0 +1,31 @@
+"""consultations.record_id
+
+Revision ID: d5e2a7c91f48
+Revises: c4f81a2b6d37
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e2a7c91f48'
+down_revision = 'c4f81a2b6d37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the initial schema already has the column; only databases created from the models lack it
+    columns = {c['name'] for c in sa.inspect(op.get_bind()).get_columns('consultations')}
+    if 'record_id' in columns:
+        return
+    with op.batch_alter_table('consultations') as batch_op:
+        batch_op.add_column(sa.Column('record_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_consultations_record_id', 'skin_records', ['record_id'], ['id'])
+
+
+def downgrade():
+    # left in place: on migrated databases the column belongs to the initial schema
+    pass
@@ -0,0 +1,294 @@
+"""Versioned model store with zero-downtime reload.
+
+Layout (MODEL_REGISTRY_DIR, default ./model_store):
+    model_store/
+        CURRENT                      <- name of the version workers should serve
+        2025-11-20_01/
+            unified_model.keras
+            class_index_to_label.json
+            calibration.json         <- optional {"temperature": T} for temperature scaling
+
+Publish a trained model:  python model_registry.py publish unified_model.keras [--activate]
+List versions:            python model_registry.py list
+
+When the store is empty the legacy unified_model.keras / class_index_to_label.json
+next to the app are served as version "legacy", so existing deployments keep working.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+REGISTRY_DIR = os.getenv("MODEL_REGISTRY_DIR", os.path.join(ROOT, "model_store"))
+MODEL_FILE = "unified_model.keras"
+LABELS_FILE = "class_index_to_label.json"
+CALIBRATION_FILE = "calibration.json"     # optional: {"temperature": 1.3}
+CURRENT_FILE = "CURRENT"
+LEGACY_VERSION = "legacy"
+
+
+def load_labels(path):
+    """index -> label list from class_index_to_label.json (either orientation)."""
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            d = json.load(f)
+        if all(str(k).isdigit() for k in d.keys()):
+            mapping = {int(k): v for k, v in d.items()}
+            return [mapping[i] for i in sorted(mapping.keys())]
+        # if it's label->index, invert
+        inv = {int(v): k for k, v in d.items()}
+        return [inv[i] for i in sorted(inv.keys())]
+    except Exception:
+        return []
+
+
+class LoadedModel:
+    """An immutable, warmed model version. Requests keep a reference for their whole lifetime."""
+
+    def __init__(self, version, model, class_names, input_size, path, temperature=1.0, embedder=None):
+        self.version = version
+        self.model = model
+        # same graph with two outputs: [pooled backbone features, class outputs]; None if not found
+        self.embedder = embedder
+        self.class_names = class_names
+        self.input_size = input_size
+        self.path = path
+        self.temperature = temperature
+        self.loaded_at = datetime.utcnow()
+
+    def label(self, idx):
+        if self.class_names and idx < len(self.class_names):
+            return self.class_names[idx]
+        return f"label_{idx}"
+
+
+class ModelRegistry:
+    def __init__(self, root=REGISTRY_DIR):
+        self.root = root
+        self._active = None                   # swapped by a single assignment; readers never lock
+        self._load_lock = threading.Lock()    # serialises loaders only
+        self._loading = None
+        self._last_error = None
+        self._failed_version = None
+        self._watcher = None
+
+    # ------------------ DISCOVERY ------------------
+    def versions(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, d, MODEL_FILE)))
+
+    def current_version(self):
+        """Version named in CURRENT, else the newest directory, else the legacy files."""
+        try:
+            with open(os.path.join(self.root, CURRENT_FILE), "r", encoding="utf-8") as f:
+                name = f.read().strip()
+            if name in self.versions():
+                return name
+        except OSError:
+            pass
+        versions = self.versions()
+        return versions[-1] if versions else LEGACY_VERSION
+
+    def _paths(self, version):
+        if version == LEGACY_VERSION:
+            return os.path.join(ROOT, MODEL_FILE), os.path.join(ROOT, LABELS_FILE)
+        vdir = os.path.join(self.root, version)
+        return os.path.join(vdir, MODEL_FILE), os.path.join(vdir, LABELS_FILE)
+
+    # ------------------ LOADING ------------------
+    def load(self, version):
+        """Load and warm a version without activating it."""
+        import numpy as np
+        import tensorflow as tf
+
+        model_path, labels_path = self._paths(version)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Model not found at {model_path}")
+        started = time.perf_counter()
+        model = tf.keras.models.load_model(model_path)
+        input_size = (224, 224)
+        try:
+            ishape = model.input_shape
+            if ishape and len(ishape) == 4:
+                _, h, w, _ = ishape
+                input_size = (int(h) or 224, int(w) or 224)
+        except Exception:
+            pass
+        # warm-up: the first call traces the graph, do it here instead of on a user's request
+        zeros = np.zeros((1, input_size[0], input_size[1], 3), dtype=np.float32)
+        model.predict(zeros, verbose=0)
+        embedder = self._embedder(model)
+        if embedder is not None:
+            embedder.predict(zeros, verbose=0)
+        lm = LoadedModel(version, model, load_labels(labels_path), input_size, model_path,
+                         temperature=self._temperature(version), embedder=embedder)
+        logger.info("Loaded model version %s in %.2fs", version, time.perf_counter() - started)
+        return lm
+
+    @staticmethod
+    def _embedder(model):
+        import tensorflow as tf
+        pool = next((layer for layer in model.layers
+                     if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D)), None)
+        if pool is None:
+            return None
+        try:
+            return tf.keras.Model(model.inputs, [pool.output, model.output])
+        except Exception:
+            logger.warning("Could not expose pooled features of %s", model.name, exc_info=True)
+            return None
+
+    @property
+    def loading(self):
+        """Version currently being loaded, if any."""
+        return self._loading
+
+    def _temperature(self, version):
+        if version == LEGACY_VERSION:
+            return 1.0
+        try:
+            with open(os.path.join(self.root, version, CALIBRATION_FILE), "r", encoding="utf-8") as f:
+                return float(json.load(f).get("temperature", 1.0)) or 1.0
+        except (OSError, ValueError):
+            return 1.0
+
+    def peek(self):
+        """The active version, or None; never triggers a load."""
+        return self._active
+
+    def active(self):
+        lm = self._active
+        if lm is not None:
+            return lm
+        with self._load_lock:
+            if self._active is None:
+                self._active = self.load(self.current_version())
+            return self._active
+
+    def activate(self, version, background=False):
+        """Load + warm `version`, then swap it in. In-flight requests finish on the old version."""
+        if version != LEGACY_VERSION and version not in self.versions():
+            raise ValueError(f"Unknown model version: {version}")
+
+        def _run():
+            with self._load_lock:
+                self._loading = version
+                try:
+                    lm = self.load(version)
+                    self._active = lm
+                    self._last_error = None
+                    self._failed_version = None
+                    logger.info("Model version %s is now active", version)
+                except Exception as e:
+                    self._last_error = f"{version}: {e}"
+                    self._failed_version = version
+                    logger.exception("Loading model version %s failed; keeping current", version)
+                finally:
+                    self._loading = None
+
+        if background:
+            threading.Thread(target=_run, name=f"model-load-{version}", daemon=True).start()
+        else:
+            _run()
+
+    def set_current(self, version):
+        """Point CURRENT at `version` so every worker's watcher picks it up."""
+        os.makedirs(self.root, exist_ok=True)
+        tmp = os.path.join(self.root, CURRENT_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(tmp, os.path.join(self.root, CURRENT_FILE))
+
+    def status(self):
+        lm = self._active
+        return {
+            "active": lm.version if lm else None,
+            "loaded_at": lm.loaded_at.isoformat() if lm else None,
+            "current": self.current_version(),
+            "loading": self._loading,
+            "last_error": self._last_error,
+            "versions": self.versions(),
+        }
+
+    # ------------------ WATCHER ------------------
+    def start_watcher(self, interval=10.0):
+        if self._watcher is not None:
+            return
+
+        def _watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    lm = self._active
+                    target = self.current_version()
+                    # don't retry a version that already failed until CURRENT changes again
+                    if (lm is not None and target != lm.version and self._loading is None
+                            and target != self._failed_version):
+                        logger.info("CURRENT changed %s -> %s; reloading", lm.version, target)
+                        self.activate(target)
+                except Exception:
+                    logger.warning("Model watcher iteration failed", exc_info=True)
+
+        self._watcher = threading.Thread(target=_watch, name="model-watcher", daemon=True)
+        self._watcher.start()
+
+    # ------------------ PUBLISHING ------------------
+    def publish(self, model_path, labels_path, version=None):
+        version = version or datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        vdir = os.path.join(self.root, version)
+        if os.path.exists(vdir):
+            raise ValueError(f"Version {version} already exists")
+        tmp = vdir + ".tmp"
+        os.makedirs(tmp)
+        shutil.copy2(model_path, os.path.join(tmp, MODEL_FILE))
+        shutil.copy2(labels_path, os.path.join(tmp, LABELS_FILE))
+        os.replace(tmp, vdir)
+        return version
+
+
+registry = ModelRegistry()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Manage versioned models.")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    pub = sub.add_parser("publish")
+    pub.add_argument("model")
+    pub.add_argument("--labels", default=os.path.join(ROOT, LABELS_FILE))
+    pub.add_argument("--version", default=None)
+    pub.add_argument("--activate", action="store_true", help="also point CURRENT at the new version")
+    act = sub.add_parser("activate")
+    act.add_argument("version")
+    sub.add_parser("list")
+    args = p.parse_args()
+
+    if args.cmd == "publish":
+        version = registry.publish(args.model, args.labels, args.version)
+        print("Published version", version)
+        if args.activate:
+            registry.set_current(version)
+            print("CURRENT ->", version)
+    elif args.cmd == "activate":
+        if args.version not in registry.versions():
+            raise SystemExit(f"Unknown version {args.version}")
+        registry.set_current(args.version)
+        print("CURRENT ->", args.version)
+    else:
+        current = registry.current_version()
+        for v in registry.versions() or [LEGACY_VERSION]:
+            print(("* " if v == current else "  ") + v)
+
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,7 @@ class Baby(db.Model):
 # ================================
 class SkinRecord(db.Model):
     __tablename__ = "skin_records"
+    __table_args__ = (db.Index("ix_skin_records_baby_id_id", "baby_id", "id"),)
 
     id = db.Column(db.Integer, primary_key=True)
     baby_id = db.Column(db.Integer, db.ForeignKey("babies.id"), nullable=False)
@@ -61,12 +62,39 @@ class SkinRecord(db.Model):
     predicted_rash_type = db.Column(db.String(120))
     confidence_score = db.Column(db.Float)
     image_path = db.Column(db.String(255))
+    model_version = db.Column(db.String(64))
+    phash = db.Column(db.String(16))  # 64-bit perceptual hash (hex), see image_hash.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     baby = db.relationship("Baby", backref="skin_records")
     created_by = db.relationship("User", backref="created_records", foreign_keys=[created_by_id])
 
 
+# ================================
+# RASH ANALYTICS (materialized, see rash_analytics.py)
+# ================================
+class BabyRashSummary(db.Model):
+    __tablename__ = "baby_rash_summary"
+
+    baby_id = db.Column(db.Integer, db.ForeignKey("babies.id"), primary_key=True)
+    rash_type = db.Column(db.String(120), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    confidence_sum = db.Column(db.Float, nullable=False, default=0.0)
+    confidence_ewma = db.Column(db.Float)
+    first_seen = db.Column(db.DateTime)
+    last_seen = db.Column(db.DateTime)
+
+
+class BabyRashWeekly(db.Model):
+    __tablename__ = "baby_rash_weekly"
+
+    baby_id = db.Column(db.Integer, db.ForeignKey("babies.id"), primary_key=True)
+    week_start = db.Column(db.String(10), primary_key=True)  # ISO date of the Monday
+    rash_type = db.Column(db.String(120), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    confidence_sum = db.Column(db.Float, nullable=False, default=0.0)
+
+
 # ================================
 # RASH TYPES / CARE TIPS
 # ================================
@@ -111,6 +139,8 @@ class Consultation(db.Model):
     parent_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     doctor_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     baby_id = db.Column(db.Integer, db.ForeignKey("babies.id"))
+    # the scan the parent asked about; NULL for consultations booked for the baby as a whole
+    record_id = db.Column(db.Integer, db.ForeignKey("skin_records.id"), nullable=True)
 
     date = db.Column(db.String(30))
     time = db.Column(db.String(30))
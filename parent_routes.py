@@ -1,30 +1,96 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from extensions import db
-from models import Baby, SkinRecord, Consultation, User
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from models import Baby, SkinRecord, Consultation, User, BabyRashSummary
+from doctor_directory import directory
+from rash_analytics import baby_summary, baby_trends
+from events import publish
+from retention import thumb_urls
 
 parent_bp = Blueprint("parent_bp", __name__, url_prefix="/api/parent")
 
 
+DASHBOARD_FIELDS = ("babies", "records", "consultations", "doctors", "summary")
+
+
 @parent_bp.route("/dashboard", methods=["GET"])
 @jwt_required()
 def dashboard():
+    """Everything the parent dashboard shows, in one round trip and a fixed number of queries.
+
+    ?fields=babies,records,consultations,doctors,summary picks sections (default: babies,consultations);
+    ?records_per_baby=N (default 5) caps the latest scans returned per baby.
+    """
     identity = get_jwt_identity()
     if identity is None:
         return jsonify({"error": "Unauthorized"}), 401
     user_id = int(identity)
 
-    babies = Baby.query.filter_by(parent_id=user_id).all()
-    babies_data = [{"id": b.id, "name": b.name, "dob": b.date_of_birth} for b in babies]
-
-    consultations = (Consultation.query
-                     .filter(Consultation.parent_id == user_id)
-                     .order_by(Consultation.created_at.desc())
-                     .limit(10).all())
-    cons = [{"id": c.id, "doctor_id": c.doctor_id, "baby_id": c.baby_id,
-             "status": c.status, "date": c.date, "time": c.time} for c in consultations]
-
-    return jsonify({"babies": babies_data, "consultations": cons}), 200
+    fields = [f.strip() for f in request.args.get("fields", "babies,consultations").split(",") if f.strip()]
+    unknown = [f for f in fields if f not in DASHBOARD_FIELDS]
+    if unknown:
+        return jsonify({"error": f"unknown fields: {', '.join(unknown)}", "allowed": list(DASHBOARD_FIELDS)}), 400
+    out = {}
+
+    if "babies" in fields:
+        babies = Baby.query.filter_by(parent_id=user_id).order_by(Baby.id).all()
+        out["babies"] = [{"id": b.id, "name": b.name, "dob": b.date_of_birth} for b in babies]
+
+    if "records" in fields:
+        # latest N scans of every baby in one query: row_number() per baby, newest first
+        n = min(max(request.args.get("records_per_baby", 5, type=int), 1), 50)
+        rn = func.row_number().over(partition_by=SkinRecord.baby_id,
+                                    order_by=(SkinRecord.created_at.desc(), SkinRecord.id.desc())).label("rn")
+        ranked = (db.session.query(SkinRecord.id, SkinRecord.baby_id, SkinRecord.predicted_rash_type,
+                                   SkinRecord.confidence_score, SkinRecord.image_path, SkinRecord.created_at, rn)
+                  .join(Baby, Baby.id == SkinRecord.baby_id)
+                  .filter(Baby.parent_id == user_id)
+                  .subquery())
+        rows = (db.session.query(ranked)
+                .filter(ranked.c.rn <= n)
+                .order_by(ranked.c.baby_id, ranked.c.rn)
+                .all())
+        records = {}
+        thumbs = thumb_urls(r.image_path for r in rows)
+        for r in rows:
+            records.setdefault(str(r.baby_id), []).append({
+                "id": r.id, "rash": r.predicted_rash_type, "confidence": r.confidence_score,
+                "image": r.image_path, "thumb_url": thumbs.get(r.image_path),
+                "created_at": r.created_at.isoformat() if r.created_at else None})
+        out["records"] = records
+
+    if "consultations" in fields:
+        doctor = aliased(User)
+        consultations = (db.session.query(Consultation, doctor.full_name)
+                         .outerjoin(doctor, doctor.id == Consultation.doctor_id)
+                         .filter(Consultation.parent_id == user_id)
+                         .order_by(Consultation.created_at.desc())
+                         .limit(10).all())
+        out["consultations"] = [{"id": c.id, "doctor_id": c.doctor_id, "doctor_name": doctor_name,
+                                 "baby_id": c.baby_id, "status": c.status, "date": c.date, "time": c.time}
+                                for c, doctor_name in consultations]
+
+    if "summary" in fields:
+        # materialized per-baby aggregates (rash_analytics), not a scan of the records
+        rows = (db.session.query(BabyRashSummary)
+                .join(Baby, Baby.id == BabyRashSummary.baby_id)
+                .filter(Baby.parent_id == user_id)
+                .order_by(BabyRashSummary.baby_id, BabyRashSummary.count.desc())
+                .all())
+        summary = {}
+        for r in rows:
+            summary.setdefault(str(r.baby_id), []).append({
+                "rash_type": r.rash_type, "count": r.count,
+                "avg_confidence": round(r.confidence_sum / r.count, 2) if r.count else None,
+                "last_seen": r.last_seen.isoformat() if r.last_seen else None})
+        out["summary"] = summary
+
+    if "doctors" in fields:
+        out["doctors"] = directory.search("", limit=200)
+
+    return jsonify(out), 200
 
 
 @parent_bp.route("/babies/<int:baby_id>/history", methods=["GET"])
@@ -40,40 +106,69 @@ def baby_history(baby_id):
         return jsonify({"error": "forbidden"}), 403
 
     records = SkinRecord.query.filter_by(baby_id=baby_id).order_by(SkinRecord.created_at.desc()).all()
+    thumbs = thumb_urls(r.image_path for r in records)
     data = [{"id": r.id, "rash": r.predicted_rash_type, "confidence": r.confidence_score,
-             "image": r.image_path, "created_at": r.created_at.isoformat()} for r in records]
+             "image": r.image_path, "thumb_url": thumbs.get(r.image_path),
+             "created_at": r.created_at.isoformat()} for r in records]
     return jsonify({"history": data}), 200
 
 
+@parent_bp.route("/babies/<int:baby_id>/summary", methods=["GET"])
+@jwt_required()
+def baby_rash_summary(baby_id):
+    identity = get_jwt_identity()
+    if identity is None:
+        return jsonify({"error": "Unauthorized"}), 401
+    user_id = int(identity)
+
+    baby = Baby.query.get_or_404(baby_id)
+    if baby.parent_id != user_id:
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(baby_summary(baby_id)), 200
+
+
+@parent_bp.route("/babies/<int:baby_id>/trends", methods=["GET"])
+@jwt_required()
+def baby_rash_trends(baby_id):
+    identity = get_jwt_identity()
+    if identity is None:
+        return jsonify({"error": "Unauthorized"}), 401
+    user_id = int(identity)
+
+    baby = Baby.query.get_or_404(baby_id)
+    if baby.parent_id != user_id:
+        return jsonify({"error": "forbidden"}), 403
+    weeks = min(max(request.args.get("weeks", 12, type=int), 1), 104)
+    return jsonify(baby_trends(baby_id, weeks)), 200
+
+
 @parent_bp.route("/doctors", methods=["GET"])
 @jwt_required(optional=True)
 def doctors_list():
-    # optional auth: we don't need the user id, but accept if present
-    identity = get_jwt_identity()
-    if identity is not None:
-        try:
-            _ = int(identity)
-        except Exception:
-            pass
-
-    docs = User.query.filter_by(role="doctor").all()
-    data = [{"id": d.id, "full_name": d.full_name, "specialization": d.specialization} for d in docs]
-    return jsonify({"doctors": data}), 200
+    # optional auth: the directory is the same for everyone, so it is served from memory
+    q = (request.args.get("q") or "").strip()
+    if q:
+        limit = min(max(request.args.get("limit", 50, type=int), 1), 200)
+        return jsonify({"doctors": directory.search(q, limit)}), 200
+
+    payload, etag = directory.listing()
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(payload, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 
 @parent_bp.route("/doctors/<int:doc_id>", methods=["GET"])
 @jwt_required(optional=True)
 def doctor_profile(doc_id):
-    identity = get_jwt_identity()
-    if identity is not None:
-        try:
-            _ = int(identity)
-        except Exception:
-            pass
-
-    doc = User.query.filter_by(id=doc_id, role="doctor").first_or_404()
-    profile = {"id": doc.id, "full_name": doc.full_name, "specialization": doc.specialization,
-               "bio": doc.bio, "experience": doc.experience}
+    doc = directory.get(doc_id)
+    if doc is None:
+        return jsonify({"error": "Doctor not found"}), 404
+    profile = {"id": doc["id"], "full_name": doc["full_name"], "specialization": doc["specialization"],
+               "bio": doc["bio"], "experience": doc["experience"]}
     return jsonify({"doctor": profile}), 200
 
 
@@ -104,6 +199,10 @@ def book_consultation():
                         date=date, time=time, reason=reason)
     db.session.add(cons)
     db.session.commit()
+
+    publish("consultation.requested", [cons.doctor_id],
+            consultation_id=cons.id, baby_id=baby.id, parent_id=user_id,
+            date=date, time=time, reason=reason)
     return jsonify({"message": "Consultation requested", "consultation_id": cons.id}), 201
 
 
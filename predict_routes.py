@@ -10,7 +10,12 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 
 from extensions import db
 from models import SkinRecord, RashType, Baby
-from inference_utils import predict_image_bytes, load_model
+from inference_utils import decode, predict_decoded
+from image_quality import ImageRejected
+from image_hash import phash, to_hex, duplicates
+from embedding_index import similar
+from shadow_eval import shadow
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 predict_bp = Blueprint("predict_bp", __name__, url_prefix="/predict")
@@ -47,16 +52,57 @@ def predict():
 
     # Run prediction (EfficientNet preprocessing handled in helper)
     try:
-        result = predict_image_bytes(file)
+        timings = {}
+        # compact top-k payload by default; ?full=1 adds the whole distribution
+        full = request.args.get("full", "").lower() in ("1", "true", "yes")
+        img, quality = decode(file, timings=timings, quality_gate=True)
+        metrics.quality_gate.inc(quality["action"] if quality else "accept")
+
+        # a recompressed / re-cropped re-upload of a recent photo reuses that record
+        image_hash, duplicate = None, None
+        if baby_id is not None:
+            image_hash = phash(img)
+            match = duplicates.find(baby_id, image_hash)
+            duplicate = SkinRecord.query.get(match[0]) if match else None
+            metrics.cache("duplicate_uploads", duplicate is not None)
+
+        if duplicate is not None:
+            result = {
+                "rash_type": duplicate.predicted_rash_type,
+                "confidence_raw": (duplicate.confidence_score or 0.0) / 100.0,
+                "top_k": [{"label": duplicate.predicted_rash_type,
+                           "score": round((duplicate.confidence_score or 0.0) / 100.0, 4)}],
+                "model_version": duplicate.model_version,
+            }
+        else:
+            # records get their pooled embedding from the same pass, for similar-case lookup
+            result, inp = predict_decoded(img, timings=timings, full=full, quality=quality,
+                                          embed=baby_id is not None)
+        metrics.inference_stages(timings)
+        embedding = result.pop("embedding", None)
         label = result.get("rash_type", "unknown")
         confidence_raw = result.get("confidence_raw", 0.0)
         confidence_pct = round(confidence_raw * 100.0, 2)
+    except ImageRejected as e:
+        # nothing saved, nothing scored: tell the parent how to retake the photo
+        metrics.inference_stages(timings)
+        metrics.quality_gate.inc("reject")
+        logger.info("Image rejected by quality gate: %s metrics=%s", e, e.report["metrics"])
+        return jsonify({
+            "error": "Image quality too low",
+            "issues": e.report["issues"],
+            "metrics": e.report["metrics"],
+        }), 422
     except FileNotFoundError:
         return jsonify({"error": "Model file missing on server"}), 500
     except Exception as e:
         logger.exception("Inference failed")
         return jsonify({"error": "Inference failed", "detail": str(e)}), 500
 
+    # candidate model (if any) scores the same tensor off the request path
+    if duplicate is None:
+        shadow.submit(result, img, inp)
+
     # Care tips from DB if available (structured: home_care, prevention, doctor_if with optional language keys)
     lang = request.args.get("lang", "en").lower()
     care_tips = []
@@ -84,38 +130,52 @@ def predict():
     except Exception:
         logger.warning("Care tips lookup failed", exc_info=True)
 
-    # Save file to uploads folder
-    fname = secure_filename(file.filename or "upload.jpg")
-    stem, ext = os.path.splitext(fname)
-    ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    final_name = f"{stem}_{ts}{ext or '.jpg'}"
-    save_path = os.path.join(current_app.uploads_path, final_name)
-    try:
-        file.stream.seek(0)
-        with open(save_path, "wb") as fh:
-            fh.write(file.read())
-    except Exception:
-        logger.exception("Failed saving file")
-
-    record_id = None
-    user_id = get_jwt_identity()
-    if baby_id is not None:
+    if duplicate is not None:
+        # same picture already on file: no second copy, no second record
+        final_name = duplicate.image_path
+        record_id = duplicate.id
+    else:
+        # Save file to uploads folder
+        fname = secure_filename(file.filename or "upload.jpg")
+        stem, ext = os.path.splitext(fname)
+        ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        final_name = f"{stem}_{ts}{ext or '.jpg'}"
+        save_path = os.path.join(current_app.uploads_path, final_name)
         try:
-            rec = SkinRecord(
-                baby_id=baby_id,
-                created_by_id=user_id,
-                predicted_rash_type=label,
-                confidence_score=confidence_pct,
-                image_path=final_name
-            )
-            db.session.add(rec)
-            db.session.commit()
-            record_id = rec.id
+            file.stream.seek(0)
+            with open(save_path, "wb") as fh:
+                fh.write(file.read())
         except Exception:
-            logger.exception("DB save failed; continuing without record")
+            logger.exception("Failed saving file")
+
+        record_id = None
+        user_id = get_jwt_identity()
+        if baby_id is not None:
+            try:
+                rec = SkinRecord(
+                    baby_id=baby_id,
+                    created_by_id=user_id,
+                    predicted_rash_type=label,
+                    confidence_score=confidence_pct,
+                    image_path=final_name,
+                    model_version=result.get("model_version"),
+                    phash=to_hex(image_hash) if image_hash is not None else None
+                )
+                db.session.add(rec)
+                db.session.commit()
+                record_id = rec.id
+            except Exception:
+                logger.exception("DB save failed; continuing without record")
+
+        if record_id is not None and embedding is not None:
+            try:
+                similar.put(result["model_version"], record_id, embedding)
+            except Exception:
+                logger.warning("Storing embedding for record %s failed", record_id, exc_info=True)
 
     image_url = url_for("file", filename=final_name, _external=False)
-    logger.info("PREDICTION label=%s confidence=%.2f%% baby_id=%s record_id=%s", label, confidence_pct, baby_id, record_id)
+    logger.info("PREDICTION label=%s confidence=%.2f%% baby_id=%s record_id=%s model=%s",
+                label, confidence_pct, baby_id, record_id, result.get("model_version"))
 
     return jsonify({
         "rash_type": label,
@@ -125,5 +185,10 @@ def predict():
         "consult_doctor_if": doctor_if,
         "record_id": record_id,
         "image_url": image_url,
-        "probs": result.get("probs", {})
+        "top_k": result.get("top_k", []),
+        **({"probs": result["probs"]} if full and "probs" in result else {}),
+        **({"duplicate_of": record_id} if duplicate is not None else {}),
+        **({"tta_views": result["tta_views"]} if "tta_views" in result else {}),
+        **({"quality": result["quality"]} if "quality" in result else {}),
+        "model_version": result.get("model_version")
     }), 200
\ No newline at end of file
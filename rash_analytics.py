@@ -0,0 +1,232 @@
+"""Materialized per-baby rash analytics.
+Run: python rash_analytics.py rebuild [--baby-id 3 ...]    # backfill / repair from skin_records
+
+Two small tables are kept current as SkinRecords are written, inside the same
+transaction (a mapper after_insert hook), so dashboards never scan records:
+    baby_rash_summary   (baby, rash type) -> count, confidence sum / EWMA, first / last seen
+    baby_rash_weekly    (baby, ISO week Monday, rash type) -> count, confidence sum
+
+Deleting a baby drops its rows; anything else that bypasses the ORM (raw SQL,
+bulk imports) should rebuild the affected babies afterwards.
+"""
+import time
+import argparse
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+EWMA_ALPHA = 0.3
+
+
+def week_start(dt):
+    """ISO date (YYYY-MM-DD) of the Monday of dt's week."""
+    return (dt - timedelta(days=dt.weekday())).strftime("%Y-%m-%d")
+
+
+def _tables():
+    from models import BabyRashSummary, BabyRashWeekly
+    return BabyRashSummary.__table__, BabyRashWeekly.__table__
+
+
+# -------------------------------------------------------------
+# INCREMENTAL UPDATE
+# -------------------------------------------------------------
+def apply_record(conn, baby_id, rash_type, confidence, seen_at):
+    """Fold one record into both tables on `conn` (UPDATE, INSERT when the row is new)."""
+    if baby_id is None:
+        return
+    summary, weekly = _tables()
+    rash_type = rash_type or "unknown"
+    conf = float(confidence or 0.0)
+    seen_at = seen_at or datetime.utcnow()
+
+    s = summary.c
+    res = conn.execute(
+        summary.update()
+        .where(s.baby_id == baby_id, s.rash_type == rash_type)
+        .values(count=s.count + 1,
+                confidence_sum=s.confidence_sum + conf,
+                confidence_ewma=EWMA_ALPHA * conf + (1 - EWMA_ALPHA) * sa.func.coalesce(s.confidence_ewma, conf),
+                first_seen=sa.case((s.first_seen > seen_at, seen_at), else_=s.first_seen),
+                last_seen=sa.case((s.last_seen < seen_at, seen_at), else_=s.last_seen)))
+    if res.rowcount == 0:
+        conn.execute(summary.insert().values(baby_id=baby_id, rash_type=rash_type, count=1,
+                                             confidence_sum=conf, confidence_ewma=conf,
+                                             first_seen=seen_at, last_seen=seen_at))
+
+    w = weekly.c
+    week = week_start(seen_at)
+    res = conn.execute(
+        weekly.update()
+        .where(w.baby_id == baby_id, w.week_start == week, w.rash_type == rash_type)
+        .values(count=w.count + 1, confidence_sum=w.confidence_sum + conf))
+    if res.rowcount == 0:
+        conn.execute(weekly.insert().values(baby_id=baby_id, week_start=week, rash_type=rash_type,
+                                            count=1, confidence_sum=conf))
+
+
+def _on_record_insert(mapper, connection, target):
+    apply_record(connection, target.baby_id, target.predicted_rash_type,
+                 target.confidence_score, target.created_at)
+
+
+def _on_baby_delete(mapper, connection, target):
+    summary, weekly = _tables()
+    connection.execute(summary.delete().where(summary.c.baby_id == target.id))
+    connection.execute(weekly.delete().where(weekly.c.baby_id == target.id))
+
+
+def _install_hooks():
+    from sqlalchemy import event
+    from models import SkinRecord, Baby
+
+    if not event.contains(SkinRecord, "after_insert", _on_record_insert):
+        event.listen(SkinRecord, "after_insert", _on_record_insert)
+    if not event.contains(Baby, "before_delete", _on_baby_delete):
+        event.listen(Baby, "before_delete", _on_baby_delete)
+
+_install_hooks()
+
+
+# -------------------------------------------------------------
+# READS
+# -------------------------------------------------------------
+def _iso(dt):
+    return dt.strftime("%Y-%m-%d %H:%M") if dt else None
+
+
+def baby_summary(baby_id):
+    from models import BabyRashSummary
+
+    rows = (BabyRashSummary.query.filter_by(baby_id=baby_id)
+            .order_by(BabyRashSummary.count.desc(), BabyRashSummary.rash_type).all())
+    total = sum(r.count for r in rows)
+    return {
+        "baby_id": baby_id,
+        "total_records": total,
+        "first_seen": _iso(min((r.first_seen for r in rows if r.first_seen), default=None)),
+        "last_seen": _iso(max((r.last_seen for r in rows if r.last_seen), default=None)),
+        "rash_types": [{
+            "rash_type": r.rash_type,
+            "count": r.count,
+            "share": round(r.count / total, 4) if total else 0.0,
+            "avg_confidence": round(r.confidence_sum / r.count, 2) if r.count else None,
+            "recent_confidence": round(r.confidence_ewma, 2) if r.confidence_ewma is not None else None,
+            "first_seen": _iso(r.first_seen),
+            "last_seen": _iso(r.last_seen),
+        } for r in rows],
+    }
+
+
+def baby_trends(baby_id, weeks=12, now=None):
+    """Per-week counts for the last `weeks` weeks, oldest first, empty weeks included."""
+    from models import BabyRashWeekly
+
+    first = datetime.strptime(week_start((now or datetime.utcnow()) - timedelta(weeks=weeks - 1)), "%Y-%m-%d")
+    rows = (BabyRashWeekly.query
+            .filter(BabyRashWeekly.baby_id == baby_id, BabyRashWeekly.week_start >= first.strftime("%Y-%m-%d"))
+            .all())
+    by_week = {}
+    for r in rows:
+        by_week.setdefault(r.week_start, []).append(r)
+
+    out = []
+    for i in range(weeks):
+        key = (first + timedelta(weeks=i)).strftime("%Y-%m-%d")
+        wk = by_week.get(key, [])
+        n = sum(r.count for r in wk)
+        out.append({
+            "week_start": key,
+            "total": n,
+            "counts": {r.rash_type: r.count for r in wk},
+            "avg_confidence": round(sum(r.confidence_sum for r in wk) / n, 2) if n else None,
+        })
+    return {"baby_id": baby_id, "weeks": out}
+
+
+# -------------------------------------------------------------
+# REBUILD
+# -------------------------------------------------------------
+def rebuild(conn, baby_ids=None, chunk=2000):
+    """Recompute the tables from skin_records (all babies, or only `baby_ids`) in one pass."""
+    from models import SkinRecord
+
+    summary, weekly = _tables()
+    rec = SkinRecord.__table__.c
+    if baby_ids is not None:
+        baby_ids = list(baby_ids)
+        if not baby_ids:
+            return 0
+        conn.execute(summary.delete().where(summary.c.baby_id.in_(baby_ids)))
+        conn.execute(weekly.delete().where(weekly.c.baby_id.in_(baby_ids)))
+    else:
+        conn.execute(summary.delete())
+        conn.execute(weekly.delete())
+
+    q = sa.select(rec.baby_id, rec.predicted_rash_type, rec.confidence_score, rec.created_at) \
+        .where(rec.baby_id.isnot(None)).order_by(rec.baby_id, rec.created_at, rec.id)
+    if baby_ids is not None:
+        q = q.where(rec.baby_id.in_(baby_ids))
+
+    sums, weeks = {}, {}
+    n = 0
+
+    def flush():
+        if sums:
+            conn.execute(summary.insert(), list(sums.values()))
+        if weeks:
+            conn.execute(weekly.insert(), list(weeks.values()))
+        sums.clear()
+        weeks.clear()
+
+    current = None
+    for baby_id, rash, conf, seen_at in conn.execution_options(yield_per=chunk).execute(q):
+        # rows arrive grouped by baby, so a finished baby can be written out and forgotten
+        if baby_id != current and len(sums) >= chunk:
+            flush()
+        current = baby_id
+        rash = rash or "unknown"
+        conf = float(conf or 0.0)
+        seen_at = seen_at or datetime.utcnow()
+        s = sums.get((baby_id, rash))
+        if s is None:
+            sums[(baby_id, rash)] = {"baby_id": baby_id, "rash_type": rash, "count": 1, "confidence_sum": conf,
+                                     "confidence_ewma": conf, "first_seen": seen_at, "last_seen": seen_at}
+        else:
+            s["count"] += 1
+            s["confidence_sum"] += conf
+            s["confidence_ewma"] = EWMA_ALPHA * conf + (1 - EWMA_ALPHA) * s["confidence_ewma"]
+            s["last_seen"] = seen_at
+        key = (baby_id, week_start(seen_at), rash)
+        w = weeks.get(key)
+        if w is None:
+            weeks[key] = {"baby_id": baby_id, "week_start": key[1], "rash_type": rash,
+                          "count": 1, "confidence_sum": conf}
+        else:
+            w["count"] += 1
+            w["confidence_sum"] += conf
+        n += 1
+    flush()
+    return n
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Materialized rash analytics")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("rebuild", help="recompute the summary tables from skin_records")
+    r.add_argument("--baby-id", type=int, nargs="*", help="only these babies (default: all)")
+    args = ap.parse_args()
+
+    from app import create_app
+    from extensions import db
+
+    app = create_app()
+    with app.app_context():
+        started = time.perf_counter()
+        with db.engine.begin() as conn:
+            n = rebuild(conn, args.baby_id)
+        print(f"Rebuilt analytics from {n} records in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+"""Tiered retention for instance/uploads: old originals move to packed cold storage.
+Run: python retention.py run [--days 365] [--limit N] [--dry-run] [--rescan]
+     python retention.py status
+     python retention.py rehydrate NAME [NAME ...]     # put files back in uploads for good
+
+Files whose newest skin record is older than RETENTION_DAYS are recompressed
+(JPEG, RETENTION_QUALITY, longest edge capped at RETENTION_MAX_EDGE) and appended
+to pack files of about RETENTION_PACK_MB in instance/archive, so years of scans
+cost a handful of inodes. An index (instance/archive/index.db) maps each file
+name to (pack, offset, length). A RETENTION_THUMB_EDGE thumbnail stays hot as
+uploads/thumbs/<name>.jpg (list endpoints return it as thumb_url) and embeddings
+are untouched, so lists and similar-case search never wait on the cold tier.
+Rehydrated files are pinned and never archived again.
+
+/instance/uploads/<name> still works for archived files: the route falls back
+to a single read from the pack (open_upload does the same for the export and
+embedding backfill).
+
+The job is resumable. A chunk's blobs are fsynced and indexed before any
+original is deleted, so a crash leaves at worst unreferenced bytes at the end
+of a pack (truncated on the next run) or originals that the next run deletes
+once it sees them indexed. Pack entries carry their own name and length, so
+the index can be rebuilt by scanning. One job runs at a time per archive
+(file lock); RETENTION_INTERVAL_HOURS>0 runs it in the background of the app.
+
+Runs pick up where the last one stopped: the job remembers the highest record
+id it has looked at and the cutoff it used, so later runs only consider newer
+images plus older ones that have crossed the cutoff since (--rescan starts over).
+--limit counts files actually archived (or failed), not names looked at; files
+that failed to recompress are only retried with --rescan.
+"""
+import io
+import os
+import time
+import json
+import struct
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:          # Windows: no cross-process lock, run a single job at a time
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", os.path.join(ROOT, "instance", "archive"))
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "365"))
+QUALITY = int(os.getenv("RETENTION_QUALITY", "80"))
+MAX_EDGE = int(os.getenv("RETENTION_MAX_EDGE", "2048"))
+THUMB_EDGE = int(os.getenv("RETENTION_THUMB_EDGE", "256"))
+PACK_BYTES = int(float(os.getenv("RETENTION_PACK_MB", "256")) * 1024 * 1024)
+CHUNK = 200
+
+MAGIC = b"BSKA"
+HEADER = struct.Struct("<4sHQ")     # magic, name length, data length; then name, then data
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived (
+    name TEXT PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    original_bytes INTEGER NOT NULL,
+    mimetype TEXT NOT NULL,
+    archived_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pinned (name TEXT PRIMARY KEY, pinned_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def thumb_name(name):
+    # keyed on the full name, so a.png and a.jpg get a thumbnail each
+    return os.path.join("thumbs", name + ".jpg")
+
+
+def thumb_urls(names):
+    """{name: URL of its hot thumbnail} for the archived uploads among `names`; absent while hot.
+    One index lookup for a whole list (thumbnails are written before their names are indexed)."""
+    names = list({n for n in names if n})
+    return {n: "/instance/uploads/" + thumb_name(n).replace(os.sep, "/") for n in archive.indexed(names)}
+
+
+def thumb_url(name):
+    return thumb_urls([name]).get(name)
+
+
+# -------------------------------------------------------------
+# ARCHIVE (packs + index)
+# -------------------------------------------------------------
+class Archive:
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+        self._local = threading.local()
+        self.progress = {}        # live counters of the running job, for /metrics
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def pack_path(self, pack):
+        return os.path.join(self.root, f"pack-{pack:06d}.bin")
+
+    # ------------------ READS ------------------
+    def lookup(self, name):
+        if not os.path.exists(os.path.join(self.root, "index.db")):
+            return None
+        return self._conn().execute("SELECT pack, offset, length, mimetype FROM archived WHERE name = ?",
+                                    (name,)).fetchone()
+
+    def read(self, name):
+        """(bytes, mimetype) of an archived file, or None."""
+        hit = self.lookup(name)
+        if hit is None:
+            return None
+        pack, offset, length, mimetype = hit
+        with open(self.pack_path(pack), "rb") as fh:
+            fh.seek(offset)
+            data = fh.read(length)
+        if len(data) != length:
+            raise IOError(f"archive pack {pack} is truncated at {name}")
+        return data, mimetype
+
+    def indexed(self, names):
+        return self._names_in("archived", names)
+
+    def pinned(self, names):
+        return self._names_in("pinned", names)
+
+    def _names_in(self, table, names):
+        if not names or not os.path.exists(os.path.join(self.root, "index.db")):
+            return set()
+        found = set()
+        for i in range(0, len(names), 500):      # under SQLite's bound-parameter limit
+            part = names[i:i + 500]
+            marks = ",".join("?" * len(part))
+            found.update(r[0] for r in self._conn().execute(
+                f"SELECT name FROM {table} WHERE name IN ({marks})", part))
+        return found
+
+    def job(self, key):
+        row = self._conn().execute("SELECT value FROM job WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def stats(self):
+        conn = self._conn()
+        n, orig, stored = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(original_bytes), 0), COALESCE(SUM(length), 0) FROM archived").fetchone()
+        packs = conn.execute("SELECT COUNT(DISTINCT pack) FROM archived").fetchone()[0]
+        pinned = conn.execute("SELECT COUNT(*) FROM pinned").fetchone()[0]
+        job = dict(conn.execute("SELECT key, value FROM job").fetchall())
+        return {"files": n, "packs": packs, "original_bytes": orig, "stored_bytes": stored, "pinned": pinned,
+                "last_run": json.loads(job["last_run"]) if "last_run" in job else None,
+                "scan": json.loads(job["scan"]) if "scan" in job else None}
+
+    # ------------------ WRITES ------------------
+    def _active_pack(self):
+        """(pack number, open append handle) positioned after the last indexed entry."""
+        row = self._conn().execute("SELECT pack, MAX(offset + length) FROM archived "
+                                   "WHERE pack = (SELECT MAX(pack) FROM archived)").fetchone()
+        pack, end = (row[0], row[1]) if row and row[0] is not None else (1, 0)
+        path = self.pack_path(pack)
+        if os.path.exists(path) and os.path.getsize(path) > end:
+            # bytes appended by an interrupted run that never made it into the index
+            with open(path, "r+b") as fh:
+                fh.truncate(end)
+        if end >= PACK_BYTES:
+            pack += 1
+        return pack, open(self.pack_path(pack), "ab")
+
+    def append(self, state, name, data):
+        """Write one entry to the active pack; returns (pack, data offset). Rolls packs over by size."""
+        pack, fh = state
+        if fh.tell() >= PACK_BYTES:
+            fh.flush()
+            os.fsync(fh.fileno())
+            fh.close()
+            pack += 1
+            fh = open(self.pack_path(pack), "ab")
+            state[:] = [pack, fh]
+        raw = name.encode("utf-8")
+        fh.write(HEADER.pack(MAGIC, len(raw), len(data)))
+        fh.write(raw)
+        offset = fh.tell()
+        fh.write(data)
+        return pack, offset
+
+    def commit(self, state, rows):
+        pack, fh = state
+        fh.flush()
+        os.fsync(fh.fileno())
+        with self._conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO archived VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def forget(self, names, pin=False):
+        """Drop names from the index; with `pin`, also keep later runs from archiving them again."""
+        now = time.time()
+        with self._conn() as conn:
+            conn.executemany("DELETE FROM archived WHERE name = ?", [(n,) for n in names])
+            if pin:
+                conn.executemany("INSERT OR REPLACE INTO pinned VALUES (?, ?)", [(n, now) for n in names])
+
+    def set_job(self, key, value):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO job VALUES (?, ?)", (key, json.dumps(value)))
+
+    def lock(self):
+        """Exclusive per-archive lock file handle, or None when another job holds it."""
+        os.makedirs(self.root, exist_ok=True)
+        fh = open(os.path.join(self.root, ".lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fh.close()
+                return None
+        return fh
+
+
+archive = Archive()
+
+
+def open_upload(uploads_dir, name):
+    """Binary file object for an upload, hot or archived. Raises FileNotFoundError."""
+    path = os.path.join(uploads_dir, name)
+    if os.path.isfile(path):
+        return open(path, "rb")
+    blob = archive.read(name)
+    if blob is None:
+        raise FileNotFoundError(name)
+    return io.BytesIO(blob[0])
+
+
+# -------------------------------------------------------------
+# JOB
+# -------------------------------------------------------------
+def recompress(path):
+    """(archived bytes, mimetype, thumbnail jpeg bytes, original size) for one original."""
+    with open(path, "rb") as fh:
+        original = fh.read()
+    img = Image.open(io.BytesIO(original))
+    source_format = img.format
+    img.load()
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if max(img.size) > MAX_EDGE:
+        img.thumbnail((MAX_EDGE, MAX_EDGE), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=QUALITY, optimize=True, progressive=True)
+    data, mimetype = out.getvalue(), "image/jpeg"
+    if len(data) >= len(original) and source_format == "JPEG":
+        data = original        # already small: keep the source bytes
+    thumb = img.copy()
+    thumb.thumbnail((THUMB_EDGE, THUMB_EDGE))
+    tout = io.BytesIO()
+    thumb.save(tout, "JPEG", quality=80)
+    return data, mimetype, tout.getvalue(), len(original)
+
+
+def _candidates(cutoff, scan=None):
+    """(image name, first record id) for names whose newest record is older than `cutoff`,
+    oldest first, streamed. With the `scan` state of an earlier run, names it already
+    judged are only returned if they crossed its cutoff since."""
+    import sqlalchemy as sa
+    from extensions import db
+    from models import SkinRecord
+
+    r = SkinRecord.__table__.c
+    first_id, newest = sa.func.min(r.id), sa.func.max(r.created_at)
+    having = newest < cutoff
+    if scan:
+        having = sa.and_(having, sa.or_(first_id > scan["after_id"],
+                                        newest >= datetime.fromisoformat(scan["cutoff"])))
+    stmt = (sa.select(r.image_path, first_id)
+            .where(r.image_path.isnot(None))
+            .group_by(r.image_path)
+            .having(having)
+            .order_by(first_id))
+    for name, rid in db.session.execute(stmt.execution_options(yield_per=1000)):
+        yield name, rid
+
+
+def _max_record_id():
+    import sqlalchemy as sa
+    from extensions import db
+    from models import SkinRecord
+
+    return db.session.execute(sa.select(sa.func.max(SkinRecord.id))).scalar() or 0
+
+
+def run(uploads_dir, days=RETENTION_DAYS, limit=None, dry_run=False, workers=4, stop=None, rescan=False):
+    """Archive everything past retention. Needs an app context. Returns the progress dict.
+
+    `limit` caps the files archived (or failed) in this run.
+    """
+    lock = archive.lock()
+    if lock is None:
+        logger.info("Retention job already running elsewhere; skipping")
+        return None
+    p = archive.progress
+    p.clear()
+    p.update(scanned=0, archived=0, already=0, pinned=0, missing=0, failed=0, bytes_in=0, bytes_out=0,
+             running=1, started_at=time.time())
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    scan = None if rescan else archive.job("scan")
+    floor = scan["after_id"] if scan else 0
+    top_id = _max_record_id()
+    state = list(archive._active_pack()) if not dry_run else None
+
+    def remaining():
+        return None if limit is None else limit - p["archived"] - p["failed"]
+
+    def process(batch):
+        """Handle a prefix of [(name, first id)] within the limit; returns how many were handled."""
+        names = [name for name, _ in batch]
+        done, pinned = archive.indexed(names), archive.pinned(names)
+        budget = remaining()
+        todo, handled = [], 0
+        for name in names:
+            if budget is not None and len(todo) >= budget:
+                break
+            handled += 1
+            path = os.path.join(uploads_dir, name)
+            if name in pinned:
+                p["pinned"] += 1
+            elif name in done:
+                p["already"] += 1
+                if os.path.isfile(path) and not dry_run:
+                    os.remove(path)       # indexed by an earlier run that stopped before deleting
+            elif not os.path.isfile(path):
+                p["missing"] += 1
+            else:
+                todo.append(name)
+        p["scanned"] += handled
+        if dry_run:
+            for name in todo:
+                p["archived"] += 1
+                p["bytes_in"] += os.path.getsize(os.path.join(uploads_dir, name))
+            return handled
+        rows, written = [], []
+        results = pool.map(lambda n: _safe(recompress, os.path.join(uploads_dir, n)), todo)
+        for name, res in zip(todo, results):
+            if res is None:
+                p["failed"] += 1
+                continue
+            data, mimetype, thumb, original = res
+            pack, offset = archive.append(state, name, data)
+            rows.append((name, pack, offset, len(data), original, mimetype, time.time()))
+            written.append((name, thumb))
+            p["bytes_in"] += original
+            p["bytes_out"] += len(data)
+        if rows:
+            # thumbnails first: lists take "indexed" to mean the thumbnail is there
+            for name, thumb in written:
+                tpath = os.path.join(uploads_dir, thumb_name(name))
+                os.makedirs(os.path.dirname(tpath), exist_ok=True)
+                with open(tpath, "wb") as fh:
+                    fh.write(thumb)
+            archive.commit(state, rows)
+            for name, _ in written:
+                os.remove(os.path.join(uploads_dir, name))
+            p["archived"] += len(rows)
+        if handled and batch[handled - 1][1] > floor:
+            # every name up to here has been judged against this cutoff (names at or below the
+            # floor come first, so they are all done too)
+            archive.set_job("scan", {"after_id": batch[handled - 1][1], "cutoff": cutoff.isoformat()})
+        return handled
+
+    finished = False
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            batch = []
+            for item in _candidates(cutoff, scan):
+                if stop is not None and stop.is_set():
+                    break
+                batch.append(item)
+                if len(batch) >= CHUNK:
+                    process(batch)
+                    batch = []
+                    logger.info("Retention: %(scanned)d scanned, %(archived)d archived", p)
+                    if remaining() == 0:
+                        break
+            else:
+                if batch:
+                    process(batch)
+                finished = remaining() != 0 and not (stop is not None and stop.is_set())
+        if finished and not dry_run:
+            # a full pass judged every name that existed when it started
+            archive.set_job("scan", {"after_id": top_id, "cutoff": cutoff.isoformat()})
+    finally:
+        if state is not None:
+            state[1].close()
+        p["running"] = 0
+        p["finished_at"] = time.time()
+        if not dry_run:
+            archive.set_job("last_run", {k: v for k, v in p.items() if k != "running"})
+        lock.close()
+    return dict(p)
+
+
+def _safe(fn, *args):
+    try:
+        return fn(*args)
+    except Exception:
+        logger.warning("Retention: could not recompress %s", args[0], exc_info=True)
+        return None
+
+
+def rehydrate(uploads_dir, names):
+    """Write archived files back into uploads for good: dropped from the index (packs keep
+    dead bytes) and pinned, so later runs leave them hot."""
+    restored = []
+    for name in names:
+        blob = archive.read(name)
+        if blob is None:
+            continue
+        with open(os.path.join(uploads_dir, name), "wb") as fh:
+            fh.write(blob[0])
+        restored.append(name)
+    archive.forget(restored, pin=True)
+    for name in restored:
+        try:
+            os.remove(os.path.join(uploads_dir, thumb_name(name)))   # lists show the original again
+        except OSError:
+            pass
+    return restored
+
+
+# -------------------------------------------------------------
+# FLASK WIRING
+# -------------------------------------------------------------
+def init_retention(app):
+    from metrics import metrics
+
+    if not any(m.name == "retention_job" for m in metrics._metrics):
+        metrics.gauge("retention_job", "Progress of the current/last retention run in this process",
+                      lambda: {(k,): v for k, v in archive.progress.items()
+                               if k not in ("started_at", "finished_at")}, ("counter",))
+
+    hours = float(os.getenv("RETENTION_INTERVAL_HOURS", "0") or 0)
+    if hours <= 0:
+        return
+
+    def _loop():
+        while True:
+            time.sleep(hours * 3600)
+            try:
+                with app.app_context():
+                    run(app.uploads_path)
+            except Exception:
+                logger.warning("Retention run failed", exc_info=True)
+
+    threading.Thread(target=_loop, name="retention", daemon=True).start()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Tiered retention of uploads")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run", help="archive originals past retention")
+    r.add_argument("--days", type=float, default=RETENTION_DAYS)
+    r.add_argument("--limit", type=int, help="stop after archiving this many files (resume later)")
+    r.add_argument("--rescan", action="store_true", help="look at every image again, not just new ones")
+    r.add_argument("--workers", type=int, default=4)
+    r.add_argument("--dry-run", action="store_true")
+    sub.add_parser("status", help="archive size and the last run")
+    h = sub.add_parser("rehydrate", help="restore archived files to uploads")
+    h.add_argument("names", nargs="+")
+    args = ap.parse_args()
+
+    if args.cmd == "status":
+        print(json.dumps(archive.stats(), indent=2))
+        return
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        if args.cmd == "rehydrate":
+            print(f"Restored {len(rehydrate(app.uploads_path, args.names))} of {len(args.names)} files")
+            return
+        started = time.perf_counter()
+        p = run(app.uploads_path, args.days, args.limit, args.dry_run, args.workers, rescan=args.rescan)
+        if p is None:
+            raise SystemExit("Another retention job holds the archive lock")
+        saved = p["bytes_in"] - p["bytes_out"]
+        print(f"{'Would archive' if args.dry_run else 'Archived'} {p['archived']} files "
+              f"({p['already']} already, {p['pinned']} pinned, {p['missing']} missing, {p['failed']} failed) in "
+              f"{time.perf_counter() - started:.1f}s; {p['bytes_in'] / 1e6:.1f} MB -> "
+              f"{p['bytes_out'] / 1e6:.1f} MB ({saved / 1e6:.1f} MB saved)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Low-overhead sampling profiler for live workers.
+
+Samples sys._current_frames() on a background thread and aggregates collapsed
+("folded") stacks - one `frame;frame;frame count` line per unique stack, the
+input format of flamegraph.pl / speedscope / inferno.
+
+Three ways in:
+    GET /api/admin/profile?seconds=10      whole process, admin JWT only
+    kill -USR2 <pid>                       writes instance/profiles/profile-<pid>-<ts>.folded
+    any request with ?profile=1            that request's thread only, admin JWT only;
+                                           the response carries X-Profile: <file name>
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+
+from flask import g, request, current_app
+
+logger = logging.getLogger(__name__)
+
+MAX_SECONDS = 60
+DEFAULT_INTERVAL = 0.005
+SIGNAL_SECONDS = int(os.getenv("PROFILE_SIGNAL_SECONDS", "10"))
+
+# one whole-process profile at a time; per-request profiles are independent
+_busy = threading.Lock()
+_labels = {}
+
+
+def _frame_label(code):
+    label = _labels.get(code)
+    if label is None:
+        path = code.co_filename.replace("\\", "/")
+        # keep the package part so PIL / tensorflow / sqlalchemy / json are told apart
+        if "site-packages/" in path:
+            path = path.split("site-packages/", 1)[1]
+        else:
+            path = os.path.basename(path)
+        label = f"{path}:{code.co_name}"
+        _labels[code] = label
+    return label
+
+
+class Sampler:
+    def __init__(self, interval=DEFAULT_INTERVAL, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = set(thread_ids) if thread_ids else None
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample_once(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for tid, frame in sys._current_frames().items():
+            if tid == me or (self.thread_ids is not None and tid not in self.thread_ids):
+                continue
+            parts = []
+            while frame is not None:
+                parts.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            parts.append(names.get(tid, str(tid)))
+            self.stacks[";".join(reversed(parts))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample_once()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def collapsed(self):
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+def profile_for(seconds, interval=DEFAULT_INTERVAL):
+    """Profile every thread for `seconds`; returns collapsed stacks, or None if a profile is already running."""
+    if not _busy.acquire(blocking=False):
+        return None
+    try:
+        sampler = Sampler(interval).start()
+        time.sleep(seconds)
+        return sampler.stop().collapsed()
+    finally:
+        _busy.release()
+
+
+def _write(profile_dir, text, tag):
+    os.makedirs(profile_dir, exist_ok=True)
+    name = f"profile-{tag}-{time.strftime('%Y%m%d%H%M%S')}.folded"
+    with open(os.path.join(profile_dir, name), "w", encoding="utf-8") as f:
+        f.write(text)
+    return name
+
+
+# -------------------------------------------------------------
+# FLASK WIRING
+# -------------------------------------------------------------
+def init_profiler(app):
+    from utils.role_required import has_role
+
+    profile_dir = os.path.join(app.instance_path_dir, "profiles")
+    app.profile_dir = profile_dir
+
+    @app.before_request
+    def _maybe_profile_request():
+        if request.args.get("profile") == "1" and has_role("admin"):
+            g._profiler = Sampler(thread_ids=[threading.get_ident()]).start()
+
+    @app.after_request
+    def _finish_request_profile(resp):
+        sampler = g.pop("_profiler", None)
+        if sampler is not None:
+            name = _write(profile_dir, sampler.stop().collapsed(), f"req-{request.endpoint}")
+            resp.headers["X-Profile"] = name
+        return resp
+
+    # SIGUSR2: profile the whole process in the background and drop the file in instance/profiles
+    if hasattr(signal, "SIGUSR2") and threading.current_thread() is threading.main_thread():
+        def _on_signal(signum, frame):
+            def _run():
+                text = profile_for(SIGNAL_SECONDS)
+                if text is not None:
+                    name = _write(profile_dir, text, str(os.getpid()))
+                    logger.info("Profile written to %s", os.path.join(profile_dir, name))
+            threading.Thread(target=_run, name="signal-profile", daemon=True).start()
+        try:
+            signal.signal(signal.SIGUSR2, _on_signal)
+        except (ValueError, OSError):
+            logger.warning("Could not install SIGUSR2 profiler handler", exc_info=True)
+
+
+def profile_path(name):
+    """Resolve a stored profile name safely inside the profile dir."""
+    base = os.path.realpath(current_app.profile_dir)
+    path = os.path.realpath(os.path.join(base, name))
+    if not path.startswith(base + os.sep) or not os.path.exists(path):
+        return None
+    return path
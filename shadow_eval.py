@@ -0,0 +1,132 @@
+"""Shadow (A/B) evaluation of a candidate model on live /predict traffic.
+
+The primary result is returned to the user immediately; the candidate scores the
+same decoded image / preprocessed tensor on a single background worker. When the
+worker falls behind, samples are dropped instead of queueing, so the shadow never
+adds latency to the request path.
+"""
+import os
+import time
+import random
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from model_registry import registry
+
+logger = logging.getLogger(__name__)
+
+SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "1.0"))
+SHADOW_MAX_PENDING = int(os.getenv("SHADOW_MAX_PENDING", "4"))
+
+
+class ShadowEvaluator:
+    def __init__(self, sample_rate=SHADOW_SAMPLE_RATE, max_pending=SHADOW_MAX_PENDING):
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self._candidate = None
+        self._loading = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.scored = 0
+        self.agreed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.conf_delta_sum = 0.0
+        self.abs_conf_delta_sum = 0.0
+        self.latency_sum = 0.0
+        # primary label -> candidate label -> count
+        self.confusion = defaultdict(lambda: defaultdict(int))
+
+    # ------------------ CONTROL ------------------
+    @property
+    def candidate(self):
+        return self._candidate
+
+    def set_candidate(self, version):
+        """Load + warm the candidate in the background; stats restart once it is live."""
+        def _run():
+            self._loading = version
+            try:
+                lm = registry.load(version)
+                with self._lock:
+                    self._candidate = lm
+                    self._reset_stats()
+                logger.info("Shadow candidate %s is live", version)
+            except Exception:
+                logger.exception("Loading shadow candidate %s failed", version)
+            finally:
+                self._loading = None
+        threading.Thread(target=_run, name=f"shadow-load-{version}", daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._candidate = None
+
+    # ------------------ REQUEST PATH ------------------
+    def submit(self, primary, img, inp):
+        """Queue the candidate on the request's decoded image / tensor. Never blocks."""
+        cand = self._candidate
+        if cand is None or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending += 1
+        self._executor.submit(self._score, cand, primary, img, inp)
+
+    def _score(self, cand, primary, img, inp):
+        from inference_utils import to_input, forward, postprocess_batch
+        started = time.perf_counter()
+        try:
+            # reuse the primary's tensor when the input sizes match; otherwise only resize again
+            x = inp if tuple(inp.shape[1:3]) == tuple(cand.input_size) else to_input(img, cand.input_size)
+            _, top_idx, top_scores = postprocess_batch(forward(cand.model, x), 1, cand.temperature)
+            label = cand.label(int(top_idx[0, 0]))
+            delta = float(top_scores[0, 0]) - float(primary.get("confidence_raw", 0.0))
+            with self._lock:
+                if cand is not self._candidate:
+                    return
+                self.scored += 1
+                self.agreed += int(label == primary.get("rash_type"))
+                self.conf_delta_sum += delta
+                self.abs_conf_delta_sum += abs(delta)
+                self.latency_sum += time.perf_counter() - started
+                self.confusion[primary.get("rash_type")][label] += 1
+        except Exception:
+            logger.warning("Shadow scoring failed", exc_info=True)
+            with self._lock:
+                self.errors += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    # ------------------ METRICS ------------------
+    def snapshot(self):
+        with self._lock:
+            cand = self._candidate
+            n = self.scored
+            return {
+                "candidate": cand.version if cand else None,
+                "loading": self._loading,
+                "primary": registry.peek().version if registry.peek() else None,
+                "sample_rate": self.sample_rate,
+                "scored": n,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "pending": self._pending,
+                "agreement": round(self.agreed / n, 4) if n else None,
+                "mean_confidence_delta": round(self.conf_delta_sum / n, 4) if n else None,
+                "mean_abs_confidence_delta": round(self.abs_conf_delta_sum / n, 4) if n else None,
+                "mean_shadow_ms": round(self.latency_sum / n * 1000, 2) if n else None,
+                "confusion": {p: dict(c) for p, c in self.confusion.items()},
+            }
+
+
+shadow = ShadowEvaluator()
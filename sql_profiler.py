@@ -0,0 +1,121 @@
+"""SQL profiling hooks: slow-query log, N+1 detection and Server-Timing.
+
+Config (env or app.config):
+    SQL_PROFILER=1                  enable the hooks (default on)
+    SQL_SLOW_QUERY_MS=100           log statements slower than this
+    SQL_N_PLUS_ONE_THRESHOLD=5      flag a statement repeated this often in one request
+    SQL_SERVER_TIMING=0             add `Server-Timing: db;dur=..` to responses
+
+Recent slow queries and N+1 suspects are kept in memory and served to admins
+at /api/admin/sql.
+"""
+import os
+import re
+import time
+import logging
+import threading
+from collections import deque, Counter
+
+from flask import g, request, has_request_context
+
+logger = logging.getLogger(__name__)
+
+_WS = re.compile(r"\s+")
+
+_config = {"slow_ms": 100.0, "n_plus_one": 5, "server_timing": False}
+_slow = deque(maxlen=200)
+_n_plus_one = deque(maxlen=200)
+_lock = threading.Lock()
+
+
+def _normalize(statement):
+    return _WS.sub(" ", statement).strip()
+
+
+def param_shape(parameters, executemany):
+    """Describe parameters without leaking their values."""
+    if executemany:
+        rows = len(parameters) if parameters is not None else 0
+        first = parameters[0] if rows else None
+        return f"many[{rows}]x{param_shape(first, False)}" if first is not None else f"many[{rows}]"
+    if parameters is None:
+        return "()"
+    if isinstance(parameters, dict):
+        return "{" + ",".join(f"{k}:{type(v).__name__}" for k, v in sorted(parameters.items())) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ",".join(type(v).__name__ for v in parameters) + ")"
+    return type(parameters).__name__
+
+
+def _route():
+    if has_request_context():
+        return request.endpoint or request.path
+    return None
+
+
+def _on_query(statement, parameters, executemany, seconds):
+    ms = seconds * 1000
+    in_request = has_request_context()
+    if in_request:
+        log = g.get("_sql_log")
+        if log is None:
+            log = g._sql_log = []
+        log.append((statement, ms))
+
+    if ms >= _config["slow_ms"]:
+        entry = {
+            "statement": _normalize(statement),
+            "params": param_shape(parameters, executemany),
+            "ms": round(ms, 2),
+            "route": _route(),
+            "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with _lock:
+            _slow.append(entry)
+        logger.warning("SLOW QUERY %.1fms route=%s params=%s sql=%s",
+                       ms, entry["route"], entry["params"], entry["statement"][:500])
+
+
+def _after_request(resp):
+    log = g.pop("_sql_log", None)
+    if not log:
+        return resp
+    total_ms = sum(ms for _, ms in log)
+
+    repeats = Counter(stmt for stmt, _ in log)
+    for stmt, n in repeats.items():
+        if n >= _config["n_plus_one"]:
+            entry = {"statement": _normalize(stmt), "count": n, "route": _route(),
+                     "at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            with _lock:
+                _n_plus_one.append(entry)
+            logger.warning("N+1 SUSPECT route=%s repeated=%d sql=%s", entry["route"], n, entry["statement"][:300])
+
+    if _config["server_timing"]:
+        timing = f'db;dur={total_ms:.1f};desc="{len(log)} queries"'
+        existing = resp.headers.get("Server-Timing")
+        resp.headers["Server-Timing"] = f"{existing}, {timing}" if existing else timing
+    return resp
+
+
+def report():
+    with _lock:
+        return {"config": dict(_config), "slow_queries": list(_slow)[::-1], "n_plus_one": list(_n_plus_one)[::-1]}
+
+
+def _flag(value):
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def init_sql_profiler(app):
+    cfg = app.config
+    if not _flag(cfg.get("SQL_PROFILER", os.getenv("SQL_PROFILER", "1"))):
+        return
+    _config["slow_ms"] = float(cfg.get("SQL_SLOW_QUERY_MS", os.getenv("SQL_SLOW_QUERY_MS", 100)))
+    _config["n_plus_one"] = int(cfg.get("SQL_N_PLUS_ONE_THRESHOLD", os.getenv("SQL_N_PLUS_ONE_THRESHOLD", 5)))
+    _config["server_timing"] = _flag(cfg.get("SQL_SERVER_TIMING", os.getenv("SQL_SERVER_TIMING", "0")))
+
+    # statements are timed by the metrics listeners; this only consumes the timings
+    from metrics import add_query_hook
+    add_query_hook(_on_query)
+    app.after_request(_after_request)
@@ -1,5 +1,8 @@
 import os
 import json
+import math
+import time
+import argparse
 import tensorflow as tf
 from tensorflow.keras import layers, models
 from tensorflow.keras.applications import EfficientNetB0
@@ -17,61 +20,127 @@ BATCH = 32
 EPOCHS = 12
 SEED = 123
 
+# --fast mode defaults (bigger batches amortise the per-step XLA/dispatch cost)
+FAST_BATCH = 64
+
 def list_subdirs(path):
     if not os.path.isdir(path):
         return []
     return sorted([d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))])
 
-def build_datasets():
+def build_datasets(data_root=DATA_ROOT, batch=BATCH, img_size=IMG_SIZE, seed=SEED):
+    train_dir = os.path.join(data_root, "train")
+    val_dir = os.path.join(data_root, "val")
     # If dataset/train exists and has subfolders, prefer explicit train/val layout
-    train_classes = list_subdirs(TRAIN_DIR)
-    val_classes = list_subdirs(VAL_DIR)
+    train_classes = list_subdirs(train_dir)
+    val_classes = list_subdirs(val_dir)
     if train_classes:
         class_names = sorted(set(train_classes) | set(val_classes))
         print("Using split folders. Classes:", class_names)
         train_ds = tf.keras.preprocessing.image_dataset_from_directory(
-            TRAIN_DIR, labels='inferred', label_mode='categorical',
-            class_names=class_names, image_size=IMG_SIZE, batch_size=BATCH, seed=SEED, shuffle=True)
+            train_dir, labels='inferred', label_mode='categorical',
+            class_names=class_names, image_size=img_size, batch_size=batch, seed=seed, shuffle=True)
         if val_classes:
             val_ds = tf.keras.preprocessing.image_dataset_from_directory(
-                VAL_DIR, labels='inferred', label_mode='categorical',
-                class_names=class_names, image_size=IMG_SIZE, batch_size=BATCH, seed=SEED, shuffle=False)
+                val_dir, labels='inferred', label_mode='categorical',
+                class_names=class_names, image_size=img_size, batch_size=batch, seed=seed, shuffle=False)
         else:
             # If val missing, create validation split from train
             train_ds = tf.keras.preprocessing.image_dataset_from_directory(
-                TRAIN_DIR, labels='inferred', label_mode='categorical',
+                train_dir, labels='inferred', label_mode='categorical',
                 validation_split=0.2, subset='training', class_names=class_names,
-                image_size=IMG_SIZE, batch_size=BATCH, seed=SEED, shuffle=True)
+                image_size=img_size, batch_size=batch, seed=seed, shuffle=True)
             val_ds = tf.keras.preprocessing.image_dataset_from_directory(
-                TRAIN_DIR, labels='inferred', label_mode='categorical',
+                train_dir, labels='inferred', label_mode='categorical',
                 validation_split=0.2, subset='validation', class_names=class_names,
-                image_size=IMG_SIZE, batch_size=BATCH, seed=SEED, shuffle=False)
+                image_size=img_size, batch_size=batch, seed=seed, shuffle=False)
         return train_ds, val_ds, class_names
 
     # Fallback: dataset contains class folders directly under DATA_ROOT
-    top_level = list_subdirs(DATA_ROOT)
+    top_level = list_subdirs(data_root)
     if top_level:
         class_names = sorted(top_level)
         print("Using single-folder dataset with automatic split. Classes:", class_names)
         ds = tf.keras.preprocessing.image_dataset_from_directory(
-            DATA_ROOT, labels='inferred', label_mode='categorical',
+            data_root, labels='inferred', label_mode='categorical',
             validation_split=0.2, subset='training', class_names=class_names,
-            image_size=IMG_SIZE, batch_size=BATCH, seed=SEED, shuffle=True)
+            image_size=img_size, batch_size=batch, seed=seed, shuffle=True)
         val_ds = tf.keras.preprocessing.image_dataset_from_directory(
-            DATA_ROOT, labels='inferred', label_mode='categorical',
+            data_root, labels='inferred', label_mode='categorical',
             validation_split=0.2, subset='validation', class_names=class_names,
-            image_size=IMG_SIZE, batch_size=BATCH, seed=SEED, shuffle=False)
+            image_size=img_size, batch_size=batch, seed=seed, shuffle=False)
         return ds, val_ds, class_names
 
     raise FileNotFoundError("No dataset found. Place class folders under dataset/ or dataset/train & dataset/val")
 
-def prepare(ds, augment=False):
+def count_images(ds, batch):
+    # image_dataset_from_directory keeps the source paths; otherwise batches * batch size
+    # (cardinality counts batches; the last one may be short, so this is an upper bound)
+    paths = getattr(ds, "file_paths", None)
+    if paths is not None:
+        return len(paths)
+    return int(ds.cardinality().numpy()) * batch
+
+# -------------------------------------------------------------
+# FAST MODE: mixed precision / XLA / tf.data threading
+# -------------------------------------------------------------
+def _cpu_flags():
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except Exception:
+        pass
+    return set()
+
+def pick_precision_policy():
+    """Return the mixed precision policy the current hardware can actually run fast."""
+    if tf.config.list_physical_devices("GPU"):
+        return "mixed_float16"
+    flags = _cpu_flags()
+    # bf16 only pays off on CPUs with native bf16 (AVX512-BF16 / AMX); elsewhere it is emulated and slower
+    if flags & {"avx512_bf16", "amx_bf16"}:
+        return "mixed_bfloat16"
+    return "float32"
+
+def data_options():
+    opts = tf.data.Options()
+    opts.deterministic = False
+    opts.threading.private_threadpool_size = os.cpu_count() or 1
+    opts.threading.max_intra_op_parallelism = 1
+    opts.experimental_optimization.map_parallelization = True
+    opts.experimental_optimization.parallel_batch = True
+    return opts
+
+class ThroughputLogger(tf.keras.callbacks.Callback):
+    """Prints and records images/sec for every training epoch."""
+
+    def __init__(self, images_per_epoch):
+        super().__init__()
+        self.images_per_epoch = images_per_epoch
+        self.history = []
+        self._start = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.perf_counter() - self._start
+        ips = self.images_per_epoch / elapsed if elapsed > 0 else 0.0
+        self.history.append({"epoch": epoch + 1, "seconds": round(elapsed, 2), "images_per_sec": round(ips, 1)})
+        print(f"Epoch {epoch + 1}: {ips:.1f} images/sec ({elapsed:.1f}s)")
+
+
+def prepare(ds, augment=False, fast=False, img_size=IMG_SIZE):
     AUTOTUNE = tf.data.AUTOTUNE
     def _scale(x, y):
-        x = tf.image.resize(x, IMG_SIZE)
+        x = tf.image.resize(x, img_size)
         # EfficientNet preprocess_input expects float inputs in range [-1,1]
         x = tf.keras.applications.efficientnet.preprocess_input(x)
         return x, y
+    if fast:
+        ds = ds.with_options(data_options())
     ds = ds.map(_scale, num_parallel_calls=AUTOTUNE)
     if augment:
         aug = tf.keras.Sequential([
@@ -82,61 +151,301 @@ def prepare(ds, augment=False):
         ds = ds.map(lambda x, y: (aug(x, training=True), y), num_parallel_calls=AUTOTUNE)
     return ds.cache().prefetch(AUTOTUNE)
 
-def build_model(num_classes):
-    base = EfficientNetB0(include_top=False, input_shape=(*IMG_SIZE, 3), weights='imagenet')
+def compile_model(model, lr, jit_compile=False):
+    model.compile(optimizer=tf.keras.optimizers.Adam(lr),
+                  loss='categorical_crossentropy', metrics=['accuracy'], jit_compile=jit_compile)
+
+def build_model(num_classes, jit_compile=False, img_size=IMG_SIZE):
+    base = EfficientNetB0(include_top=False, input_shape=(*img_size, 3), weights='imagenet')
     base.trainable = False
-    inp = layers.Input(shape=(*IMG_SIZE, 3))
+    inp = layers.Input(shape=(*img_size, 3))
     x = base(inp, training=False)
     x = layers.GlobalAveragePooling2D()(x)
     x = layers.Dropout(0.3)(x)
     x = layers.Dense(128, activation='swish')(x)
-    out = layers.Dense(num_classes, activation='softmax')(x)
+    # keep the softmax in float32 so mixed precision does not underflow the probabilities
+    out = layers.Dense(num_classes, activation='softmax', dtype='float32')(x)
     model = models.Model(inp, out)
-    model.compile(optimizer=tf.keras.optimizers.Adam(1e-4),
-                  loss='categorical_crossentropy', metrics=['accuracy'])
+    compile_model(model, 1e-4, jit_compile=jit_compile)
     return model
 
-def main():
+def find_backbone(model):
+    # the EfficientNet base is the only nested Model; the InputLayer also has `trainable`
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.Model):
+            return layer
+    return None
+
+# -------------------------------------------------------------
+# DATA PARALLEL (tf.distribute)
+# -------------------------------------------------------------
+def make_strategy(kind="none", replicas=None):
+    """Must run before TensorFlow initialises its devices (i.e. before any op executes)."""
+    if kind == "none":
+        return tf.distribute.get_strategy()
+    if tf.config.list_physical_devices("GPU"):
+        return tf.distribute.MirroredStrategy()
+    cores = os.cpu_count() or 1
+    replicas = replicas or max(1, cores // 4)
+    cpus = tf.config.list_physical_devices("CPU")
+    tf.config.set_logical_device_configuration(
+        cpus[0], [tf.config.LogicalDeviceConfiguration() for _ in range(replicas)])
+    # split the cores between replicas instead of letting every replica grab all of them
+    tf.config.threading.set_intra_op_parallelism_threads(max(1, cores // replicas))
+    devices = [d.name for d in tf.config.list_logical_devices("CPU")]
+    return tf.distribute.MirroredStrategy(devices=devices,
+                                          cross_device_ops=tf.distribute.ReductionToOneDevice())
+
+# -------------------------------------------------------------
+# CHECKPOINTING / RESUME
+# -------------------------------------------------------------
+PHASES = ("head", "fine_tune")
+STATE_FILE = "state.json"
+BEST_WEIGHTS = "best.weights.h5"
+_CALLBACK_ATTRS = ("wait", "best", "cooldown_counter")
+
+def load_state(ckpt_dir):
+    path = os.path.join(ckpt_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_state(ckpt_dir, state):
+    path = os.path.join(ckpt_dir, STATE_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+class ResumableState(tf.keras.callbacks.Callback):
+    """Writes a full checkpoint (weights, optimizer slots, LR, callback counters) after every epoch.
+
+    Keep it last in the callbacks list: on_train_begin restores the counters of the
+    other callbacks after they have reset themselves. `best_val_loss` is the best seen
+    in any earlier phase or run; early stopping starts from it (and from the weights in
+    ckpt_dir/BEST_WEIGHTS) so a later phase can never end on something worse.
+    """
+
+    def __init__(self, ckpt_dir, phase, manager, watched, base_state, resume=None, best_val_loss=None):
+        super().__init__()
+        self.ckpt_dir = ckpt_dir
+        self.phase = phase
+        self.manager = manager
+        self.watched = watched
+        self.base_state = base_state
+        self.resume = resume or {}
+        self.best_val_loss = best_val_loss
+        self._epoch = 0
+
+    def on_train_begin(self, logs=None):
+        for name, attrs in self.resume.get("callbacks", {}).items():
+            cb = self.watched.get(name)
+            for attr, value in attrs.items():
+                if cb is not None and value is not None:
+                    setattr(cb, attr, value)
+        if self.resume.get("lr") is not None:
+            self.model.optimizer.learning_rate.assign(self.resume["lr"])
+        self._restore_best()
+
+    def _restore_best(self):
+        es = self.watched.get("early_stopping")
+        path = os.path.join(self.ckpt_dir, BEST_WEIGHTS)
+        if es is None or self.best_val_loss is None or not os.path.exists(path):
+            return
+        es.best = min(float(es.best), self.best_val_loss)
+        if es.restore_best_weights:
+            current = self.model.get_weights()
+            self.model.load_weights(path)
+            es.best_weights = self.model.get_weights()
+            self.model.set_weights(current)
+
+    def best(self):
+        """Best val_loss so far across phases and runs, or None."""
+        value = float(self.watched["checkpoint"].best)
+        if math.isfinite(value):
+            return value if self.best_val_loss is None else min(value, self.best_val_loss)
+        return self.best_val_loss
+
+    def _write(self, finished):
+        cb_state = {}
+        for name, cb in self.watched.items():
+            cb_state[name] = {a: float(getattr(cb, a)) for a in _CALLBACK_ATTRS if hasattr(cb, a)}
+        state = dict(self.base_state, phase=self.phase, epoch=self._epoch, finished=finished,
+                     lr=float(self.model.optimizer.learning_rate.numpy()), callbacks=cb_state,
+                     best_val_loss=self.best())
+        save_state(self.ckpt_dir, state)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._epoch = epoch + 1
+        self.manager.save(checkpoint_number=self._epoch)
+        self._write(finished=False)
+
+    def on_train_end(self, logs=None):
+        self._write(finished=True)
+
+def _checkpoint_manager(model, ckpt_dir, phase):
+    ckpt = tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+    return ckpt, tf.train.CheckpointManager(ckpt, os.path.join(ckpt_dir, phase), max_to_keep=3)
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Train the unified rash classifier.")
+    p.add_argument("--data-root", default=DATA_ROOT,
+                   help="dataset/<class>/... or dataset/train + dataset/val")
+    p.add_argument("--epochs", type=int, default=EPOCHS)
+    p.add_argument("--fine-tune-epochs", type=int, default=3)
+    p.add_argument("--batch", type=int, default=None,
+                   help=f"global batch size (default {BATCH}, or {FAST_BATCH} with --fast)")
+    p.add_argument("--img-size", type=int, default=IMG_SIZE[0])
+    p.add_argument("--seed", type=int, default=SEED)
+    p.add_argument("--patience", type=int, default=6, help="early stopping patience (epochs)")
+    p.add_argument("--fast", action="store_true",
+                   help="mixed precision (where supported), XLA jit_compile and tuned tf.data threading")
+    p.add_argument("--distribute", choices=["none", "mirrored"], default="none",
+                   help="mirrored = data parallel across GPUs, or across logical CPU replicas")
+    p.add_argument("--replicas", type=int, default=None,
+                   help="CPU replicas for --distribute mirrored (default: cores // 4)")
+    p.add_argument("--checkpoint-dir", default=os.path.join(BASE, "checkpoints"))
+    p.add_argument("--resume", action="store_true", help="continue from the last checkpoint in --checkpoint-dir")
+    p.add_argument("--out", default=MODEL_OUT, help="where to write the trained model")
+    p.add_argument("--class-json", default=None,
+                   help="label map to write (default: class_index_to_label.json when --out is the production model)")
+    p.add_argument("--report", default=None, help="write a JSON run summary (used by bench_training.py)")
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    batch = args.batch or (FAST_BATCH if args.fast else BATCH)
+    img_size = (args.img_size, args.img_size)
+
+    strategy = make_strategy(args.distribute, args.replicas)
+
+    policy = "float32"
+    if args.fast:
+        policy = pick_precision_policy()
+        tf.keras.mixed_precision.set_global_policy(policy)
+    print(f"Precision policy: {policy} | jit_compile: {args.fast} | batch: {batch} "
+          f"| replicas: {strategy.num_replicas_in_sync}")
+
     print("Detecting dataset...")
-    train_ds, val_ds, classes = build_datasets()
+    train_ds, val_ds, classes = build_datasets(args.data_root, batch=batch, img_size=img_size, seed=args.seed)
     print("Classes detected:", classes)
+    n_train = count_images(train_ds, batch)
+
+    state = load_state(args.checkpoint_dir) if args.resume else None
+    if args.resume and state is None:
+        print("No checkpoint state in", args.checkpoint_dir, "- starting from scratch")
+    if state and state.get("classes") != classes:
+        raise SystemExit("Checkpoint was trained on different classes; refusing to resume: "
+                         f"{state.get('classes')} != {classes}")
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
 
-    train_ds = prepare(train_ds, augment=True)
-    val_ds = prepare(val_ds, augment=False)
+    train_ds = prepare(train_ds, augment=True, fast=args.fast, img_size=img_size)
+    val_ds = prepare(val_ds, augment=False, fast=args.fast, img_size=img_size)
 
-    model = build_model(len(classes))
+    with strategy.scope():
+        model = build_model(len(classes), jit_compile=args.fast, img_size=img_size)
     model.summary()
 
-    callbacks = [
-        tf.keras.callbacks.ModelCheckpoint(MODEL_OUT, save_best_only=True, monitor='val_loss'),
-        tf.keras.callbacks.EarlyStopping(patience=6, restore_best_weights=True, monitor='val_loss'),
-        tf.keras.callbacks.ReduceLROnPlateau(patience=3, factor=0.5, monitor='val_loss')
-    ]
+    throughput = ThroughputLogger(n_train)
+    base_state = {"classes": classes, "config": {k: v for k, v in vars(args).items() if k != "resume"}}
+    phase_plan = [("head", args.epochs, 1e-4), ("fine_tune", args.fine_tune_epochs, 1e-5)]
 
-    model.fit(train_ds, validation_data=val_ds, epochs=EPOCHS, callbacks=callbacks)
+    # best val_loss of any phase / earlier run: checkpoints only ever move to something better
+    best_val_loss = state.get("best_val_loss") if state else None
+    best_weights = os.path.join(args.checkpoint_dir, BEST_WEIGHTS)
 
-    # Optional fine-tune
-    base_layer = None
-    for layer in model.layers:
-        if isinstance(layer, tf.keras.Model) or hasattr(layer, "trainable"):
-            base_layer = layer
-            break
-    if base_layer is not None:
-        try:
-            base_layer.trainable = True
-            model.compile(optimizer=tf.keras.optimizers.Adam(1e-5),
-                          loss='categorical_crossentropy', metrics=['accuracy'])
-            model.fit(train_ds, validation_data=val_ds, epochs=3, callbacks=callbacks)
-        except Exception:
-            # if fine-tune fails, ignore and continue
-            pass
-
-    model.save(MODEL_OUT)
-    with open(CLASS_JSON, "w", encoding="utf-8") as f:
+    started = time.perf_counter()
+    hist = None
+    for phase, epochs, lr in phase_plan:
+        if epochs <= 0:
+            continue
+        resume = None
+        if state:
+            done_idx = PHASES.index(state["phase"])
+            if PHASES.index(phase) < done_idx or (phase == state["phase"] and state.get("finished")):
+                print(f"Skipping phase '{phase}' (already completed)")
+                continue
+
+        with strategy.scope():
+            if phase == "fine_tune":
+                backbone = find_backbone(model)
+                if backbone is None:
+                    print("No backbone found; skipping fine-tune")
+                    continue
+                backbone.trainable = True
+                compile_model(model, lr, jit_compile=args.fast)
+            ckpt, manager = _checkpoint_manager(model, args.checkpoint_dir, phase)
+
+            initial_epoch = 0
+            if state:
+                # resuming into this phase (or the one after a finished phase): restore the newest weights
+                src = state["phase"]
+                if src != phase:
+                    _, src_manager = _checkpoint_manager(model, args.checkpoint_dir, src)
+                    latest = src_manager.latest_checkpoint
+                else:
+                    latest = manager.latest_checkpoint
+                    initial_epoch = int(state.get("epoch", 0))
+                    resume = state
+                if latest:
+                    try:
+                        model.optimizer.build(model.trainable_variables)
+                    except Exception:
+                        pass
+                    # the optimizer of a different phase is not ours; restore weights only
+                    target = ckpt if src == phase else tf.train.Checkpoint(model=model)
+                    target.restore(latest).expect_partial()
+                    print(f"Resumed phase '{phase}' from {latest} at epoch {initial_epoch}")
+                state = None
+        if initial_epoch >= epochs:
+            continue
+
+        watched = {
+            "checkpoint": tf.keras.callbacks.ModelCheckpoint(args.out, save_best_only=True, monitor='val_loss',
+                                                             initial_value_threshold=best_val_loss),
+            "best_weights": tf.keras.callbacks.ModelCheckpoint(best_weights, save_best_only=True,
+                                                               save_weights_only=True, monitor='val_loss',
+                                                               initial_value_threshold=best_val_loss),
+            "early_stopping": tf.keras.callbacks.EarlyStopping(patience=args.patience, restore_best_weights=True,
+                                                               monitor='val_loss'),
+            "reduce_lr": tf.keras.callbacks.ReduceLROnPlateau(patience=3, factor=0.5, monitor='val_loss'),
+        }
+        tracker = ResumableState(args.checkpoint_dir, phase, manager, watched, base_state, resume=resume,
+                                 best_val_loss=best_val_loss)
+        callbacks = list(watched.values()) + [throughput, tracker]
+        hist = model.fit(train_ds, validation_data=val_ds, epochs=epochs,
+                         initial_epoch=initial_epoch, callbacks=callbacks)
+        best_val_loss = tracker.best()
+    wall = time.perf_counter() - started
+
+    # args.out already holds the best epoch; the weights in memory may be a later, worse one
+    if best_val_loss is None or not os.path.exists(args.out):
+        model.save(args.out)
+    class_json = args.class_json
+    if class_json is None:
+        if os.path.abspath(args.out) == os.path.abspath(MODEL_OUT):
+            class_json = CLASS_JSON
+        else:
+            class_json = os.path.splitext(args.out)[0] + "_classes.json"
+    with open(class_json, "w", encoding="utf-8") as f:
         json.dump({i: c for i, c in enumerate(classes)}, f, ensure_ascii=False, indent=2)
 
-    print("Training finished. Model saved to:", MODEL_OUT)
-    print("Class map written to:", CLASS_JSON)
+    print("Training finished. Model saved to:", args.out)
+    print("Class map written to:", class_json)
+
+    if args.report:
+        val_acc = (hist.history.get("val_accuracy") if hist else None) or [None]
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({
+                "fast": args.fast,
+                "policy": policy,
+                "batch": batch,
+                "replicas": strategy.num_replicas_in_sync,
+                "wall_seconds": round(wall, 2),
+                "final_val_accuracy": val_acc[-1],
+                "epochs": throughput.history,
+            }, f, indent=2)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,7 +1,61 @@
+import os
+import time
+import threading
 from functools import wraps
-from flask import jsonify
+from flask import jsonify, g
 from flask_jwt_extended import verify_jwt_in_request, get_jwt
 
+# Identity and role come from the verified token: `sub` is str(user.id) and `role`
+# sits in additional_claims (auth_routes.login). A role change therefore takes effect
+# at the next login; nothing here goes back to the users table to re-check it.
+
+PROFILE_TTL = float(os.getenv("USER_PROFILE_TTL", "60"))
+
+def has_role(required_role):
+    """True when the request carries a valid JWT with this role claim. Never raises."""
+    try:
+        verify_jwt_in_request(optional=True)
+        return get_jwt().get("role") == required_role
+    except Exception:
+        return False
+
+def current_user():
+    """(user_id as int, role) from the already-verified token of this request; (None, None) without one."""
+    cached = g.get("_claims_user")
+    if cached is None:
+        claims = get_jwt() or {}
+        sub = claims.get("sub")
+        try:
+            user_id = int(sub)
+        except (TypeError, ValueError):
+            user_id = None
+        cached = g._claims_user = (user_id, claims.get("role"))
+    return cached
+
+def current_user_id():
+    return current_user()[0]
+
+def claims_required(*roles):
+    """Require a valid JWT (and one of `roles`, if given) without touching the database.
+
+    The wrapped view reads the caller with current_user() / current_user_id().
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                verify_jwt_in_request()
+                user_id, role = current_user()
+            except Exception:
+                return jsonify({"error": "Invalid or missing token"}), 401
+            if user_id is None:
+                return jsonify({"error": "Invalid or missing token"}), 401
+            if roles and role not in roles:
+                return jsonify({"error": "Unauthorized: Access denied"}), 403
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
 def role_required(required_role):
     def decorator(fn):
         @wraps(fn)
@@ -17,4 +71,79 @@ def role_required(required_role):
                 return jsonify({"error": "Invalid or missing token"}), 401
             return fn(*args, **kwargs)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+
+# -------------------------------------------------------------
+# USER PROFILE CACHE
+# -------------------------------------------------------------
+PROFILE_FIELDS = ("id", "full_name", "email", "role", "specialization", "experience", "bio")
+
+class UserProfileCache:
+    """Small TTL cache of public user fields (names for chat lists, doctor lookups).
+
+    Entries are dropped as soon as a User row is updated or deleted in this process;
+    other workers see the change within `ttl` seconds.
+    """
+
+    def __init__(self, ttl=PROFILE_TTL, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}   # user_id -> (expires_at, profile or None)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        return self.get_many([user_id]).get(int(user_id))
+
+    def get_many(self, user_ids):
+        """{user_id: profile dict} for the ids that exist; misses are loaded with one IN query."""
+        from metrics import metrics
+        from models import User
+
+        now = time.monotonic()
+        out, missing = {}, []
+        with self._lock:
+            for uid in {int(u) for u in user_ids if u is not None}:
+                entry = self._entries.get(uid)
+                if entry is not None and entry[0] > now:
+                    metrics.cache("user_profiles", True)
+                    if entry[1] is not None:
+                        out[uid] = entry[1]
+                else:
+                    metrics.cache("user_profiles", False)
+                    missing.append(uid)
+        if missing:
+            cols = [getattr(User, f) for f in PROFILE_FIELDS]
+            rows = {r.id: dict(zip(PROFILE_FIELDS, r)) for r in
+                    User.query.with_entities(*cols).filter(User.id.in_(missing)).all()}
+            with self._lock:
+                if len(self._entries) + len(missing) > self.max_entries:
+                    self._entries.clear()
+                for uid in missing:
+                    # unknown ids are cached too, so probing them does not hit the DB each time
+                    self._entries[uid] = (now + self.ttl, rows.get(uid))
+            out.update(rows)
+        return out
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(user_id), None)
+
+
+user_profiles = UserProfileCache()
+
+def _drop_cached_profile(mapper, connection, target):
+    user_profiles.invalidate(target.id)
+
+def _install_invalidation():
+    from sqlalchemy import event
+    from models import User
+
+    for name in ("after_insert", "after_update", "after_delete"):
+        if not event.contains(User, name, _drop_cached_profile):
+            event.listen(User, name, _drop_cached_profile)
+
+_install_invalidation()